@@ -0,0 +1,368 @@
+"""
+HTTP/JSON job API, served next to the Gradio UI.
+
+    POST   /v1/jobs              submit a job, returns 202 with its id (429 when full)
+    GET    /v1/jobs/{id}         status, timings and queue position
+    GET    /v1/jobs/{id}/result  the result image once the job has succeeded
+    DELETE /v1/jobs/{id}         cancel a queued or running job
+    GET    /v1/metrics           queue depth, wait times and job counts
+    GET    /metrics              Prometheus metrics of the whole process
+
+Jobs go through the same ``ResultCache`` and ``BatchScheduler`` (or
+``WorkerPool``) as the UI, so exact repeats are answered from the cache,
+identical requests in flight share one run, and jobs share the loaded
+pipelines, the caches and batching. Admission control keeps the queue short
+enough to serve within its SLA: a job is rejected with 429 (and a Retry-After
+hint) when the scheduler queue is at ``max_queue`` or the estimated wait
+exceeds ``max_wait_seconds``.
+"""
+import base64
+import io
+import math
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse, JSONResponse
+from PIL import Image
+from pydantic import BaseModel, Field
+
+from cancellation import CancelToken
+from inference import GenerationRequest
+from metrics import add_metrics_routes
+from region_edit import Box
+
+MAX_SEED = 2**31 - 1
+
+
+class JobRequest(BaseModel):
+    prompt: str
+    image: Optional[str] = Field(None, description="Base64-encoded input image; omit for text-to-image")
+    seed: Optional[int] = Field(None, ge=0, le=MAX_SEED, description="Random when omitted")
+    guidance_scale: float = Field(2.5, ge=1.0, le=10.0)
+    steps: int = Field(28, ge=1, le=50)
+    priority: int = Field(0, ge=-10, le=10, description="Higher runs first")
+    output_format: Optional[str] = Field(None, pattern="(?i)^(jpe?g|png|webp)$")
+    region: Optional[List[int]] = Field(
+        None, min_length=4, max_length=4,
+        description="[left, top, right, bottom] in input image pixels: edit only this area, blended back into the full image",
+    )
+
+
+class Job:
+    __slots__ = ("id", "params", "seed", "priority", "status", "error", "path", "future", "cancel_token",
+                 "run_token", "created", "started", "finished", "queue_seconds", "skipped_steps", "decode_seconds",
+                 "transferred_bytes")
+
+    def __init__(self, params, seed, priority):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.seed = seed
+        self.priority = priority
+        self.status = "queued"
+        self.error = None
+        self.path = None
+        self.future = None
+        self.cancel_token = CancelToken()
+        # Cancels the run itself, which identical requests may share with this job.
+        self.run_token = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.queue_seconds = None
+        self.skipped_steps = None
+        self.decode_seconds = None
+        self.transferred_bytes = None
+
+    @property
+    def done(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "seed": self.seed,
+            "priority": self.priority,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "queue_seconds": self.queue_seconds,
+            "run_seconds": self.finished - self.started if self.finished and self.started else None,
+            "skipped_steps": self.skipped_steps,
+            "decode_seconds": self.decode_seconds,
+            "transferred_bytes": self.transferred_bytes,
+            "result_url": f"/v1/jobs/{self.id}/result" if self.status == "succeeded" else None,
+        }
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class JobManager:
+    """
+    Tracks API jobs and applies admission control.
+
+    Args:
+        scheduler (BatchScheduler or WorkerPool): The scheduler shared with the UI.
+        result_cache (ResultCache): Shared with the UI: repeats are served from
+            it and identical in-flight requests share one run.
+        resolution_policy (ResolutionPolicy): Buckets input images.
+        region_editor (RegionEditor): Crops and composites region edits.
+        output_writer (OutputWriter): Writes result files.
+        max_queue (int, optional): Reject new jobs once this many items are
+            queued in the scheduler. Defaults to 16.
+        max_wait_seconds (float, optional): Reject new jobs whose estimated
+            queue wait exceeds this. ``0`` disables the estimate. Defaults to 0.
+        max_jobs (int, optional): Finished jobs kept for polling; the oldest are
+            forgotten first. Defaults to 256.
+        restore_input_size (bool, optional): Resize results back to the input size.
+    """
+
+    def __init__(self, scheduler, result_cache, resolution_policy, region_editor, output_writer, max_queue=16,
+                 max_wait_seconds=0, max_jobs=256, restore_input_size=False):
+        self.scheduler = scheduler
+        self.result_cache = result_cache
+        self.resolution_policy = resolution_policy
+        self.region_editor = region_editor
+        self.output_writer = output_writer
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.max_jobs = max_jobs
+        self.restore_input_size = restore_input_size
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        # Finishing touches (resize, file encode) stay off the scheduler thread.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-jobs")
+
+        self.submitted = 0
+        self.rejected = 0
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+        self.started_jobs = 0
+
+    def estimated_wait(self, depth):
+        """Seconds a new item would queue behind ``depth`` others, from past batch times."""
+        stats = self.scheduler.stats()
+        batches_ahead = math.ceil((depth + 1) / self.scheduler.max_batch_size)
+        return batches_ahead * stats["mean_batch_seconds"]
+
+    def admit(self):
+        depth = self.scheduler.queue_depth
+        if depth >= self.max_queue:
+            raise Rejected(f"queue is full ({depth} jobs waiting)", self.estimated_wait(depth) or 1)
+        if self.max_wait_seconds > 0:
+            wait = self.estimated_wait(depth)
+            if wait > self.max_wait_seconds:
+                raise Rejected(f"estimated wait {wait:.0f}s exceeds {self.max_wait_seconds:.0f}s", wait)
+
+    def submit(self, params):
+        input_image, original_size, region = None, None, None
+        if params.image and params.region:
+            original = Image.open(io.BytesIO(base64.b64decode(params.image))).convert("RGB")
+            region = (original, self.region_editor.crop(original, Box(*params.region)))
+            input_image, bucket = region[1].image, region[1].bucket
+        elif params.image:
+            input_image = Image.open(io.BytesIO(base64.b64decode(params.image))).convert("RGB")
+            original_size = input_image.size
+            input_image, bucket = self.resolution_policy.apply(input_image)
+        elif params.region:
+            raise ValueError("a region needs an input image")
+        else:
+            bucket = self.resolution_policy.choose(1024, 1024)
+            self.resolution_policy.record(bucket)
+
+        seed = params.seed if params.seed is not None else random.randint(0, MAX_SEED)
+        job = Job(params, seed, params.priority)
+        request = GenerationRequest(
+            prompt=params.prompt,
+            seed=seed,
+            guidance_scale=params.guidance_scale,
+            steps=params.steps,
+            width=bucket.width,
+            height=bucket.height,
+            input_image=input_image,
+            cancel_token=job.cancel_token,
+        )
+        # Admission and queueing happen together, so concurrent submissions cannot
+        # all pass the check, and a job is only visible once it has its future.
+        scheduled = []
+        with self._lock:
+            try:
+                self.admit()
+            except Rejected:
+                self.rejected += 1
+                raise
+            key = self.result_cache.key(
+                params.prompt, seed, params.guidance_scale, params.steps, bucket.width, bucket.height,
+                input_image=input_image,
+            )
+            job.future = self.result_cache.submit(
+                key,
+                request,
+                lambda request: scheduled.append(request) or self.scheduler.submit(
+                    request, priority=job.priority, on_start=lambda wait: self._started(job, wait)
+                ),
+            )
+            job.run_token = request.cancel_token
+            self._jobs[job.id] = job
+            self._prune()
+            self.submitted += 1
+        if not scheduled:
+            # A cache hit or a job joining an identical run never reaches the
+            # scheduler, so it starts as soon as it has its future.
+            self._started(job, time.time() - job.created)
+        job.future.add_done_callback(
+            lambda future: self._executor.submit(self._finish, job, future, original_size, region)
+        )
+        return job
+
+    def _started(self, job, wait):
+        with self._lock:
+            job.status = "running"
+            job.started = time.time()
+            job.queue_seconds = wait
+            self.started_jobs += 1
+            self.queue_wait_seconds += wait
+            self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, wait)
+
+    def _finish(self, job, future, original_size, region=None):
+        # Fields are collected first and set together, so a poll never sees a half-finished job.
+        fields = {}
+        try:
+            result = None if job.cancel_token.cancelled or future.cancelled() else future.result()
+            if result is None:
+                fields["status"] = "cancelled"
+            else:
+                image = result.image
+                if region is not None:
+                    image = self.region_editor.composite(region[0], region[1], image)
+                elif self.restore_input_size and original_size:
+                    image = self.resolution_policy.restore(image, original_size)
+                _, written = self.output_writer.submit(image, job.params.output_format)
+                fields = {
+                    "skipped_steps": result.skipped_steps,
+                    "decode_seconds": result.decode_seconds,
+                    "transferred_bytes": result.transferred_bytes,
+                    "path": written.result(),
+                    "status": "succeeded",
+                }
+        except Exception as exc:
+            fields = {"status": "failed", "error": repr(exc)}
+        with self._lock:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.finished = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[: max(0, len(self._jobs) - self.max_jobs)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="unknown job")
+        return job
+
+    def describe(self, job):
+        """``job.to_dict()``, read under the lock so it never mixes old and new fields."""
+        with self._lock:
+            return job.to_dict()
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if not job.done:
+            job.cancel_token.cancel("cancelled")
+            if job.run_token.cancelled:
+                # Nobody else is waiting on this run: drop it if it has not started.
+                job.future.cancel()
+        return job
+
+    def queue_position(self, job):
+        """Number of queued jobs that run before ``job`` (API jobs only)."""
+        if job.status != "queued":
+            return None
+        with self._lock:
+            queued = [other for other in self._jobs.values() if other.status == "queued"]
+        return sum(1 for other in queued if (-other.priority, other.created) < (-job.priority, job.created))
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "queue_depth": self.scheduler.queue_depth,
+            "max_queue": self.max_queue,
+            "estimated_wait_seconds": self.estimated_wait(self.scheduler.queue_depth),
+            "jobs": counts,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "mean_queue_wait_seconds": self.queue_wait_seconds / self.started_jobs if self.started_jobs else 0.0,
+            "max_queue_wait_seconds": self.max_queue_wait_seconds,
+            "scheduler": self.scheduler.stats(),
+        }
+
+
+def create_app(jobs):
+    """Build the FastAPI app around a ``JobManager``."""
+    app = FastAPI(title="FLUX.1 Kontext API")
+
+    @app.post("/v1/jobs", status_code=202)
+    def submit_job(params: JobRequest):
+        try:
+            job = jobs.submit(params)
+        except Rejected as exc:
+            return JSONResponse(
+                status_code=429,
+                content={"detail": str(exc)},
+                headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+            )
+        except (OSError, ValueError) as exc:
+            raise HTTPException(status_code=400, detail=f"invalid input: {exc}")
+        return dict(jobs.describe(job), queue_position=jobs.queue_position(job))
+
+    @app.get("/v1/jobs/{job_id}")
+    def job_status(job_id: str):
+        job = jobs.get(job_id)
+        return dict(jobs.describe(job), queue_position=jobs.queue_position(job))
+
+    @app.get("/v1/jobs/{job_id}/result")
+    def job_result(job_id: str):
+        job = jobs.get(job_id)
+        if job.status != "succeeded":
+            raise HTTPException(status_code=409, detail=f"job is {job.status}")
+        return FileResponse(job.path)
+
+    @app.delete("/v1/jobs/{job_id}")
+    def cancel_job(job_id: str):
+        return jobs.describe(jobs.cancel(job_id))
+
+    @app.get("/v1/metrics")
+    def metrics():
+        return jobs.stats()
+
+    add_metrics_routes(app)
+    return app
+
+
+def serve(app, host, port):
+    """Run ``app`` with uvicorn on a daemon thread."""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name=f"http-{port}", daemon=True)
+    thread.start()
+    print(f"{app.title} listening on http://{host}:{port}")
+    return server
@@ -1,28 +1,113 @@
-import os
-import gc
+import contextvars
+import queue
 import random
-import tempfile
+import threading
+import time
 import torch
-import devicetorch
 import gradio as gr
 import numpy as np
 from PIL import Image
 
-from diffusers import FluxKontextPipeline
-from diffusers.utils import load_image
-from dfloat11 import DFloat11Model
+import settings
+from batching import BatchScheduler
+from caches import ImageLatentCache, PromptEmbeddingCache
+from compile_cache import CompiledExecution, parse_buckets
+from cancellation import SessionCancellation
+from examples import EXAMPLE_GUIDANCE_SCALE, EXAMPLE_SEED, EXAMPLE_STEPS, EXAMPLES, precompute_examples
+from inference import GenerationRequest, run_batch
+from latents import image_hash
+from memory import MemoryManager, device_memory, process_memory
+from metrics import create_metrics_app, metrics
+from output_writer import OutputWriter
+from region_edit import RegionEditor, region_from_editor
+from resolution import ResolutionPolicy
+from result_cache import ResultCache
+from schedules import PRESETS, FastLoRA, ScheduleCache
+from step_cache import StepCache
+from vae_tiling import VAETiling
+from weight_residency import WeightResidency
+from pipeline_loader import PROCESS_START, PipelineLoader
 
 MAX_SEED = np.iinfo(np.int32).max
 
-pipe = FluxKontextPipeline.from_pretrained("fuliucansheng/FLUX.1-Kontext-dev-diffusers", torch_dtype=torch.bfloat16)
-DFloat11Model.from_pretrained(
-    "DFloat11/FLUX.1-Kontext-dev-DF11",
-    device="cpu",
-    bfloat16_model=pipe.transformer,
+# The pipeline is loaded on first use (or by the warm-up thread started before
+# launch), so the UI binds its port without waiting for multi-GB weights.
+resolution_policy = ResolutionPolicy(settings.MAX_PIXELS)
+region_editor = RegionEditor(settings.MAX_PIXELS, margin=settings.REGION_MARGIN, feather=settings.REGION_FEATHER)
+# Compiles for the configured buckets while loading; other sizes run eager.
+compiled = CompiledExecution(
+    settings.COMPILE,
+    parse_buckets(settings.COMPILE_BUCKETS, resolution_policy),
+    cache_dir=settings.COMPILE_CACHE_DIR,
 )
-pipe.enable_model_cpu_offload()
+loader = PipelineLoader(settings.PIPELINE_BACKEND, offload_mode=settings.OFFLOAD_MODE, prepare=compiled.prepare)
+prompt_cache = PromptEmbeddingCache(settings.PROMPT_CACHE_MB * 1024**2)
+image_cache = ImageLatentCache(settings.IMAGE_LATENT_CACHE_MB * 1024**2)
+schedule_cache = ScheduleCache()
+fast_lora = FastLoRA(settings.FAST_LORA, scale=settings.FAST_LORA_SCALE, max_steps=settings.FAST_LORA_MAX_STEPS)
+step_cache = StepCache(settings.STEP_CACHE_THRESHOLD)
+weight_residency = WeightResidency(settings.WEIGHT_RESIDENCY_MB * 1024**2)
+vae_tiling = VAETiling(settings.VAE_TILING_PIXELS, tile_size=settings.VAE_TILE_SIZE)
+# Everything besides the request itself that changes the output image.
+result_cache = ResultCache(
+    settings.RESULT_CACHE_DIR,
+    settings.RESULT_CACHE_MB * 1024**2,
+    model_id=(
+        f"{settings.PIPELINE_BACKEND}:{settings.MODEL_ID}:{settings.DFLOAT11_MODEL_ID}"
+        f":lora={settings.FAST_LORA}@{settings.FAST_LORA_SCALE}/{settings.FAST_LORA_MAX_STEPS}"
+        f":step_cache={settings.STEP_CACHE_THRESHOLD}"
+        f":vae_tiling={settings.VAE_TILING_PIXELS}/{settings.VAE_TILE_SIZE}"
+        f":text_encoders={settings.TEXT_ENCODERS}"
+    ),
+)
+output_writer = OutputWriter(
+    settings.OUTPUT_DIR,
+    image_format=settings.OUTPUT_FORMAT,
+    quality=settings.OUTPUT_QUALITY,
+    max_age_seconds=settings.OUTPUT_MAX_AGE_HOURS * 3600,
+    max_total_bytes=settings.OUTPUT_MAX_DISK_MB * 1024**2,
+)
+
+memory_manager = MemoryManager(
+    high_water=settings.MEMORY_HIGH_WATER,
+    idle_seconds=settings.MEMORY_IDLE_SECONDS,
+)
+
+def generate_batch(requests):
+    with memory_manager.active():
+        return run_batch(
+            loader.get(), requests, prompt_cache, image_cache, schedule_cache, fast_lora, step_cache, weight_residency,
+            vae_tiling,
+        )
+
+if settings.WORKERS:
+    from workers import RemoteLoader, WorkerPool, parse_devices
+
+    # Each worker process owns a pipeline on its device; requests go to the least loaded.
+    scheduler = WorkerPool(
+        parse_devices(settings.WORKERS, torch.cuda.device_count()),
+        settings.PIPELINE_BACKEND,
+        settings.OFFLOAD_MODE,
+        max_batch_size=settings.BATCH_MAX_SIZE,
+    )
+    loader = RemoteLoader(scheduler)
+else:
+    # All pipeline work goes through one scheduler thread, which groups concurrent
+    # requests with the same size and step count into a single denoising batch.
+    scheduler = BatchScheduler(
+        generate_batch,
+        key_fn=lambda request: request.batch_key,
+        max_batch_size=settings.BATCH_MAX_SIZE,
+        max_wait=settings.BATCH_MAX_WAIT_MS / 1000,
+    )
+cancellations = SessionCancellation()
+
+def cancel_session(request: gr.Request):
+    """Cancel the generation the calling browser session has queued or running."""
+    if cancellations.cancel(request.session_hash):
+        print("Generation cancelled by the user")
 
-def infer(input_image, prompt, seed=42, randomize_seed=False, guidance_scale=2.5, steps=28, progress=gr.Progress(track_tqdm=True)):
+def infer(input_image, prompt, seed=42, randomize_seed=False, guidance_scale=2.5, steps=28, input_latent_key=None, output_format=None, num_variations=1, region=None, progress=gr.Progress(track_tqdm=True), session: gr.Request = None):
     """
     Perform image editing using the FLUX.1 Kontext pipeline.
     
@@ -44,17 +129,39 @@ def infer(input_image, prompt, seed=42, randomize_seed=False, guidance_scale=2.5
             image quality. Range: 1.0-10.0. Defaults to 2.5.
         steps (int, optional): Controls how many steps to run the diffusion model for.
             Range: 1-30. Defaults to 28.
+        input_latent_key (tuple, optional): Image latent cache key of a previous result
+            that `input_image` was reused from, and the hash of the reused input image.
+            Lets the pipeline start from that result's latents instead of re-encoding
+            the image, as long as the input still is that image. Defaults to None.
+        output_format (str, optional): Format of the downloadable file: "JPEG", "PNG"
+            or "WebP". Defaults to the KONTEXT_OUTPUT_FORMAT setting.
+        num_variations (int, optional): Number of images to generate from consecutive
+            seeds starting at `seed`, in a single batch. Defaults to 1.
+        region (dict or Box, optional): Area of `input_image` to edit, as a
+            painted gr.ImageMask value or a region_edit.Box. Only a crop around it
+            is generated, at a resolution that fits the crop, and the result is
+            blended back into the full-size input. Defaults to None (whole image).
         progress (gr.Progress, optional): Gradio progress tracker for monitoring
             generation progress. Defaults to gr.Progress(track_tqdm=True).
+        session (gr.Request, optional): Injected by Gradio. A newer submission from
+            the same browser session cancels this one. Defaults to None.
     
-    Returns:
-        tuple: A 3-tuple containing:
+    Yields:
+        tuple: A 7-tuple. While denoising, low-resolution previews are sent every
+        KONTEXT_PREVIEW_EVERY steps in place of the image (other fields unchanged).
+        The final result is sent twice: first as soon as the image is ready (with no
+        file yet), then again once the download file has been written. Nothing more
+        is sent if the generation is cancelled:
             - PIL.Image.Image: The generated/edited image
+            - str: Path of the saved image file (None in the first update)
             - int: The seed value used for generation (useful when randomize_seed=True)
             - gr.update: Gradio update object to make the reuse button visible
+            - str: Image latent cache key of the result, for the reuse button
+            - gr.Gallery: All variations (hidden when there is only one)
+            - list: (file path, latent cache key) of each variation, None until written
     
     Example:
-        >>> edited_image, used_seed, button_update = infer(
+        >>> *_, (edited_image, file_path, used_seed, button_update, latent_key, _, _) = infer(
         ...     input_image=my_image,
         ...     prompt="Add sunglasses",
         ...     seed=123,
@@ -64,43 +171,154 @@ def infer(input_image, prompt, seed=42, randomize_seed=False, guidance_scale=2.5
     """
     if randomize_seed:
         seed = random.randint(0, MAX_SEED)
-    
-    if input_image:
+
+    request_start = time.perf_counter()
+    loader.get()
+    if input_latent_key is not None:
+        # An example or upload may have replaced the reused result since.
+        latent_key, reused_hash = input_latent_key
+        input_latent_key = latent_key if input_image is not None and image_hash(input_image) == reused_hash else None
+    region_box = region_from_editor(region) if isinstance(region, dict) else region
+    region_crop = None
+    if input_image and region_box:
+        original_image = input_image.convert("RGB")
+        original_size = None
+        region_crop = region_editor.crop(original_image, region_box)
+        input_image, bucket = region_crop.image, region_crop.bucket
+        # Reused latents are of the whole image, not of this crop.
+        input_latent_key = None
+        crop = region_crop.crop
+        print(f"Region edit: {crop.width}x{crop.height} crop at ({crop.left}, {crop.top}) "
+              f"of the {original_image.width}x{original_image.height} input")
+    elif input_image:
         input_image = input_image.convert("RGB")
-        image = pipe(
-            image=input_image, 
-            prompt=prompt,
-            guidance_scale=guidance_scale,
-            width = input_image.size[0],
-            height = input_image.size[1],
-            num_inference_steps=steps,
-            generator=torch.Generator().manual_seed(seed),
-        ).images[0]
+        original_size = input_image.size
+        input_image, bucket = resolution_policy.apply(input_image)
     else:
-        image = pipe(
+        original_size = None
+        bucket = resolution_policy.choose(1024, 1024)
+        resolution_policy.record(bucket)
+    print(f"Resolution bucket: {bucket}" + (f" (input {original_size[0]}x{original_size[1]})" if original_size else ""))
+
+    # The batch runs on the scheduler's thread; carry this request's Gradio
+    # context along so progress updates reach the right session.
+    report_progress = contextvars.copy_context().run
+
+    def report_step(step, total):
+        report_progress(progress, (step, total), desc="Denoising")
+
+    previews = queue.Queue()
+    session_id = session.session_hash if session is not None else None
+    cancel_token = cancellations.start(session_id)
+    # Variations use consecutive seeds and run as one batch, sharing the prompt
+    # embeddings and input latents. Only the first one streams progress and previews.
+    seeds = [(seed + offset) % (MAX_SEED + 1) for offset in range(max(1, int(num_variations)))]
+    requests = [
+        GenerationRequest(
             prompt=prompt,
+            seed=variation_seed,
             guidance_scale=guidance_scale,
-            num_inference_steps=steps,
-            generator=torch.Generator().manual_seed(seed),
-        ).images[0]
-
-    gradio_temp_dir = os.environ.get('GRADIO_TEMP_DIR', tempfile.gettempdir())
-    temp_file_path = os.path.join(gradio_temp_dir, "image.jpg")
-    # Convert to RGB if image has transparency (RGBA) to save as JPEG
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
-    image.save(temp_file_path, format="JPEG", quality=95)
-    print(f"Image saved in: {temp_file_path}")
-
-    gc.collect()
-    devicetorch.empty_cache(torch)
+            steps=steps,
+            width=bucket.width,
+            height=bucket.height,
+            input_image=input_image,
+            input_latent_key=input_latent_key,
+            on_step=report_step if index == 0 else None,
+            on_preview=previews.put if index == 0 else None,
+            preview_every=settings.PREVIEW_EVERY,
+            cancel_token=cancel_token,
+        )
+        for index, variation_seed in enumerate(seeds)
+    ]
+    # Exact repeats come straight from the result cache; identical requests
+    # already running are joined rather than run twice.
+    cache_keys = [
+        result_cache.key(
+            prompt, variation_seed, guidance_scale, steps, bucket.width, bucket.height,
+            input_image=input_image, input_latent_key=input_latent_key,
+        )
+        for variation_seed in seeds
+    ]
+    futures = result_cache.submit_many(cache_keys, requests, scheduler.submit_many)
+    try:
+        # Stream cheap latent previews into the result image while denoising runs.
+        while True:
+            try:
+                preview = previews.get(timeout=0.1)
+            except queue.Empty:
+                if all(future.done() for future in futures) or cancel_token.cancelled:
+                    break
+                continue
+            yield preview, None, seed, gr.update(), gr.update(), gr.update(), gr.update()
+    except GeneratorExit:
+        # The client went away or Gradio cancelled the event.
+        cancel_token.cancel("disconnected")
+        raise
+    finally:
+        for request, future in zip(requests, futures):
+            if request.cancelled:
+                # Nobody else is waiting on this run: drop it if it has not started.
+                future.cancel()
+        cancellations.finish(session_id, cancel_token)
+
+    results = [None if cancel_token.cancelled or future.cancelled() else future.result() for future in futures]
+    if results[0] is None:
+        print(f"Generation cancelled ({cancel_token.reason})")
+        return
+    result = results[0]
+    result_latent_key = result.latent_key
+    if result.skipped_steps:
+        print(f"Step cache: skipped {result.skipped_steps} of {steps} transformer passes")
+    if result.decode_seconds:
+        print(f"DFloat11 decode: {result.decode_seconds:.2f}s, "
+              f"{result.transferred_bytes / 1024**2:.0f} MB transferred to the device")
+    images = [result.image for result in results]
+    latent_keys = [result.latent_key for result in results]
+    if region_crop is not None:
+        images = [region_editor.composite(original_image, region_crop, image) for image in images]
+        # The latents are of the crop, so reusing the composite has to re-encode it.
+        result_latent_key, latent_keys = None, [None] * len(images)
+    elif settings.RESTORE_INPUT_SIZE and original_size:
+        images = [resolution_policy.restore(image, original_size) for image in images]
+
+    # Encode the download files in the background: the images are sent to the UI
+    # right away and the files follow once they have been written.
+    written = [output_writer.submit(image, output_format) for image in images]
+    gallery = gr.Gallery(value=images, visible=len(images) > 1)
+    yield images[0], None, seed, gr.Button(visible=True), result_latent_key, gallery, None
+
+    file_paths = []
+    for file_path, file_written in written:
+        file_written.result()
+        print(f"Image saved in: {file_path}")
+        file_paths.append(file_path)
+    if not settings.WORKERS:
+        cache_stats = prompt_cache.stats()
+        print(f"Prompt cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries")
+    cache_stats = result_cache.stats()
+    print(f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['deduplicated']} shared")
+
+    loader.record_request()
+    metrics.record_span("request", request_start, time.perf_counter(), steps=steps, variations=len(seeds))
+    # Each gallery item is the written file, so its download is in the chosen format.
+    gallery = gr.Gallery(
+        value=[(path, f"Seed {variation_seed}") for path, variation_seed in zip(file_paths, seeds)],
+        visible=len(images) > 1,
+    )
+    variations = list(zip(file_paths, latent_keys))
+    yield images[0], file_paths[0], seed, gr.Button(visible=True), result_latent_key, gallery, variations
 
-    return image, temp_file_path, seed, gr.Button(visible=True)
+def select_variation(variations, evt: gr.SelectData):
+    """Show the variation picked in the gallery as the result, for download and reuse."""
+    if not variations:
+        return gr.update(), gr.update(), gr.update()
+    file_path, latent_key = variations[evt.index]
+    return Image.open(file_path), file_path, latent_key
 
 def infer_example(input_image, prompt):
-    image, temp_file_path, seed, _ = infer(input_image, prompt)
-    gc.collect()
-    devicetorch.empty_cache(torch)
+    # Precomputed in the background at startup, so usually a result cache hit.
+    outputs = infer(input_image, prompt, seed=EXAMPLE_SEED, guidance_scale=EXAMPLE_GUIDANCE_SCALE, steps=EXAMPLE_STEPS)
+    image, temp_file_path, seed, *_ = list(outputs)[-1]
     return image,temp_file_path, seed
 
 css="""
@@ -595,10 +813,21 @@ with gr.Blocks(css=css, title="DFloat-Kontext") as demo:
         with gr.Row(equal_height=True):
             with gr.Column():
                 input_image = gr.Image(label="📸 Upload Your Image", type="pil", elem_classes="input-image", elem_id="row")
+                with gr.Accordion("🎯 Edit only a region", open=False):
+                    region = gr.ImageMask(
+                        label="Paint over the area to change (leave empty to edit the whole image)",
+                        type="pil",
+                        sources=(),
+                        transforms=(),
+                    )
                     
             with gr.Column():
                 result = gr.Image(label="✨ Your Transformed Creation", show_label=True, interactive=False, elem_classes="input-image", elem_id="row")
                 reuse_button = gr.Button("♻️ Reuse this image", visible=False, elem_id="reuse-btn")
+                result_latent_key = gr.State(None)
+                input_latent_key = gr.State(None)
+                variation_gallery = gr.Gallery(label="🖼️ Variations", columns=4, height="auto", visible=False)
+                variations = gr.State(None)
         
         with gr.Row(equal_height=True):
             with gr.Column():
@@ -615,6 +844,7 @@ with gr.Blocks(css=css, title="DFloat-Kontext") as demo:
             with gr.Column():
                 download_image = gr.File(label="💾 Download Your Masterpiece", elem_id="row-height", scale=0)
                 run_button = gr.Button("🚀 Transform Image!", scale=1, elem_id="run-btn")
+                stop_button = gr.Button("⏹️ Stop", variant="stop", size="sm")
 
         with gr.Row():
             with gr.Accordion("⚙️ Advanced Settings", open=False):
@@ -637,6 +867,12 @@ with gr.Blocks(css=css, title="DFloat-Kontext") as demo:
                     value=2.5,
                 )       
                 
+                speed_preset = gr.Radio(
+                    label="⚡ Speed preset",
+                    choices=list(PRESETS),
+                    value="Quality",
+                )
+
                 steps = gr.Slider(
                     label="🏃 Steps (quality vs speed)",
                     minimum=1,
@@ -644,29 +880,138 @@ with gr.Blocks(css=css, title="DFloat-Kontext") as demo:
                     value=28,
                     step=1
                 )
+
+                num_variations = gr.Slider(
+                    label="🎲 Variations (consecutive seeds, one batch)",
+                    minimum=1,
+                    maximum=4,
+                    value=1,
+                    step=1
+                )
+
+                output_format = gr.Radio(
+                    label="💾 Download format",
+                    choices=["JPEG", "PNG", "WebP"],
+                    value={"jpeg": "JPEG", "png": "PNG", "webp": "WebP"}.get(settings.OUTPUT_FORMAT.lower(), "JPEG"),
+                )
             
         examples = gr.Examples(
-            examples=[
-                ["flowers.png", "turn the flowers into sunflowers"],
-                ["monster.png", "make this monster ride a skateboard on the beach"],
-                ["cat.png", "make this cat happy"]
-            ],
+            examples=EXAMPLES,
             inputs=[input_image, prompt],
             outputs=[result, download_image, seed],
             fn=infer_example,
             cache_examples=False
         )
             
+    # A resubmission cancels the session's running generation right away (outside
+    # the queue, which it would otherwise wait behind) and then queues normally.
     gr.on(
+        triggers=[run_button.click, prompt.submit],
+        fn = cancel_session,
+        queue = False
+    )
+    run_event = gr.on(
         triggers=[run_button.click, prompt.submit],
         fn = infer,
-        inputs = [input_image, prompt, seed, randomize_seed, guidance_scale, steps],
-        outputs = [result, download_image, seed, reuse_button]
+        inputs = [input_image, prompt, seed, randomize_seed, guidance_scale, steps, input_latent_key, output_format, num_variations, region],
+        outputs = [result, download_image, seed, reuse_button, result_latent_key, variation_gallery, variations],
+        # Enough concurrent runs to fill a batch on every worker.
+        concurrency_limit = scheduler.max_batch_size,
+        trigger_mode = "multiple"
+    )
+    stop_button.click(
+        fn = cancel_session,
+        queue = False,
+        cancels = [run_event]
     )
+    demo.unload(cancel_session)
+    speed_preset.change(
+        fn = lambda preset: PRESETS[preset],
+        inputs = [speed_preset],
+        outputs = [steps]
+    )
+    variation_gallery.select(
+        fn = select_variation,
+        inputs = [variations],
+        outputs = [result, download_image, result_latent_key]
+    )
+    # The key is paired with the hash of the input as Gradio hands it back (the
+    # round trip re-encodes it), so infer only uses it while the input is unchanged.
     reuse_button.click(
         fn = lambda image: image,
         inputs = [result],
         outputs = [input_image]
+    ).then(
+        fn = lambda image, latent_key: (latent_key, image_hash(image)) if image is not None and latent_key else None,
+        inputs = [input_image, result_latent_key],
+        outputs = [input_latent_key]
+    )
+    # The region is painted over whatever the input currently is; a new input clears it.
+    input_image.change(
+        fn = lambda image: {"background": image, "layers": [], "composite": image} if image else None,
+        inputs = [input_image],
+        outputs = [region]
     )
 
-demo.launch(server_name="127.0.0.1", mcp_server=False)
+metrics.gauge("kontext_queue_depth", lambda: scheduler.queue_depth, "Requests waiting for the pipeline")
+metrics.gauge("kontext_pipeline_loaded", lambda: loader.is_loaded, "1 once the pipeline is loaded")
+metrics.gauge("kontext_result_cache_bytes", lambda: result_cache.current_bytes)
+metrics.gauge("kontext_result_cache_hits_total", lambda: result_cache.hits, kind="counter")
+metrics.gauge("kontext_result_cache_deduplicated_total", lambda: result_cache.deduplicated, kind="counter")
+# With workers these run inside the worker processes, so the ones here stay unused.
+if not settings.WORKERS:
+    for cache in (prompt_cache, image_cache):
+        metrics.gauge(f"kontext_{cache.name}_cache_bytes", lambda cache=cache: cache.current_bytes)
+        metrics.gauge(f"kontext_{cache.name}_cache_hits_total", lambda cache=cache: cache.hits, kind="counter")
+        metrics.gauge(f"kontext_{cache.name}_cache_misses_total", lambda cache=cache: cache.misses, kind="counter")
+    metrics.gauge("kontext_step_cache_skipped_total", lambda: step_cache.skipped, kind="counter")
+    metrics.gauge("kontext_step_cache_computed_total", lambda: step_cache.computed, kind="counter")
+    metrics.gauge("kontext_weight_resident_bytes", lambda: weight_residency.resident_bytes)
+    metrics.gauge("kontext_weight_decodes_total", lambda: weight_residency.decodes, kind="counter")
+    metrics.gauge("kontext_weight_resident_hits_total", lambda: weight_residency.resident_hits, kind="counter")
+    metrics.gauge("kontext_weight_evictions_total", lambda: weight_residency.evictions, kind="counter")
+    metrics.gauge("kontext_compiled_calls_total", lambda: compiled.compiled_calls, "Forward calls run compiled",
+                  kind="counter")
+    metrics.gauge("kontext_eager_calls_total", lambda: compiled.eager_calls, "Forward calls run eager", kind="counter")
+    metrics.gauge("kontext_vae_tiled_total", lambda: vae_tiling.tiled, "VAE encodes/decodes run in tiles", kind="counter")
+metrics.gauge("kontext_device_reserved_bytes", lambda: (device_memory() or {}).get("reserved"))
+metrics.gauge("kontext_device_allocated_bytes", lambda: (device_memory() or {}).get("allocated"))
+metrics.gauge("kontext_process_rss_bytes", lambda: (process_memory() or {}).get("rss"), "Resident host memory of this process")
+metrics.gauge("kontext_process_pss_bytes", lambda: (process_memory() or {}).get("pss"),
+              "Host memory of this process, counting shared pages in part")
+if settings.TRACE_FILE:
+    metrics.enable_trace(settings.TRACE_FILE)
+
+if settings.METRICS_PORT and settings.METRICS_PORT != settings.API_PORT:
+    from api import serve
+
+    serve(create_metrics_app(), settings.SERVER_NAME, settings.METRICS_PORT)
+
+if settings.API_PORT:
+    from api import JobManager, create_app, serve
+
+    api_jobs = JobManager(
+        scheduler,
+        result_cache,
+        resolution_policy,
+        region_editor,
+        output_writer,
+        max_queue=settings.API_MAX_QUEUE,
+        max_wait_seconds=settings.API_MAX_WAIT_SECONDS,
+        max_jobs=settings.API_MAX_JOBS,
+        restore_input_size=settings.RESTORE_INPUT_SIZE,
+    )
+    serve(create_app(api_jobs), settings.SERVER_NAME, settings.API_PORT)
+
+if settings.WARMUP_ON_START:
+    loader.warmup_async()
+    if settings.PRECOMPUTE_EXAMPLES and result_cache.max_bytes > 0:
+        threading.Thread(
+            target=precompute_examples,
+            args=(loader, resolution_policy, result_cache, scheduler),
+            name="precompute-examples",
+            daemon=True,
+        ).start()
+
+print(f"UI ready {time.perf_counter() - PROCESS_START:.2f}s after process start (backend: {loader.backend_name})")
+demo.launch(server_name=settings.SERVER_NAME, server_port=settings.SERVER_PORT, mcp_server=False)
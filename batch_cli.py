@@ -0,0 +1,312 @@
+"""
+Headless batch processing.
+
+    python batch_cli.py manifest.jsonl --output-dir out/
+    python batch_cli.py --input-dir photos/ --prompt "remove the background" --output-dir out/
+
+A manifest is JSONL or CSV with one job per row: ``image`` (path, relative to
+the manifest; empty for text-to-image), ``prompt`` and optionally ``seed``,
+``guidance_scale``, ``steps`` and ``id``. Jobs run through the same resolution
+policy, caches, batch scheduler and ``run_batch`` as the web UI.
+
+Input images are read and bucketed on a thread pool a bounded number of jobs
+ahead, results are encoded to disk on writer threads, and the denoiser only
+ever waits on the GPU. Every finished job is appended to
+``<output-dir>/results.jsonl``; re-running the same command skips jobs that
+already completed, so a crashed run resumes where it stopped.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import settings
+from batching import BatchScheduler
+from caches import ImageLatentCache, PromptEmbeddingCache
+from compile_cache import CompiledExecution, parse_buckets
+from inference import GenerationRequest, run_batch
+from memory import MemoryManager
+from output_writer import FORMATS, OutputWriter
+from pipeline_loader import PipelineLoader
+from resolution import ResolutionPolicy
+from schedules import FastLoRA, ScheduleCache
+from step_cache import StepCache
+from vae_tiling import VAETiling
+from weight_residency import WeightResidency
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+RESULTS_FILE = "results.jsonl"
+
+
+def read_manifest(path, defaults):
+    """
+    Load jobs from a JSONL or CSV manifest.
+
+    Args:
+        path (str): The manifest file.
+        defaults (dict): ``seed``, ``guidance_scale`` and ``steps`` for rows that
+            leave them out.
+
+    Returns:
+        list[dict]: One normalized job per row.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    jobs = []
+    for row in rows:
+        image = row.get("image") or None
+        if image and not os.path.isabs(image):
+            image = os.path.join(base, image)
+        jobs.append(_job(row.get("id"), image, row["prompt"], row, defaults))
+    return jobs
+
+
+def directory_jobs(directory, prompt, defaults):
+    """One job per image in ``directory``, all with the same prompt."""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [_job(None, os.path.join(directory, name), prompt, {}, defaults) for name in names]
+
+
+def _job(job_id, image, prompt, row, defaults):
+    def value(name, cast, *aliases):
+        for key in (name, *aliases):
+            if row.get(key) not in (None, ""):
+                return cast(row[key])
+        return defaults[name]
+
+    job = {
+        "image": image,
+        "prompt": prompt,
+        "seed": value("seed", int),
+        "guidance_scale": value("guidance_scale", float, "guidance"),
+        "steps": value("steps", int),
+    }
+    if not job_id:
+        # Derived from the job itself, so ids survive reordering the manifest.
+        key = json.dumps(job, sort_keys=True).encode()
+        stem = os.path.splitext(os.path.basename(image))[0] if image else "t2i"
+        job_id = f"{stem}-{hashlib.sha256(key).hexdigest()[:10]}"
+    job["id"] = str(job_id)
+    return job
+
+
+def completed_jobs(results_path):
+    """Ids of jobs recorded as done in an earlier run whose output still exists."""
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash.
+                continue
+            if record.get("status") == "ok" and os.path.exists(record.get("output", "")):
+                done.add(record["id"])
+    return done
+
+
+class ResultsLog:
+    """Appends one JSON line per finished job, flushed immediately."""
+
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self.ok = 0
+        self.failed = 0
+
+    def record(self, job, status, **fields):
+        record = dict(job, status=status, **fields)
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            if status == "ok":
+                self.ok += 1
+            else:
+                self.failed += 1
+                print(f"Job {job['id']} failed: {fields.get('error')}", file=sys.stderr)
+
+    def close(self):
+        self._file.close()
+
+
+def load_input(job, policy):
+    """Read and bucket a job's input image (runs on a prefetch thread)."""
+    if job["image"] is None:
+        bucket = policy.choose(1024, 1024)
+        policy.record(bucket)
+        return None, None, bucket
+    with Image.open(job["image"]) as image:
+        image = image.convert("RGB")
+    original_size = image.size
+    image, bucket = policy.apply(image)
+    return image, original_size, bucket
+
+
+def prefetch(jobs, pool, policy, depth):
+    """Yield ``(job, future)`` pairs, keeping at most ``depth`` inputs loading ahead."""
+    pending = deque()
+    for job in jobs:
+        pending.append((job, pool.submit(load_input, job, policy)))
+        if len(pending) >= depth:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def run(args):
+    jobs = (
+        read_manifest(args.manifest, vars(args))
+        if args.manifest
+        else directory_jobs(args.input_dir, args.prompt, vars(args))
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = os.path.join(args.output_dir, RESULTS_FILE)
+    done = completed_jobs(results_path)
+    todo = [job for job in jobs if job["id"] not in done]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(todo)} already done, {len(todo)} to run")
+    if not todo:
+        return 0
+
+    policy = ResolutionPolicy(settings.MAX_PIXELS)
+    compiled = CompiledExecution(
+        settings.COMPILE, parse_buckets(settings.COMPILE_BUCKETS, policy), cache_dir=settings.COMPILE_CACHE_DIR,
+    )
+    loader = PipelineLoader(args.backend, offload_mode=settings.OFFLOAD_MODE, prepare=compiled.prepare)
+    prompt_cache = PromptEmbeddingCache(settings.PROMPT_CACHE_MB * 1024**2)
+    image_cache = ImageLatentCache(settings.IMAGE_LATENT_CACHE_MB * 1024**2)
+    memory_manager = MemoryManager(high_water=settings.MEMORY_HIGH_WATER, idle_seconds=0)
+    schedule_cache = ScheduleCache()
+    fast_lora = FastLoRA(settings.FAST_LORA, scale=settings.FAST_LORA_SCALE, max_steps=settings.FAST_LORA_MAX_STEPS)
+    step_cache = StepCache(settings.STEP_CACHE_THRESHOLD)
+    weight_residency = WeightResidency(settings.WEIGHT_RESIDENCY_MB * 1024**2)
+    vae_tiling = VAETiling(settings.VAE_TILING_PIXELS, tile_size=settings.VAE_TILE_SIZE)
+    # Outputs belong to the user: never garbage-collect them.
+    writer = OutputWriter(
+        args.output_dir,
+        image_format=args.format,
+        quality=settings.OUTPUT_QUALITY,
+        max_workers=args.workers,
+        max_age_seconds=float("inf"),
+        max_total_bytes=float("inf"),
+    )
+
+    def generate_batch(requests):
+        with memory_manager.active():
+            return run_batch(
+                loader.get(), requests, prompt_cache, image_cache, schedule_cache, fast_lora, step_cache,
+                weight_residency, vae_tiling,
+            )
+
+    scheduler = BatchScheduler(
+        generate_batch,
+        key_fn=lambda request: request.batch_key,
+        max_batch_size=args.batch_size,
+        max_wait=settings.BATCH_MAX_WAIT_MS / 1000,
+    )
+    loader.get().set_progress_bar_config(disable=True)
+    log = ResultsLog(results_path)
+    extension = FORMATS[writer.image_format][1]
+    start = time.perf_counter()
+
+    def finish(job, original_size, future, submitted):
+        try:
+            result = future.result()
+        except Exception as exc:
+            log.record(job, "error", error=repr(exc))
+            return None
+        image = result.image
+        if args.restore_size and original_size:
+            image = policy.restore(image, original_size)
+        path = os.path.join(args.output_dir, job["id"] + extension)
+        _, written = writer.submit(image, path=path)
+
+        def on_written(written):
+            if written.exception() is not None:
+                log.record(job, "error", error=repr(written.exception()))
+            else:
+                log.record(job, "ok", output=path, width=image.width, height=image.height,
+                           seconds=round(time.perf_counter() - submitted, 3), skipped_steps=result.skipped_steps,
+                           decode_seconds=round(result.decode_seconds, 3), transferred_bytes=result.transferred_bytes)
+        written.add_done_callback(on_written)
+        return written
+
+    # Keep enough requests in flight for the scheduler to form full batches.
+    in_flight = deque()
+    writes = []
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="batch-prefetch") as pool:
+        for index, (job, loading) in enumerate(prefetch(todo, pool, policy, args.prefetch), 1):
+            try:
+                image, original_size, bucket = loading.result()
+            except Exception as exc:
+                log.record(job, "error", error=repr(exc))
+                continue
+            request = GenerationRequest(
+                prompt=job["prompt"],
+                seed=job["seed"],
+                guidance_scale=job["guidance_scale"],
+                steps=job["steps"],
+                width=bucket.width,
+                height=bucket.height,
+                input_image=image,
+            )
+            in_flight.append((job, original_size, scheduler.submit(request), time.perf_counter()))
+            while len(in_flight) >= 2 * args.batch_size:
+                writes.append(finish(*in_flight.popleft()))
+            if index % args.log_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"[{index}/{len(todo)}] {log.ok} done, {log.failed} failed, {log.ok / elapsed:.2f} images/s")
+        while in_flight:
+            writes.append(finish(*in_flight.popleft()))
+
+    for written in writes:
+        if written is not None:
+            written.exception()
+    scheduler.shutdown()
+    log.close()
+    elapsed = time.perf_counter() - start
+    print(f"Finished in {elapsed:.1f}s: {log.ok} done, {log.failed} failed ({log.ok / elapsed:.2f} images/s)")
+    print(f"Results manifest: {results_path}")
+    return 1 if log.failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("manifest", nargs="?", help="JSONL or CSV manifest of jobs")
+    source.add_argument("--input-dir", help="process every image in this directory with --prompt")
+    parser.add_argument("--prompt", help="edit applied to every image of --input-dir")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--format", default=settings.OUTPUT_FORMAT, choices=sorted(FORMATS))
+    parser.add_argument("--seed", type=int, default=42, help="default for jobs without a seed")
+    parser.add_argument("--guidance-scale", type=float, default=2.5, help="default for jobs without one")
+    parser.add_argument("--steps", type=int, default=28, help="default for jobs without one")
+    parser.add_argument("--batch-size", type=int, default=max(1, settings.BATCH_MAX_SIZE))
+    parser.add_argument("--prefetch", type=int, default=8, help="input images loaded ahead of the GPU")
+    parser.add_argument("--workers", type=int, default=2, help="threads for reading and for writing images")
+    parser.add_argument("--restore-size", action="store_true", default=settings.RESTORE_INPUT_SIZE,
+                        help="resize outputs back to their input size")
+    parser.add_argument("--backend", default=settings.PIPELINE_BACKEND)
+    parser.add_argument("--log-every", type=int, default=10)
+    args = parser.parse_args(argv)
+    if args.input_dir and not args.prompt:
+        parser.error("--input-dir requires --prompt")
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+Micro-batching scheduler for generation requests.
+
+Requests submitted from any thread are held for at most ``max_wait`` seconds
+while the scheduler looks for others with the same batch key; up to
+``max_batch_size`` of them then run as one batched pipeline call on a single
+worker thread, which also serialises all access to the pipeline. Items with a
+higher priority are picked first; equal priorities run in arrival order.
+Items submitted together with ``submit_many`` always run in the same batch,
+even when there are more of them than ``max_batch_size``.
+"""
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import metrics
+
+
+class _Pending:
+    __slots__ = ("item", "key", "priority", "on_start", "future", "enqueued", "group")
+
+    def __init__(self, item, key, priority=0, on_start=None):
+        self.item = item
+        self.key = key
+        self.priority = priority
+        self.on_start = on_start
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+        self.group = None
+
+    @property
+    def order(self):
+        return (-self.priority, self.enqueued)
+
+
+class BatchScheduler:
+    """
+    Groups compatible work items into batches and runs them on a worker thread.
+
+    Args:
+        run_batch (callable): Called with a list of items sharing a key; must
+            return one result per item, in order.
+        key_fn (callable): Maps an item to its batch key.
+        max_batch_size (int, optional): Largest batch to form. ``1`` disables
+            batching. Defaults to 4.
+        max_wait (float, optional): Seconds the oldest queued item may wait for
+            batch-mates before its batch runs anyway. Defaults to 0.05.
+    """
+
+    def __init__(self, run_batch, key_fn, max_batch_size=4, max_wait=0.05):
+        self.run_batch = run_batch
+        self.key_fn = key_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+        self.batch_size_counts = {}
+
+        self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, item, priority=0, on_start=None):
+        """
+        Queue ``item`` and return a ``Future`` resolving to its result.
+
+        Args:
+            item: The work item.
+            priority (int, optional): Higher values run first. Defaults to 0.
+            on_start (callable, optional): Called on the worker thread, with the
+                seconds ``item`` spent queued, when its batch starts running.
+        """
+        pending = _Pending(item, self.key_fn(item), priority, on_start)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is shut down")
+            self._pending.append(pending)
+            self._cond.notify()
+        return pending.future
+
+    def submit_many(self, items, priority=0, on_start=None):
+        """
+        Queue ``items`` to run together in one batch; they must share a batch key.
+
+        Returns:
+            list[Future]: One future per item, in order.
+        """
+        group = [_Pending(item, self.key_fn(item), priority, on_start) for item in items]
+        if len({pending.key for pending in group}) > 1:
+            raise ValueError("submit_many requires items with identical batch keys")
+        for pending in group:
+            pending.enqueued = group[0].enqueued
+            pending.group = group
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is shut down")
+            self._pending.extend(group)
+            self._cond.notify()
+        return [pending.future for pending in group]
+
+    def __call__(self, item):
+        """Submit ``item`` and block until its result is ready."""
+        return self.submit(item).result()
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+
+            # Drop items whose futures were cancelled while still queued.
+            self._pending = [p for p in self._pending if not p.future.cancelled()]
+            if not self._pending:
+                return []
+
+            first = min(self._pending, key=lambda p: p.order)
+            deadline = first.enqueued + self.max_wait
+            while True:
+                candidates = sorted((p for p in self._pending if p.key == first.key), key=lambda p: p.order)
+                # Groups are never split: a group runs whole, with any room left
+                # filled by items submitted on their own.
+                members = [p for p in candidates if first.group is not None and p.group is first.group]
+                limit = max(self.max_batch_size, len(members))
+                batch = (members + [p for p in candidates if p.group is None])[:limit]
+                remaining = deadline - time.perf_counter()
+                if len(batch) >= limit or remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+
+            for pending in batch:
+                self._pending.remove(pending)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [p for p in batch if p.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            waited = [start - p.enqueued for p in batch]
+            for pending, wait in zip(batch, waited):
+                metrics.record_span("queue_wait", pending.enqueued, start)
+                if pending.on_start is not None:
+                    pending.on_start(wait)
+            try:
+                results = self.run_batch([p.item for p in batch])
+            except Exception as exc:
+                for pending in batch:
+                    pending.future.set_exception(exc)
+            else:
+                for pending, result in zip(batch, results):
+                    pending.future.set_result(result)
+            elapsed = time.perf_counter() - start
+            self._record(len(batch), elapsed, waited)
+
+    def _record(self, size, elapsed, waited):
+        self.batches += 1
+        self.items += size
+        self.busy_seconds += elapsed
+        self.queue_wait_seconds += sum(waited)
+        self.batch_size_counts[size] = self.batch_size_counts.get(size, 0) + 1
+        print(
+            f"Batch of {size} ran in {elapsed:.2f}s ({size / elapsed:.2f} images/s), "
+            f"max queue wait {max(waited) * 1000:.0f}ms"
+        )
+
+    def stats(self):
+        """Throughput and latency summary since start-up."""
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "queue_depth": self.queue_depth,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "mean_batch_seconds": self.busy_seconds / self.batches if self.batches else 0.0,
+            "batch_size_counts": dict(self.batch_size_counts),
+            "images_per_busy_second": self.items / self.busy_seconds if self.busy_seconds else 0.0,
+            "mean_queue_wait_seconds": self.queue_wait_seconds / self.items if self.items else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_seconds": self.max_wait,
+        }
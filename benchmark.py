@@ -0,0 +1,704 @@
+"""
+Benchmarks for the Kontext pipeline.
+
+    python benchmark.py offload [--modes none model sequential text-encoders]
+                                [--backend stub] [--steps 28] [--repeats 1]
+    python benchmark.py presets [--presets Quality Fast Turbo] [--step-cache 0 0.08]
+                                [--backend stub] [--repeats 1]
+    python benchmark.py vae [--sizes 1024 2048] [--tile-size 512]
+                            [--backend stub] [--repeats 1]
+    python benchmark.py compile [--buckets 1024x1024] [--backend stub]
+                                [--steps 28] [--repeats 3]
+    python benchmark.py text-encoders [--repeats 3]
+    python benchmark.py startup [--backends dfloat11 snapshot] [--processes 2]
+                                [--steps 1]
+
+``offload`` runs the bundled examples under each offload mode and reports
+pipeline load time, per-stage latency (text encode, VAE encode, denoise, VAE
+decode), time spent moving weights between host and device, and peak memory.
+Every mode runs in a fresh subprocess so peak memory numbers are not polluted
+by the modes measured before it.
+
+``presets`` runs the examples at every speed preset through the app's own
+generation path (schedule cache and fast-mode LoRA included) and reports
+latency per image next to its PSNR against the highest-step preset's output
+for the same seed (computed without the step cache). ``--step-cache`` repeats
+every preset at each step cache threshold and adds the number of skipped
+transformer passes.
+
+``vae`` encodes and decodes a square image of each size with and without VAE
+tiling and reports the time of both and the peak memory. Like ``offload``,
+every combination runs in a fresh subprocess.
+
+``compile`` loads the pipeline eager and compiled (each in its own process)
+and reports the compile warm-up time, the compile cache hit rate and the
+steady-state latency per image at each bucket. Run it twice to see the warm-up
+of a restart that finds its artifacts in the cache.
+
+``text-encoders`` loads the model's text encoders in bf16 and int8 and reports
+the prompt encode latency of each (on CPU, and in bf16 on the accelerator if
+there is one), their memory, and the cosine similarity of the int8 embeddings
+of the example prompts to the bf16 ones.
+
+``startup`` starts several processes per backend at once, as a multi-worker
+host does, and reports how long each took to load the pipeline and run a first
+edit, and its resident (RSS) and proportional (PSS) host memory once all of
+them have done so.
+PSS splits shared pages between the processes, so the summed PSS is what they
+take together: with the ``snapshot`` backend the weights are memory-mapped and
+counted once.
+"""
+import argparse
+import json
+import math
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import devicetorch
+import numpy as np
+import torch
+from PIL import Image
+
+import settings
+from caches import ImageLatentCache, PromptEmbeddingCache
+from compile_cache import CompiledExecution, parse_buckets
+from examples import EXAMPLES
+from inference import GenerationRequest, run_batch
+from latents import decode_latents, encode_image, unpack_latents
+from memory import peak_memory, process_memory, reset_peak_memory
+from pipeline_loader import OFFLOAD_MODES, PipelineLoader
+from resolution import ResolutionPolicy
+from schedules import PRESETS, FastLoRA, ScheduleCache
+from step_cache import StepCache
+from vae_tiling import VAETiling
+
+STAGES = ("text_encode", "vae_encode", "denoise", "vae_decode")
+
+
+class StageTimer:
+    """Collects wall-clock samples per stage, synchronizing the device around each."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def __call__(self, stage):
+        devicetorch.synchronize(torch)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            devicetorch.synchronize(torch)
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def reset(self):
+        self.samples.clear()
+
+    def medians(self):
+        return {stage: statistics.median(values) for stage, values in self.samples.items()}
+
+
+@contextmanager
+def transfer_timer():
+    """
+    Time spent inside accelerate's offload hooks, i.e. moving weights between
+    host and device. Yields a dict whose ``seconds`` entry accumulates.
+    """
+    from accelerate import hooks
+
+    totals = {"seconds": 0.0}
+    patched = [
+        (hooks.CpuOffload, "pre_forward"),
+        (hooks.UserCpuOffloadHook, "offload"),
+        (hooks.AlignDevicesHook, "pre_forward"),
+        (hooks.AlignDevicesHook, "post_forward"),
+    ]
+    originals = [(cls, name, getattr(cls, name)) for cls, name in patched]
+
+    def timed(original):
+        def wrapper(*args, **kwargs):
+            devicetorch.synchronize(torch)
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                devicetorch.synchronize(torch)
+                totals["seconds"] += time.perf_counter() - start
+        return wrapper
+
+    for cls, name, original in originals:
+        setattr(cls, name, timed(original))
+    try:
+        yield totals
+    finally:
+        for cls, name, original in originals:
+            setattr(cls, name, original)
+
+
+def peak_memory_mb():
+    """Peak device memory (if any) and peak process RSS, in MB."""
+    peak_device = peak_memory()
+    # ru_maxrss is in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None if peak_device is None else peak_device / 1024**2, peak_rss
+
+
+@torch.no_grad()
+def run_example(pipe, policy, timer, image, prompt, steps, seed=0):
+    """Run one edit with every stage timed separately."""
+    image, bucket = policy.apply(image.convert("RGB"))
+    with timer("text_encode"):
+        prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(
+            prompt=prompt, prompt_2=None, device=pipe._execution_device
+        )
+    with timer("vae_encode"):
+        image_latents = encode_image(pipe, image).to(pipe._execution_device)
+    with timer("denoise"):
+        latents = pipe(
+            image=image_latents,
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            guidance_scale=2.5,
+            width=bucket.width,
+            height=bucket.height,
+            max_area=bucket.pixels,
+            num_inference_steps=steps,
+            generator=torch.Generator().manual_seed(seed),
+            output_type="latent",
+        ).images
+    with timer("vae_decode"):
+        decode_latents(pipe, unpack_latents(pipe, latents, bucket.width, bucket.height))
+    pipe.maybe_free_model_hooks()
+
+
+def measure_offload_mode(mode, backend, steps, repeats):
+    """Load the pipeline with ``mode`` and time the bundled examples."""
+    loader = PipelineLoader(backend, offload_mode=mode)
+    pipe = loader.get()
+    pipe.set_progress_bar_config(disable=True)
+    policy = ResolutionPolicy(settings.MAX_PIXELS)
+    images = [(Image.open(path), prompt) for path, prompt in EXAMPLES]
+    timer = StageTimer()
+
+    reset_peak_memory()
+    with transfer_timer() as transfers:
+        # The first pass is a warm-up and is not reported.
+        for image, prompt in images:
+            run_example(pipe, policy, timer, image, prompt, steps)
+        timer.reset()
+        transfers["seconds"] = 0.0
+        for _ in range(repeats):
+            for image, prompt in images:
+                run_example(pipe, policy, timer, image, prompt, steps)
+    peak_device, peak_rss = peak_memory_mb()
+
+    return {
+        "mode": mode,
+        "backend": loader.backend_name,
+        "device": devicetorch.get(torch),
+        "steps": steps,
+        "load_seconds": loader.load_seconds,
+        "stage_seconds": timer.medians(),
+        "transfer_seconds_per_image": transfers["seconds"] / (repeats * len(images)),
+        "peak_device_mb": peak_device,
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def psnr(image, reference):
+    """Peak signal-to-noise ratio between two same-sized 8-bit images, in dB."""
+    error = np.asarray(image, dtype=np.float64) - np.asarray(reference, dtype=np.float64)
+    mse = np.mean(error**2)
+    return math.inf if mse == 0 else 10 * math.log10(255**2 / mse)
+
+
+def measure_presets(presets, backend, repeats, step_cache_thresholds=(0.0,)):
+    """Latency and fidelity to the highest-step preset, per speed preset and step cache threshold."""
+    loader = PipelineLoader(backend, offload_mode=settings.OFFLOAD_MODE)
+    pipe = loader.get()
+    pipe.set_progress_bar_config(disable=True)
+    policy = ResolutionPolicy(settings.MAX_PIXELS)
+    # Encodes are cached after the warm-up, so the numbers isolate denoise + decode.
+    prompt_cache = PromptEmbeddingCache(settings.PROMPT_CACHE_MB * 1024**2)
+    image_cache = ImageLatentCache(settings.IMAGE_LATENT_CACHE_MB * 1024**2)
+    schedule_cache = ScheduleCache()
+    fast_lora = FastLoRA(settings.FAST_LORA, scale=settings.FAST_LORA_SCALE, max_steps=settings.FAST_LORA_MAX_STEPS)
+    inputs = [(policy.apply(Image.open(path).convert("RGB")), prompt) for path, prompt in EXAMPLES]
+
+    def generate(image, bucket, prompt, steps, step_cache=None):
+        request = GenerationRequest(
+            prompt=prompt, seed=0, guidance_scale=2.5, steps=steps,
+            width=bucket.width, height=bucket.height, input_image=image,
+        )
+        devicetorch.synchronize(torch)
+        start = time.perf_counter()
+        result = run_batch(pipe, [request], prompt_cache, image_cache, schedule_cache, fast_lora, step_cache)[0]
+        devicetorch.synchronize(torch)
+        return result, time.perf_counter() - start
+
+    for (image, bucket), prompt in inputs:
+        generate(image, bucket, prompt, 1)
+
+    reference_steps = max(PRESETS[name] for name in presets)
+    references = [generate(image, bucket, prompt, reference_steps)[0].image for (image, bucket), prompt in inputs]
+    results = []
+    for name in sorted(presets, key=lambda name: -PRESETS[name]):
+        steps = PRESETS[name]
+        for threshold in step_cache_thresholds:
+            step_cache = StepCache(threshold)
+            seconds, scores = [], []
+            for ((image, bucket), prompt), reference in zip(inputs, references):
+                for _ in range(repeats):
+                    output, elapsed = generate(image, bucket, prompt, steps, step_cache)
+                    seconds.append(elapsed)
+                scores.append(psnr(output.image, reference))
+            results.append({
+                "preset": name,
+                "steps": steps,
+                "lora": fast_lora.wanted(steps),
+                "step_cache_threshold": threshold,
+                "skipped_steps": step_cache.skipped / (len(inputs) * repeats),
+                "seconds_per_image": statistics.median(seconds),
+                "psnr_db": statistics.mean(scores),
+            })
+    return results
+
+
+@torch.no_grad()
+def measure_vae(size, tiled, tile_size, backend, repeats):
+    """Encode and decode one ``size`` x ``size`` image, tiled or not, and time both."""
+    loader = PipelineLoader(backend, offload_mode=settings.OFFLOAD_MODE)
+    pipe = loader.get()
+    path, _ = EXAMPLES[0]
+    image = Image.open(path).convert("RGB").resize((size, size), Image.LANCZOS)
+    tiling = VAETiling(1 if tiled else 0, tile_size=tile_size)
+    timer = StageTimer()
+
+    def run():
+        with tiling.applied(pipe, size, size):
+            with timer("vae_encode"):
+                latents = encode_image(pipe, image)
+            with timer("vae_decode"):
+                decode_latents(pipe, latents)
+
+    # The first pass is a warm-up and is not reported.
+    run()
+    timer.reset()
+    reset_peak_memory()
+    for _ in range(repeats):
+        run()
+    peak_device, peak_rss = peak_memory_mb()
+    return {
+        "size": size,
+        "tiled": tiled,
+        "tile_size": tile_size if tiled else None,
+        "backend": loader.backend_name,
+        "device": devicetorch.get(torch),
+        "stage_seconds": timer.medians(),
+        "peak_device_mb": peak_device,
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def measure_compiled(compile, buckets, backend, steps, repeats):
+    """Load the pipeline eager or compiled and time edits at each of ``buckets``."""
+    policy = ResolutionPolicy(settings.MAX_PIXELS)
+    compiled = CompiledExecution(compile, parse_buckets(buckets, policy), cache_dir=settings.COMPILE_CACHE_DIR)
+    loader = PipelineLoader(backend, offload_mode=settings.OFFLOAD_MODE, prepare=compiled.prepare)
+    pipe = loader.get()
+    pipe.set_progress_bar_config(disable=True)
+    prompt_cache = PromptEmbeddingCache(settings.PROMPT_CACHE_MB * 1024**2)
+    image_cache = ImageLatentCache(settings.IMAGE_LATENT_CACHE_MB * 1024**2)
+    path, prompt = EXAMPLES[0]
+    source = Image.open(path).convert("RGB")
+
+    seconds = {}
+    for bucket in compiled.buckets:
+        image = source.resize(bucket.size, Image.LANCZOS)
+        request = GenerationRequest(
+            prompt=prompt, seed=0, guidance_scale=2.5, steps=steps,
+            width=bucket.width, height=bucket.height, input_image=image,
+        )
+        # The first run fills the prompt and image caches and is not reported.
+        run_batch(pipe, [request], prompt_cache, image_cache)
+        samples = []
+        for _ in range(repeats):
+            devicetorch.synchronize(torch)
+            start = time.perf_counter()
+            run_batch(pipe, [request], prompt_cache, image_cache)
+            devicetorch.synchronize(torch)
+            samples.append(time.perf_counter() - start)
+        seconds[str(bucket)] = statistics.median(samples)
+    return dict(compiled.stats(), compile=compile, backend=loader.backend_name, steps=steps,
+                load_seconds=loader.load_seconds, seconds_per_image=seconds)
+
+
+@torch.no_grad()
+def measure_text_encoders(repeats):
+    """Encode latency, size and fidelity of the bf16 and int8 text encoders."""
+    from diffusers import FluxKontextPipeline
+
+    from text_encoders import embedding_similarity, module_nbytes, quantize_int8
+
+    def load():
+        return FluxKontextPipeline.from_pretrained(settings.MODEL_ID, transformer=None, vae=None, torch_dtype=torch.bfloat16)
+
+    reference, quantized = load(), load()
+    quantize_int8(quantized.text_encoder)
+    quantize_int8(quantized.text_encoder_2)
+    prompts = [prompt for _, prompt in EXAMPLES]
+
+    def timed(pipe, device):
+        samples = []
+        for _ in range(repeats):
+            for prompt in prompts:
+                devicetorch.synchronize(torch)
+                start = time.perf_counter()
+                pipe.encode_prompt(prompt=prompt, prompt_2=None, device=device)
+                devicetorch.synchronize(torch)
+                samples.append(time.perf_counter() - start)
+        return statistics.median(samples)
+
+    def nbytes(pipe):
+        return module_nbytes(pipe.text_encoder) + module_nbytes(pipe.text_encoder_2)
+
+    results = [
+        {"encoders": "bf16", "device": "cpu", "seconds_per_prompt": timed(reference, "cpu"), "mb": nbytes(reference) / 1024**2},
+        {"encoders": "int8", "device": "cpu", "seconds_per_prompt": timed(quantized, "cpu"), "mb": nbytes(quantized) / 1024**2},
+    ]
+    similarity = embedding_similarity(reference.encode_prompt, quantized.encode_prompt, prompts)
+    device = devicetorch.get(torch)
+    if device != "cpu":
+        reference.to(device)
+        timed(reference, device)
+        results.append({
+            "encoders": "bf16", "device": device, "seconds_per_prompt": timed(reference, device),
+            "mb": nbytes(reference) / 1024**2,
+        })
+    return results, similarity
+
+
+def measure_startup(backend, steps):
+    """Load the pipeline the way the app does, then run one edit so every weight has been read."""
+    loader = PipelineLoader(backend, offload_mode=settings.OFFLOAD_MODE)
+    pipe = loader.get()
+    pipe.set_progress_bar_config(disable=True)
+    path, prompt = EXAMPLES[0]
+    image, bucket = ResolutionPolicy(settings.MAX_PIXELS).apply(Image.open(path).convert("RGB"))
+    request = GenerationRequest(
+        prompt=prompt, seed=0, guidance_scale=2.5, steps=steps,
+        width=bucket.width, height=bucket.height, input_image=image,
+    )
+    start = time.perf_counter()
+    run_batch(pipe, [request], PromptEmbeddingCache(0), ImageLatentCache(0))
+    return {
+        "backend": loader.backend_name,
+        "load_seconds": loader.load_seconds,
+        "ready_since_start": loader.ready_since_start,
+        "first_image_seconds": time.perf_counter() - start,
+    }
+
+
+def print_table(rows, columns):
+    widths = [max(len(name), *(len(row[i]) for row in rows)) for i, name in enumerate(columns)]
+    print("  ".join(name.ljust(width) for name, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+def _fmt(value, spec):
+    return "n/a" if value is None else format(value, spec)
+
+
+def offload_command(args):
+    if args.child:
+        result = measure_offload_mode(args.child, args.backend, args.steps, args.repeats)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for mode in args.modes:
+        print(f"Benchmarking offload mode '{mode}'...", file=sys.stderr)
+        completed = subprocess.run(
+            [
+                sys.executable, __file__, "offload",
+                "--child", mode,
+                "--backend", args.backend,
+                "--steps", str(args.steps),
+                "--repeats", str(args.repeats),
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if completed.returncode != 0:
+            print(f"Offload mode '{mode}' failed (exit code {completed.returncode})", file=sys.stderr)
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    rows = [
+        [
+            result["mode"],
+            _fmt(result["load_seconds"], ".1f"),
+            *(_fmt(result["stage_seconds"].get(stage), ".3f") for stage in STAGES),
+            _fmt(result["transfer_seconds_per_image"], ".3f"),
+            _fmt(result["peak_device_mb"], ".0f"),
+            _fmt(result["peak_rss_mb"], ".0f"),
+        ]
+        for result in results
+    ]
+    print_table(rows, ["mode", "load_s", *(f"{stage}_s" for stage in STAGES), "transfer_s", "peak_device_mb", "peak_rss_mb"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def presets_command(args):
+    results = measure_presets(args.presets, args.backend, args.repeats, args.step_cache)
+    baseline = max(results, key=lambda result: result["seconds_per_image"])
+    rows = [
+        [
+            result["preset"],
+            str(result["steps"]),
+            "yes" if result["lora"] else "no",
+            _fmt(result["step_cache_threshold"], "g"),
+            _fmt(result["skipped_steps"], ".1f"),
+            _fmt(result["seconds_per_image"], ".3f"),
+            _fmt(baseline["seconds_per_image"] / result["seconds_per_image"], ".2f") + "x",
+            _fmt(result["psnr_db"], ".1f"),
+        ]
+        for result in results
+    ]
+    print_table(rows, ["preset", "steps", "lora", "step_cache", "skipped", "s_per_image", "speedup", "psnr_db"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def vae_command(args):
+    if args.child:
+        result = measure_vae(args.child, args.tiled, args.tile_size, args.backend, args.repeats)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for size in args.sizes:
+        for tiled in (False, True):
+            label = f"{size}x{size} {'tiled' if tiled else 'untiled'}"
+            print(f"Benchmarking VAE at {label}...", file=sys.stderr)
+            completed = subprocess.run(
+                [
+                    sys.executable, __file__, "vae",
+                    "--child", str(size),
+                    *(["--tiled"] if tiled else []),
+                    "--tile-size", str(args.tile_size),
+                    "--backend", args.backend,
+                    "--repeats", str(args.repeats),
+                ],
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            if completed.returncode != 0:
+                # Typically out of memory at large sizes without tiling.
+                print(f"VAE at {label} failed (exit code {completed.returncode})", file=sys.stderr)
+                continue
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    rows = [
+        [
+            f"{result['size']}x{result['size']}",
+            str(result["tile_size"]) if result["tiled"] else "no",
+            _fmt(result["stage_seconds"].get("vae_encode"), ".3f"),
+            _fmt(result["stage_seconds"].get("vae_decode"), ".3f"),
+            _fmt(result["peak_device_mb"], ".0f"),
+            _fmt(result["peak_rss_mb"], ".0f"),
+        ]
+        for result in results
+    ]
+    print_table(rows, ["size", "tiles", "vae_encode_s", "vae_decode_s", "peak_device_mb", "peak_rss_mb"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def compile_command(args):
+    if args.child:
+        result = measure_compiled(args.child == "compiled", args.buckets, args.backend, args.steps, args.repeats)
+        print(json.dumps(result))
+        return
+
+    results = {}
+    for mode in ("eager", "compiled"):
+        print(f"Benchmarking {mode} execution...", file=sys.stderr)
+        completed = subprocess.run(
+            [
+                sys.executable, __file__, "compile",
+                "--child", mode,
+                "--buckets", args.buckets,
+                "--backend", args.backend,
+                "--steps", str(args.steps),
+                "--repeats", str(args.repeats),
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if completed.returncode != 0:
+            print(f"{mode.capitalize()} execution failed (exit code {completed.returncode})", file=sys.stderr)
+            return
+        results[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    eager, compiled = results["eager"], results["compiled"]
+    print(f"Compile warm-up {compiled['warmup_seconds']:.1f}s for {compiled['shapes']} shapes, "
+          f"cache {compiled['cache_hits']} hits / {compiled['cache_misses']} misses")
+    rows = [
+        [
+            bucket,
+            _fmt(eager["seconds_per_image"][bucket], ".3f"),
+            _fmt(compiled["seconds_per_image"][bucket], ".3f"),
+            _fmt(eager["seconds_per_image"][bucket] / compiled["seconds_per_image"][bucket], ".2f") + "x",
+        ]
+        for bucket in compiled["seconds_per_image"]
+    ]
+    print_table(rows, ["bucket", "eager_s", "compiled_s", "speedup"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def text_encoders_command(args):
+    results, similarity = measure_text_encoders(args.repeats)
+    rows = [
+        [result["encoders"], result["device"], _fmt(result["seconds_per_prompt"], ".3f"), _fmt(result["mb"], ".0f")]
+        for result in results
+    ]
+    print_table(rows, ["encoders", "device", "s_per_prompt", "size_mb"])
+    print(f"int8 vs bf16 cosine similarity: prompt_embeds min {similarity['prompt_embeds_min']:.4f} "
+          f"mean {similarity['prompt_embeds_mean']:.4f}, pooled min {similarity['pooled_min']:.4f} "
+          f"mean {similarity['pooled_mean']:.4f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results, "similarity": similarity}, f, indent=2)
+
+
+def startup_command(args):
+    if args.child:
+        print(json.dumps(measure_startup(args.child, args.steps)), flush=True)
+        # Stay loaded until the parent has measured every process.
+        sys.stdin.read()
+        return
+
+    results = []
+    for backend in args.backends:
+        print(f"Starting {args.processes} processes with backend '{backend}'...", file=sys.stderr)
+        children = [
+            subprocess.Popen(
+                [sys.executable, __file__, "startup", "--child", backend, "--steps", str(args.steps)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+            )
+            for _ in range(args.processes)
+        ]
+        loaded = []
+        for child in children:
+            # The pipeline's own log lines come first; the result is the JSON line.
+            for line in child.stdout:
+                if line.startswith("{"):
+                    loaded.append(json.loads(line))
+                    break
+        if len(loaded) == len(children):
+            for result, child in zip(loaded, children):
+                result["memory"] = process_memory(child.pid)
+        for child in children:
+            child.stdin.close()
+            child.wait()
+        if len(loaded) < len(children):
+            print(f"Backend '{backend}' failed to start", file=sys.stderr)
+            continue
+        if any(result["memory"] is None for result in loaded):
+            print(f"No memory figures for backend '{backend}': /proc/<pid>/smaps_rollup is missing or incomplete",
+                  file=sys.stderr)
+            continue
+        results.append({"backend": backend, "processes": loaded})
+
+    rows = [
+        [
+            result["backend"],
+            str(len(result["processes"])),
+            _fmt(statistics.median(p["load_seconds"] for p in result["processes"]), ".2f"),
+            _fmt(statistics.median(p["ready_since_start"] for p in result["processes"]), ".2f"),
+            _fmt(statistics.median(p["first_image_seconds"] for p in result["processes"]), ".2f"),
+            _fmt(statistics.mean(p["memory"]["rss"] for p in result["processes"]) / 1024**2, ".0f"),
+            _fmt(statistics.mean(p["memory"]["pss"] for p in result["processes"]) / 1024**2, ".0f"),
+            _fmt(sum(p["memory"]["pss"] for p in result["processes"]) / 1024**2, ".0f"),
+        ]
+        for result in results
+    ]
+    print_table(rows, ["backend", "processes", "load_s", "ready_s", "first_image_s", "rss_mb", "pss_mb", "total_pss_mb"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    offload = subparsers.add_parser("offload", help="compare offload modes")
+    offload.add_argument("--modes", nargs="+", choices=OFFLOAD_MODES, default=list(OFFLOAD_MODES))
+    offload.add_argument("--backend", default=settings.PIPELINE_BACKEND)
+    offload.add_argument("--steps", type=int, default=28)
+    offload.add_argument("--repeats", type=int, default=1, help="measured passes over the examples")
+    offload.add_argument("--json", help="also write the raw results to this file")
+    offload.add_argument("--child", choices=OFFLOAD_MODES, help=argparse.SUPPRESS)
+    offload.set_defaults(func=offload_command)
+
+    presets = subparsers.add_parser("presets", help="compare speed presets: latency vs fidelity")
+    presets.add_argument("--presets", nargs="+", choices=list(PRESETS), default=list(PRESETS))
+    presets.add_argument("--backend", default=settings.PIPELINE_BACKEND)
+    presets.add_argument("--step-cache", nargs="+", type=float, default=[settings.STEP_CACHE_THRESHOLD],
+                         metavar="THRESHOLD", help="step cache thresholds to compare (0 disables)")
+    presets.add_argument("--repeats", type=int, default=1, help="timed runs per example and preset")
+    presets.add_argument("--json", help="also write the raw results to this file")
+    presets.set_defaults(func=presets_command)
+
+    vae = subparsers.add_parser("vae", help="compare tiled and untiled VAE encode/decode: time vs peak memory")
+    vae.add_argument("--sizes", nargs="+", type=int, default=[1024, 2048], help="square image edges in pixels")
+    vae.add_argument("--tile-size", type=int, default=settings.VAE_TILE_SIZE)
+    vae.add_argument("--backend", default=settings.PIPELINE_BACKEND)
+    vae.add_argument("--repeats", type=int, default=1, help="measured runs per size")
+    vae.add_argument("--json", help="also write the raw results to this file")
+    vae.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    vae.add_argument("--tiled", action="store_true", help=argparse.SUPPRESS)
+    vae.set_defaults(func=vae_command)
+
+    compile_parser = subparsers.add_parser("compile", help="compare eager and compiled execution")
+    compile_parser.add_argument("--buckets", default=settings.COMPILE_BUCKETS, help='"WxH,WxH" or "all"')
+    compile_parser.add_argument("--backend", default=settings.PIPELINE_BACKEND)
+    compile_parser.add_argument("--steps", type=int, default=28)
+    compile_parser.add_argument("--repeats", type=int, default=3, help="timed runs per bucket")
+    compile_parser.add_argument("--json", help="also write the raw results to this file")
+    compile_parser.add_argument("--child", choices=("eager", "compiled"), help=argparse.SUPPRESS)
+    compile_parser.set_defaults(func=compile_command)
+
+    text_encoders = subparsers.add_parser("text-encoders", help="compare bf16 and int8 text encoders")
+    text_encoders.add_argument("--repeats", type=int, default=3, help="timed passes over the example prompts")
+    text_encoders.add_argument("--json", help="also write the raw results to this file")
+    text_encoders.set_defaults(func=text_encoders_command)
+
+    startup = subparsers.add_parser("startup", help="compare cold start time and per-process memory of backends")
+    startup.add_argument("--backends", nargs="+", default=[settings.PIPELINE_BACKEND, "snapshot"])
+    startup.add_argument("--processes", type=int, default=2, help="processes started at once per backend")
+    startup.add_argument("--steps", type=int, default=1, help="steps of the edit each process runs before measuring")
+    startup.add_argument("--json", help="also write the raw results to this file")
+    startup.add_argument("--child", help=argparse.SUPPRESS)
+    startup.set_defaults(func=startup_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
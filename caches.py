@@ -0,0 +1,199 @@
+"""
+In-memory caches for intermediate pipeline tensors.
+
+All caches share ``ByteLRUCache``: an LRU map bounded by the total size of its
+values in bytes rather than by entry count, since entries range from a few KB to
+tens of MB.
+"""
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import torch
+
+from latents import encode_image, image_hash
+from metrics import span
+
+
+def tensor_nbytes(*tensors):
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+class ByteLRUCache:
+    """
+    Thread-safe LRU cache with a byte budget.
+
+    Args:
+        max_bytes (int): Total size of cached values before the least recently
+            used entries are evicted. ``0`` disables the cache.
+        name (str): Label used in stats output.
+    """
+
+    def __init__(self, max_bytes, name="cache"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace and Unicode variants so near-identical prompts share a key."""
+    return " ".join(unicodedata.normalize("NFC", prompt or "").split())
+
+
+class PromptEmbeddingCache(ByteLRUCache):
+    """
+    Caches ``(prompt_embeds, pooled_prompt_embeds)`` per normalized prompt.
+
+    Embeddings are stored on CPU so the cache never competes with the
+    transformer for device memory; a hit also skips moving the text encoders
+    on and off the accelerator under model CPU offload. With CPU text encoders
+    (see ``text_encoders.py``), misses can be encoded ahead of time with
+    ``prefetch``.
+    """
+
+    def __init__(self, max_bytes, max_sequence_length=512):
+        super().__init__(max_bytes, name="prompt_embeds")
+        self.max_sequence_length = max_sequence_length
+        self._pending = {}
+
+    def prefetch(self, pipe, prompts):
+        """
+        Start encoding the uncached ``prompts`` in the background, if ``pipe``
+        encodes prompts on a thread of its own; otherwise do nothing.
+        """
+        encode_prompt_async = getattr(pipe, "encode_prompt_async", None)
+        if encode_prompt_async is None:
+            return
+        for prompt in prompts:
+            key = normalize_prompt(prompt)
+            with self._lock:
+                if key in self._entries or key in self._pending:
+                    continue
+                self._pending[key] = encode_prompt_async(key, self.max_sequence_length)
+
+    def encode(self, pipe, prompt):
+        """
+        Return prompt embeddings for ``prompt`` on the pipeline's execution device.
+
+        Args:
+            pipe: A Flux/Kontext pipeline exposing ``encode_prompt``.
+            prompt (str): The raw prompt text.
+
+        Returns:
+            tuple: ``(prompt_embeds, pooled_prompt_embeds)`` ready to pass to ``pipe(...)``.
+        """
+        key = normalize_prompt(prompt)
+        device = pipe._execution_device
+        cached = self.get(key)
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if cached is None and pending is not None:
+            # Prefetched embeddings come straight off the text encoders; store them
+            # in the transformer's dtype like the ones encoded below.
+            cached = tuple(tensor.to("cpu", pipe.transformer.dtype) for tensor in pending.result())
+            self.put(key, cached, tensor_nbytes(*cached))
+        elif cached is None:
+            with torch.no_grad(), span("text_encode"):
+                prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(
+                    prompt=key,
+                    prompt_2=None,
+                    device=device,
+                    num_images_per_prompt=1,
+                    max_sequence_length=self.max_sequence_length,
+                )
+            cached = (prompt_embeds.cpu(), pooled_prompt_embeds.cpu())
+            self.put(key, cached, tensor_nbytes(*cached))
+
+        prompt_embeds, pooled_prompt_embeds = cached
+        return prompt_embeds.to(device), pooled_prompt_embeds.to(device)
+
+
+class ImageLatentCache(ByteLRUCache):
+    """
+    Caches VAE-encoded image latents by image content hash.
+
+    Besides encoded uploads, the app stores the final denoised latents of every
+    result here, so "reuse this image" can feed them straight back into the
+    pipeline without decoding, re-encoding or a lossy PIL round trip.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes, name="image_latents")
+
+    def add(self, key, latents):
+        latents = latents.detach().cpu()
+        self.put(key, latents, tensor_nbytes(latents))
+
+    def encode(self, pipe, image, key=None):
+        """
+        Return latents for ``image``, encoding it through the VAE only on a miss.
+
+        Args:
+            pipe: A Kontext pipeline.
+            image (PIL.Image.Image): RGB input image.
+            key (str, optional): Cache key to use instead of the content hash,
+                e.g. the key of a previous result being reused.
+
+        Returns:
+            tuple: ``(key, latents)`` with latents on the pipeline's execution device.
+        """
+        key = key or image_hash(image)
+        latents = self.get(key)
+        if latents is None:
+            with span("vae_encode"):
+                latents = encode_image(pipe, image)
+            self.add(key, latents)
+        return key, latents.to(pipe._execution_device)
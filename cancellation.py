@@ -0,0 +1,103 @@
+"""
+Cancellation of in-flight generations.
+
+Every request carries a ``CancelToken`` that the denoising loop checks after each
+step. ``SessionCancellation`` remembers the live token of each browser session,
+so that resubmitting, pressing stop or closing the tab cancels whatever that
+session already has queued or running instead of letting it finish unseen.
+"""
+import threading
+from collections import Counter
+
+
+class CancelToken:
+    """A thread-safe, one-way cancellation flag."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+class SessionCancellation:
+    """
+    Tracks the current generation of each session.
+
+    Starting a new generation for a session cancels the previous one (a newer
+    submission supersedes it). Tokens created without a session id are not
+    tracked and can only be cancelled directly.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def start(self, session_id):
+        """Return a fresh token for ``session_id``, cancelling the session's previous one."""
+        token = CancelToken()
+        if session_id is None:
+            return token
+        with self._lock:
+            previous = self._tokens.get(session_id)
+            self._tokens[session_id] = token
+        if previous is not None and not previous.cancelled:
+            previous.cancel("superseded")
+            self.counts["superseded"] += 1
+        return token
+
+    def cancel(self, session_id, reason="cancelled"):
+        """Cancel the session's current generation, if any. Returns True if one was cancelled."""
+        with self._lock:
+            token = self._tokens.pop(session_id, None)
+        if token is None or token.cancelled:
+            return False
+        token.cancel(reason)
+        self.counts[reason] += 1
+        return True
+
+    def finish(self, session_id, token):
+        """Forget ``token`` once its generation is over."""
+        with self._lock:
+            if self._tokens.get(session_id) is token:
+                del self._tokens[session_id]
+
+    def stats(self):
+        with self._lock:
+            active = len(self._tokens)
+        return {"active": active, "cancelled": dict(self.counts)}
+
+
+class CancelGroup:
+    """
+    A cancellation flag shared by several waiters on one generation.
+
+    It only reads as cancelled once every member token is cancelled, so identical
+    requests can share a single pipeline run that stops when nobody wants it.
+    """
+
+    def __init__(self, tokens=()):
+        self._tokens = list(tokens)
+        self._lock = threading.Lock()
+
+    def add(self, token):
+        with self._lock:
+            self._tokens.append(token)
+
+    @property
+    def cancelled(self):
+        with self._lock:
+            return bool(self._tokens) and all(token.cancelled for token in self._tokens)
+
+    @property
+    def reason(self):
+        with self._lock:
+            return self._tokens[-1].reason if self._tokens else None
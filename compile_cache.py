@@ -0,0 +1,201 @@
+"""
+Compiled transformer and VAE decoder, warmed up per resolution bucket.
+
+``torch.compile`` speeds up every denoising step, but compiling happens on the
+first call with each new input shape and takes from seconds to minutes, which
+would stall whichever request first hit that shape. ``CompiledExecution``
+therefore compiles only during a warm-up run per configured resolution bucket
+while the pipeline loads. At serving time, shapes seen during the warm-up run
+compiled and every other shape runs eager, so no request ever waits for a
+compile.
+
+Each transformer block is compiled on its own rather than the whole model:
+identical blocks share one compiled graph, and hooks on the blocks (DFloat11's
+weight decode, ``WeightResidency``) keep running eagerly around it. Compiled
+artifacts go to an on-disk inductor cache, so after a restart the warm-up loads
+them instead of recompiling.
+"""
+import os
+import time
+
+import torch
+
+from latents import decode_latents, unpack_latents
+from resolution import Bucket
+
+
+def parse_buckets(value, resolution_policy):
+    """
+    Buckets to compile for.
+
+    Args:
+        value (str): Comma-separated ``WIDTHxHEIGHT`` sizes, or ``all`` for
+            every bucket of ``resolution_policy``.
+        resolution_policy (ResolutionPolicy): Supplies the buckets for ``all``.
+
+    Returns:
+        list[Bucket]: The buckets, in order.
+    """
+    if value.strip().lower() == "all":
+        return list(resolution_policy.buckets)
+    buckets = []
+    for item in value.split(","):
+        width, _, height = item.strip().lower().partition("x")
+        if not width or not height:
+            raise ValueError(f"Invalid compile bucket {item!r}; expected WIDTHxHEIGHT")
+        buckets.append(Bucket(int(width), int(height)))
+    return buckets
+
+
+def _shapes(values):
+    key = []
+    for value in values:
+        if isinstance(value, torch.Tensor):
+            key.append(tuple(value.shape))
+        elif isinstance(value, (tuple, list)):
+            key.append(_shapes(value))
+    return tuple(key)
+
+
+class _Dispatch:
+    """Stands in for a module's ``forward``: compiled for warmed-up shapes, eager for the rest."""
+
+    def __init__(self, owner, name, forward):
+        self.owner = owner
+        self.name = name
+        self.eager = forward
+        self.compiled = torch.compile(forward, dynamic=False)
+
+    def __call__(self, *args, **kwargs):
+        key = (self.name, _shapes(args), _shapes(kwargs.values()))
+        owner = self.owner
+        if owner.warming:
+            owner.ready.add(key)
+        elif key not in owner.ready:
+            owner.eager_calls += 1
+            return self.eager(*args, **kwargs)
+        owner.compiled_calls += 1
+        return self.compiled(*args, **kwargs)
+
+
+def _inductor_counters():
+    from torch._dynamo.utils import counters
+
+    return counters["inductor"]["fxgraph_cache_hit"], counters["inductor"]["fxgraph_cache_miss"]
+
+
+class CompiledExecution:
+    """
+    Compiles the transformer blocks and the VAE decoder for a set of buckets.
+
+    Args:
+        enabled (bool): Compile at all. When False, ``prepare`` leaves the
+            pipeline untouched.
+        buckets (list[Bucket], optional): Output sizes to warm up. Buckets
+            with the same pixel count share the transformer's compiled graphs.
+        cache_dir (str, optional): Directory for the inductor cache that
+            persists compiled artifacts across restarts. Defaults to inductor's
+            own temporary directory.
+    """
+
+    def __init__(self, enabled, buckets=(), cache_dir=None):
+        self.enabled = enabled
+        self.buckets = list(buckets)
+        self.cache_dir = cache_dir
+        self.ready = set()
+        self.warming = False
+        self.installed = False
+        self.warmup_seconds = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.compiled_calls = 0
+        self.eager_calls = 0
+
+    def _install(self, pipe):
+        modules = [
+            *(("transformer_block", block) for block in pipe.transformer.transformer_blocks),
+            *(("single_transformer_block", block) for block in pipe.transformer.single_transformer_blocks),
+            ("vae_decoder", pipe.vae.decoder),
+        ]
+        if any(param.device.type == "meta" for _, module in modules for param in module.parameters()):
+            # Sequential offload streams weights in through accelerate hooks on every layer.
+            print("Compiled execution is not supported with sequential offload; running eager")
+            return False
+        for name, module in modules:
+            # An instance attribute: nn.Module.__call__ still runs the module's hooks around it.
+            module.forward = _Dispatch(self, name, module.forward)
+        return True
+
+    @torch.no_grad()
+    def _warm_up(self, pipe):
+        prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(
+            prompt="", prompt_2=None, device=pipe._execution_device
+        )
+        for bucket in self.buckets:
+            # An edit of an input image in the same bucket, which is what the app runs.
+            image_latents = torch.zeros(
+                1, pipe.vae.config.latent_channels, bucket.height // pipe.vae_scale_factor,
+                bucket.width // pipe.vae_scale_factor, device=pipe._execution_device, dtype=pipe.vae.dtype,
+            )
+            latents = pipe(
+                image=image_latents,
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                width=bucket.width,
+                height=bucket.height,
+                max_area=bucket.pixels,
+                num_inference_steps=1,
+                output_type="latent",
+            ).images
+            decode_latents(pipe, unpack_latents(pipe, latents, bucket.width, bucket.height))
+        pipe.maybe_free_model_hooks()
+
+    def prepare(self, pipe):
+        """
+        Compile ``pipe`` and warm it up for every bucket; pass to ``PipelineLoader(prepare=...)``.
+
+        Returns:
+            The same pipeline.
+        """
+        if not self.enabled or self.installed:
+            return pipe
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.cache_dir
+        torch._inductor.config.fx_graph_cache = True
+        # One entry per warmed-up shape for every compiled forward.
+        torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 4 * len(self.buckets) + 8)
+        if not self._install(pipe):
+            return pipe
+        self.installed = True
+
+        print(f"Compiling for {len(self.buckets)} buckets: {', '.join(map(str, self.buckets))}...")
+        hits, misses = _inductor_counters()
+        start = time.perf_counter()
+        self.warming = True
+        try:
+            self._warm_up(pipe)
+        finally:
+            self.warming = False
+        self.warmup_seconds = time.perf_counter() - start
+        self.cache_hits, self.cache_misses = (now - before for now, before in zip(_inductor_counters(), (hits, misses)))
+        self.compiled_calls = 0
+        print(f"Compile warm-up: {self.warmup_seconds:.1f}s for {len(self.ready)} shapes, "
+              f"compile cache {self.cache_hits} hits / {self.cache_misses} misses")
+        return pipe
+
+    def stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        calls = self.compiled_calls + self.eager_calls
+        return {
+            "enabled": self.installed,
+            "buckets": [str(bucket) for bucket in self.buckets],
+            "shapes": len(self.ready),
+            "warmup_seconds": self.warmup_seconds,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": self.cache_hits / lookups if lookups else None,
+            "compiled_calls": self.compiled_calls,
+            "eager_calls": self.eager_calls,
+            "compiled_fraction": self.compiled_calls / calls if calls else None,
+        }
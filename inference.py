@@ -0,0 +1,254 @@
+"""
+Batched generation on top of the Kontext pipeline.
+
+``run_batch`` turns a list of compatible ``GenerationRequest`` objects into a
+single pipeline call: prompt embeddings and image latents come from the shared
+caches and are concatenated along the batch dimension, every item keeps its own
+seed (one generator per item) and its own guidance scale. Cancelled requests
+stop the denoising loop once every item in their batch has been cancelled.
+With a ``StepCache``, steps are skipped for the batch as a whole, and every
+result reports how many were. Likewise, results report the DFloat11 decode time
+and host-to-device bytes of the pipeline call that produced them. A
+``VAETiling`` switches the VAE encode and decode of large images to tiles.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import devicetorch
+import torch
+from PIL import Image
+
+from cancellation import CancelToken
+from latents import decode_latents, estimate_denoised, image_hash, latents_to_preview, unpack_latents
+from metrics import metrics, span
+
+
+@dataclass
+class GenerationRequest:
+    """A single edit (or text-to-image) request, already resolved to a concrete size and seed."""
+
+    prompt: str
+    seed: int
+    guidance_scale: float
+    steps: int
+    width: int
+    height: int
+    input_image: Optional[Image.Image] = None
+    input_latent_key: Optional[str] = None
+    on_step: Optional[Callable[[int, int], None]] = None
+    on_preview: Optional[Callable[[Image.Image], None]] = None
+    preview_every: int = 0
+    cancel_token: Optional[CancelToken] = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_token is not None and self.cancel_token.cancelled
+
+    @property
+    def batch_key(self):
+        """Requests with equal keys can share one denoising batch."""
+        return (self.width, self.height, self.steps, self.input_image is not None)
+
+
+@dataclass
+class GenerationResult:
+    image: Image.Image
+    latents: torch.Tensor
+    latent_key: str
+    # Denoising steps whose transformer pass was answered from the step cache.
+    skipped_steps: int = 0
+    # DFloat11 decode time and compressed bytes moved to the device during the pipeline call.
+    decode_seconds: float = 0.0
+    transferred_bytes: int = 0
+
+
+@contextmanager
+def per_item_guidance(transformer, guidance_scales):
+    """
+    Feed a different guidance scale to each batch item.
+
+    The pipeline broadcasts a single ``guidance_scale`` over the batch; FLUX's
+    guidance embedding accepts one value per item, so a forward pre-hook swaps
+    in the per-item tensor for the duration of the call.
+    """
+    if len(set(guidance_scales)) <= 1:
+        yield
+        return
+
+    def hook(module, args, kwargs):
+        guidance = kwargs.get("guidance")
+        if guidance is not None:
+            kwargs["guidance"] = torch.tensor(guidance_scales, device=guidance.device, dtype=guidance.dtype)
+        return args, kwargs
+
+    handle = transformer.register_forward_pre_hook(hook, with_kwargs=True)
+    try:
+        yield
+    finally:
+        handle.remove()
+
+
+def run_batch(
+    pipe, requests, prompt_cache, image_cache, schedule_cache=None, fast_lora=None, step_cache=None,
+    weight_residency=None, vae_tiling=None,
+):
+    """
+    Generate all ``requests`` with as few pipeline calls as possible.
+
+    All requests must share the same ``batch_key``. Requests whose input images
+    encode to different latent shapes are split into sub-batches.
+
+    Args:
+        pipe: A Kontext pipeline.
+        requests (list[GenerationRequest]): Requests to run together.
+        prompt_cache (PromptEmbeddingCache): Cache used to encode prompts.
+        image_cache (ImageLatentCache): Cache used to encode input images.
+        schedule_cache (ScheduleCache, optional): Supplies precomputed sigma
+            schedules. Defaults to None (the pipeline computes its own).
+        fast_lora (FastLoRA, optional): Few-step LoRA, enabled for low step counts.
+        step_cache (StepCache, optional): Skips transformer passes on steps that
+            barely change. Defaults to None.
+        weight_residency (WeightResidency, optional): Keeps decoded DFloat11
+            blocks resident and counts decode work. Defaults to None.
+        vae_tiling (VAETiling, optional): Tiles the VAE for large images.
+            Defaults to None.
+
+    Returns:
+        list[GenerationResult]: One result per request, in order; ``None`` for
+        requests that were cancelled.
+    """
+    if len({request.batch_key for request in requests}) > 1:
+        raise ValueError("run_batch requires requests with identical batch keys")
+    if all(request.cancelled for request in requests):
+        return [None] * len(requests)
+
+    # With CPU text encoders, the prompts encode while the input images go through the VAE.
+    prompt_cache.prefetch(pipe, [request.prompt for request in requests])
+    if requests[0].input_image is None:
+        results = _run_group(
+            pipe, requests, prompt_cache, None, schedule_cache, fast_lora, step_cache, weight_residency, vae_tiling,
+        )
+    else:
+        groups = defaultdict(list)
+        for index, request in enumerate(requests):
+            with _tiling(vae_tiling, pipe, *request.input_image.size):
+                _, latents = image_cache.encode(pipe, request.input_image, key=request.input_latent_key)
+            groups[tuple(latents.shape)].append((index, latents))
+
+        results = [None] * len(requests)
+        for members in groups.values():
+            indices = [index for index, _ in members]
+            image_latents = torch.cat([latents for _, latents in members])
+            group_results = _run_group(
+                pipe, [requests[i] for i in indices], prompt_cache, image_latents,
+                schedule_cache, fast_lora, step_cache, weight_residency, vae_tiling,
+            )
+            for index, result in zip(indices, group_results):
+                results[index] = result
+
+    # Keep each result's latents so "Reuse this image" can skip the VAE encoder.
+    for result in results:
+        if result is not None:
+            image_cache.add(result.latent_key, result.latents)
+    return results
+
+
+def _tiling(vae_tiling, pipe, width, height):
+    return vae_tiling.applied(pipe, width, height) if vae_tiling is not None else nullcontext()
+
+
+def _run_group(
+    pipe, requests, prompt_cache, image_latents, schedule_cache=None, fast_lora=None, step_cache=None,
+    weight_residency=None, vae_tiling=None,
+):
+    first = requests[0]
+    embeds = [prompt_cache.encode(pipe, request.prompt) for request in requests]
+    prompt_embeds = torch.cat([prompt_embeds for prompt_embeds, _ in embeds])
+    pooled_prompt_embeds = torch.cat([pooled for _, pooled in embeds])
+    generators = [torch.Generator().manual_seed(request.seed) for request in requests]
+
+    previous = {"latents": None, "time": None}
+
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        latents = callback_kwargs["latents"]
+        done = step + 1
+        # Kernels run asynchronously; wait for this step to finish so its span is honest.
+        devicetorch.synchronize(torch)
+        now = time.perf_counter()
+        metrics.record_span("denoise_step", previous["time"] or denoise_start, now, step=done, batch=len(requests))
+        previous["time"] = now
+        if all(request.cancelled for request in requests):
+            # The pipeline skips the remaining steps once interrupted.
+            pipeline._interrupt = True
+            return {}
+        for request in requests:
+            if request.on_step is not None and not request.cancelled:
+                request.on_step(done, first.steps)
+
+        # Previews are skipped on the last step: the real image follows right after.
+        wanted = [
+            index for index, request in enumerate(requests)
+            if request.on_preview is not None and request.preview_every > 0 and not request.cancelled
+            and done % request.preview_every == 0 and done < first.steps
+        ]
+        if wanted:
+            sigmas = pipeline.scheduler.sigmas
+            denoised = estimate_denoised(
+                latents[wanted],
+                None if previous["latents"] is None else previous["latents"][wanted],
+                float(sigmas[step]),
+                float(sigmas[step + 1]),
+            )
+            previews = latents_to_preview(pipeline, denoised, first.width, first.height)
+            for index, preview in zip(wanted, previews):
+                requests[index].on_preview(preview)
+        previous["latents"] = latents
+        return {}
+
+    sigmas, schedule = None, nullcontext()
+    if schedule_cache is not None:
+        sigmas = schedule_cache.sigmas(pipe, first.steps, first.width, first.height)
+        schedule = schedule_cache.applied(pipe)
+    lora = fast_lora.applied(pipe, first.steps) if fast_lora is not None else nullcontext()
+    skipping = step_cache.applied(pipe) if step_cache is not None else nullcontext()
+    residency = weight_residency.applied(pipe) if weight_residency is not None else nullcontext()
+
+    denoise_start = time.perf_counter()
+    with per_item_guidance(pipe.transformer, [request.guidance_scale for request in requests]), \
+            schedule, lora, skipping as step_run, residency as decode_run, \
+            span("denoise", steps=first.steps, batch=len(requests)):
+        latents = pipe(
+            image=image_latents,
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            guidance_scale=first.guidance_scale,
+            width=first.width,
+            height=first.height,
+            num_inference_steps=first.steps,
+            sigmas=sigmas,
+            generator=generators,
+            max_area=first.width * first.height,
+            output_type="latent",
+            callback_on_step_end=on_step_end,
+        ).images
+    latents = unpack_latents(pipe, latents, first.width, first.height)
+    skipped_steps = step_run.skipped if step_run is not None else 0
+    decode_seconds = decode_run.decode_seconds if decode_run is not None else 0.0
+    transferred_bytes = decode_run.transferred_bytes if decode_run is not None else 0
+
+    results = []
+    for request, item_latents in zip(requests, latents.split(1)):
+        if request.cancelled:
+            results.append(None)
+            continue
+        with span("vae_decode"), _tiling(vae_tiling, pipe, first.width, first.height):
+            image = decode_latents(pipe, item_latents)[0]
+        results.append(GenerationResult(
+            image=image, latents=item_latents.cpu(), latent_key=image_hash(image), skipped_steps=skipped_steps,
+            decode_seconds=decode_seconds, transferred_bytes=transferred_bytes,
+        ))
+    pipe.maybe_free_model_hooks()
+    return results
@@ -0,0 +1,126 @@
+"""
+Helpers for moving between PIL images and Kontext latents.
+
+These mirror the preprocessing and decoding done inside
+``FluxKontextPipeline.__call__`` so that the app can encode an input image once
+(and cache it), run the denoiser with ``output_type="latent"`` and decode the
+result itself.
+"""
+import hashlib
+
+import torch
+from PIL import Image
+
+# Linear map from FLUX's 16 latent channels to approximate RGB in [-1, 1], as
+# used by ComfyUI's latent previewer. Orders of magnitude cheaper than a VAE
+# decode, good enough to judge composition mid-generation.
+FLUX_LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+FLUX_LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+
+def image_hash(image):
+    """Content hash of a PIL image's pixels, size and mode."""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+@torch.no_grad()
+def encode_image(pipe, image):
+    """
+    VAE-encode a PIL image the way the Kontext pipeline would.
+
+    The image is expected to be bucketed already (see ``resolution.py``); it is
+    only resized down to a multiple of the latent patch size if needed.
+
+    Args:
+        pipe: A Kontext pipeline.
+        image (PIL.Image.Image): RGB input image.
+
+    Returns:
+        torch.Tensor: Scaled image latents of shape ``(1, C, H/8, W/8)`` on CPU.
+    """
+    multiple_of = pipe.vae_scale_factor * 2
+    width = image.size[0] // multiple_of * multiple_of
+    height = image.size[1] // multiple_of * multiple_of
+    pixels = pipe.image_processor.preprocess(image, height, width)
+    pixels = pixels.to(device=pipe._execution_device, dtype=pipe.vae.dtype)
+    return pipe._encode_vae_image(image=pixels, generator=None).cpu()
+
+
+def unpack_latents(pipe, latents, width, height):
+    """Turn packed ``(B, seq, C*4)`` transformer latents into ``(B, C, H/8, W/8)``."""
+    return pipe._unpack_latents(latents, height, width, pipe.vae_scale_factor)
+
+
+@torch.no_grad()
+def decode_latents(pipe, latents, output_type="pil"):
+    """
+    Decode unpacked, scaled latents to images.
+
+    Args:
+        pipe: A Kontext pipeline.
+        latents (torch.Tensor): Latents from ``unpack_latents``.
+        output_type (str, optional): ``"pil"``, ``"np"`` or ``"pt"``. Defaults to ``"pil"``.
+
+    Returns:
+        list: Decoded images in the requested format.
+    """
+    latents = latents.to(device=pipe._execution_device, dtype=pipe.vae.dtype)
+    latents = (latents / pipe.vae.config.scaling_factor) + pipe.vae.config.shift_factor
+    image = pipe.vae.decode(latents, return_dict=False)[0]
+    return pipe.image_processor.postprocess(image, output_type=output_type)
+
+
+def estimate_denoised(latents, previous_latents, sigma, sigma_next):
+    """
+    Estimate the clean latents from two consecutive flow-matching steps.
+
+    An Euler step moves ``x`` by ``(sigma_next - sigma) * v``, so the velocity can
+    be recovered from consecutive latents and extrapolated to ``sigma = 0``.
+    Falls back to the noisy latents when there is no previous step.
+    """
+    if previous_latents is None or sigma_next == sigma:
+        return latents
+    velocity = (latents - previous_latents) / (sigma_next - sigma)
+    return latents - sigma_next * velocity
+
+
+@torch.no_grad()
+def latents_to_preview(pipe, latents, width, height):
+    """
+    Cheap RGB previews of packed transformer latents, at 1/8 of the output size.
+
+    Args:
+        pipe: A Kontext pipeline.
+        latents (torch.Tensor): Packed ``(B, seq, C*4)`` latents.
+        width (int): Output width the latents were generated for.
+        height (int): Output height the latents were generated for.
+
+    Returns:
+        list[PIL.Image.Image]: One preview per batch item.
+    """
+    latents = unpack_latents(pipe, latents, width, height).float().cpu()
+    factors = torch.tensor(FLUX_LATENT_RGB_FACTORS)
+    bias = torch.tensor(FLUX_LATENT_RGB_BIAS)
+    rgb = torch.einsum("bchw,cr->bhwr", latents, factors) + bias
+    rgb = ((rgb.clamp(-1, 1) + 1) * 127.5).round().to(torch.uint8).numpy()
+    return [Image.fromarray(item) for item in rgb]
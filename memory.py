@@ -0,0 +1,176 @@
+"""
+Adaptive memory cleanup.
+
+Running ``gc.collect()`` and emptying the allocator cache after every request
+costs tens to hundreds of milliseconds and throws away cached blocks the next
+request immediately needs again. ``MemoryManager`` only cleans up when the
+accelerator's reserved memory is above a high-water mark, or once the app has
+been idle for a while, and keeps track of how long cleanup takes.
+"""
+import gc
+import threading
+import time
+from contextlib import contextmanager
+
+import devicetorch
+import torch
+
+from metrics import BYTES_BUCKETS, observe, span
+
+
+def device_memory():
+    """
+    Current accelerator memory usage.
+
+    Returns:
+        dict or None: ``allocated``, ``reserved`` and ``total`` bytes, or None on CPU.
+    """
+    device = devicetorch.get(torch)
+    if device == "cuda":
+        _, total = torch.cuda.mem_get_info()
+        return {
+            "allocated": torch.cuda.memory_allocated(),
+            "reserved": torch.cuda.memory_reserved(),
+            "total": total,
+        }
+    if device == "mps":
+        return {
+            "allocated": torch.mps.current_allocated_memory(),
+            "reserved": torch.mps.driver_allocated_memory(),
+            "total": torch.mps.recommended_max_memory(),
+        }
+    return None
+
+
+def process_memory(pid="self"):
+    """
+    Current host memory of a process (this one by default), from ``/proc/<pid>/smaps_rollup``.
+
+    ``pss`` charges pages shared with other processes (e.g. a memory-mapped
+    snapshot in the page cache) in equal parts to each of them, so summed over
+    workers it is the host memory they take together.
+
+    Returns:
+        dict or None: ``rss``, ``pss`` and ``shared`` bytes, or None where the
+        kernel does not report them.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = {line.split()[0].rstrip(":"): int(line.split()[1]) * 1024 for line in f if line.endswith("kB\n")}
+    except OSError:
+        return None
+    if not {"Rss", "Pss", "Shared_Clean", "Shared_Dirty"} <= fields.keys():
+        return None
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "shared": fields["Shared_Clean"] + fields["Shared_Dirty"],
+    }
+
+
+def reset_peak_memory():
+    if devicetorch.get(torch) == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory():
+    """Peak allocated accelerator memory since the last reset, in bytes (None on CPU)."""
+    device = devicetorch.get(torch)
+    if device == "cuda":
+        return torch.cuda.max_memory_allocated()
+    if device == "mps":
+        # MPS keeps no peak statistics; the driver's current allocation is the closest proxy.
+        return torch.mps.driver_allocated_memory()
+    return None
+
+
+class MemoryManager:
+    """
+    Decides when to run garbage collection and empty the allocator cache.
+
+    Args:
+        high_water (float, optional): Clean up after a request when reserved
+            memory exceeds this fraction of device memory. Defaults to 0.85.
+        idle_seconds (float, optional): Clean up once no request has run for
+            this long. ``0`` disables idle cleanup. Defaults to 60.
+    """
+
+    def __init__(self, high_water=0.85, idle_seconds=60):
+        self.high_water = high_water
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last_activity = time.monotonic()
+        self._dirty = False
+
+        self.cleanups = {"high_water": 0, "idle": 0}
+        self.cleanup_seconds = 0.0
+        self.skipped = 0
+        self.peak_reserved = 0
+
+        if idle_seconds > 0:
+            threading.Thread(target=self._idle_loop, name="memory-manager", daemon=True).start()
+
+    @contextmanager
+    def active(self):
+        """
+        Mark a block of pipeline work; records its peak memory and checks the
+        high-water mark when it ends.
+        """
+        with self._lock:
+            self._active += 1
+        reset_peak_memory()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._last_activity = time.monotonic()
+                self._dirty = True
+            peak = peak_memory()
+            if peak is not None:
+                observe("kontext_batch_peak_memory_bytes", peak, buckets=BYTES_BUCKETS)
+            self.after_request()
+
+    def after_request(self):
+        usage = device_memory()
+        if usage is not None:
+            self.peak_reserved = max(self.peak_reserved, usage["reserved"])
+            if usage["reserved"] > self.high_water * usage["total"]:
+                self.cleanup("high_water")
+                return
+        self.skipped += 1
+
+    def cleanup(self, reason):
+        start = time.perf_counter()
+        with span("memory_cleanup", reason=reason):
+            gc.collect()
+            devicetorch.empty_cache(torch)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._dirty = False
+            self.cleanups[reason] += 1
+            self.cleanup_seconds += elapsed
+        print(f"Memory cleanup ({reason}) took {elapsed * 1000:.0f}ms")
+
+    def _idle_loop(self):
+        poll = min(self.idle_seconds, 5)
+        while True:
+            time.sleep(poll)
+            with self._lock:
+                idle = self._active == 0 and self._dirty
+                idle = idle and time.monotonic() - self._last_activity >= self.idle_seconds
+            if idle:
+                self.cleanup("idle")
+
+    def stats(self):
+        usage = device_memory() or {}
+        return {
+            "cleanups": dict(self.cleanups),
+            "cleanup_seconds": self.cleanup_seconds,
+            "skipped_cleanups": self.skipped,
+            "allocated_bytes": usage.get("allocated"),
+            "reserved_bytes": usage.get("reserved"),
+            "peak_reserved_bytes": self.peak_reserved,
+            "high_water": self.high_water,
+        }
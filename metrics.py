@@ -0,0 +1,197 @@
+"""
+Stage timing, memory and queue metrics.
+
+Code under measurement wraps each stage in ``span("stage")``: the duration is
+added to the ``kontext_stage_seconds`` histogram and, when a trace file is
+configured, written as a Chrome trace event (open it in Perfetto or
+chrome://tracing to see where a slow request spent its time). Other values are
+recorded with ``observe`` or exposed as gauges read at scrape time.
+``render_prometheus`` produces the text exposition format served on ``/metrics``.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = tuple(2**exponent * 1024**2 for exponent in range(9, 17))  # 512MB .. 64GB
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, plus a window of recent samples for
+    quick percentiles.
+    """
+
+    def __init__(self, buckets, window=1024):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Metrics:
+    """Registry of histograms (labelled by stage) and gauges."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._gauges = {}
+        self._trace = None
+        self._trace_lock = threading.Lock()
+        self._trace_start = time.perf_counter()
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        """Add ``value`` to the histogram ``name`` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, fn, help="", kind="gauge"):
+        """
+        Register ``fn`` to be called for the value of ``name`` at scrape time.
+
+        ``kind="counter"`` exposes a monotonically increasing value kept elsewhere
+        (e.g. a cache's hit count) as a Prometheus counter.
+        """
+        self._gauges[name] = (fn, help, kind)
+
+    @contextmanager
+    def span(self, stage, **args):
+        """Time a block as ``stage``, recording it to the histogram and the trace."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.observe("kontext_stage_seconds", end - start, stage=stage)
+            if self._trace is not None:
+                self._trace_event(stage, start, end, args)
+
+    def record_span(self, stage, start, end, **args):
+        """Record a span whose start and end were measured elsewhere (``perf_counter`` times)."""
+        self.observe("kontext_stage_seconds", end - start, stage=stage)
+        if self._trace is not None:
+            self._trace_event(stage, start, end, args)
+
+    def enable_trace(self, path):
+        """Append Chrome trace events to ``path`` (a JSON array left open, as the format allows)."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._trace = open(path, "w", encoding="utf-8")
+        self._trace.write("[\n")
+        self._trace.flush()
+        print(f"Writing trace events to {path}")
+
+    def _trace_event(self, name, start, end, args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._trace_start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.current_thread().name,
+            "args": args,
+        }
+        with self._trace_lock:
+            self._trace.write(json.dumps(event) + ",\n")
+            self._trace.flush()
+
+    def summary(self):
+        """Count, mean, p50 and p99 of every histogram (over its recent window)."""
+        with self._lock:
+            items = list(self._histograms.items())
+        summary = {}
+        for (name, labels), histogram in items:
+            label = ",".join(f"{key}={value}" for key, value in labels)
+            summary[f"{name}{{{label}}}" if label else name] = {
+                "count": histogram.count,
+                "mean": histogram.sum / histogram.count if histogram.count else None,
+                "p50": histogram.percentile(0.5),
+                "p99": histogram.percentile(0.99),
+            }
+        return summary
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            items = sorted(self._histograms.items())
+        declared = set()
+        for (name, labels), histogram in items:
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+        for name, (fn, help, kind) in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+# Process-wide registry, shared by the UI, the API and the batch CLI.
+metrics = Metrics()
+span = metrics.span
+observe = metrics.observe
+
+
+def create_metrics_app():
+    """A FastAPI app serving ``/metrics`` (Prometheus) and ``/metrics.json`` (percentiles)."""
+    from fastapi import FastAPI
+
+    app = FastAPI(title="FLUX.1 Kontext metrics")
+    add_metrics_routes(app)
+    return app
+
+
+def add_metrics_routes(app):
+    from fastapi.responses import PlainTextResponse
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def prometheus_metrics():
+        return metrics.render_prometheus()
+
+    @app.get("/metrics.json")
+    def metrics_summary():
+        return metrics.summary()
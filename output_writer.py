@@ -0,0 +1,148 @@
+"""
+Background writer for downloadable result files.
+
+Each result is written to a content-addressed path (so concurrent users never
+overwrite each other's downloads) by a small thread pool, letting the request
+return the image to the UI before the file encode finishes. Old files are
+garbage-collected by age and by a total disk budget.
+"""
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import span
+
+FORMATS = {
+    "jpeg": ("JPEG", ".jpg", {"progressive": True}),
+    "png": ("PNG", ".png", {"compress_level": 3}),
+    "webp": ("WEBP", ".webp", {"method": 4}),
+}
+
+
+class OutputWriter:
+    """
+    Encodes result images to disk on worker threads.
+
+    Args:
+        directory (str): Where result files are written.
+        image_format (str, optional): Default format, one of ``jpeg``, ``png`` or
+            ``webp``. Defaults to ``"jpeg"``.
+        quality (int, optional): JPEG/WebP quality. Defaults to 95.
+        max_workers (int, optional): Encoder threads. Defaults to 2.
+        max_age_seconds (float, optional): Files older than this are deleted.
+        max_total_bytes (int, optional): Oldest files are deleted once the
+            directory grows past this size.
+        gc_interval_seconds (float, optional): Minimum time between GC sweeps.
+    """
+
+    def __init__(
+        self,
+        directory,
+        image_format="jpeg",
+        quality=95,
+        max_workers=2,
+        max_age_seconds=24 * 3600,
+        max_total_bytes=1024**3,
+        gc_interval_seconds=60,
+    ):
+        self.directory = directory
+        self.image_format = self._check_format(image_format)
+        self.quality = quality
+        self.max_age_seconds = max_age_seconds
+        self.max_total_bytes = max_total_bytes
+        self.gc_interval_seconds = gc_interval_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="output-writer")
+        self._gc_lock = threading.Lock()
+        self._last_gc = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _check_format(image_format):
+        image_format = image_format.lower()
+        if image_format == "jpg":
+            image_format = "jpeg"
+        if image_format not in FORMATS:
+            raise ValueError(f"Unsupported output format {image_format!r}; choose one of {sorted(FORMATS)}")
+        return image_format
+
+    def path_for(self, image, image_format=None):
+        """The content-addressed path ``image`` will be written to."""
+        image_format = self._check_format(image_format or self.image_format)
+        digest = hashlib.sha256()
+        digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:{image_format}:{self.quality}:".encode())
+        digest.update(image.tobytes())
+        return os.path.join(self.directory, digest.hexdigest()[:32] + FORMATS[image_format][1])
+
+    def submit(self, image, image_format=None, path=None):
+        """
+        Schedule ``image`` to be written and return immediately.
+
+        Args:
+            image (PIL.Image.Image): The image to save.
+            image_format (str, optional): Overrides the default format.
+            path (str, optional): Write here instead of the content-addressed path.
+
+        Returns:
+            tuple: ``(path, future)``; the future resolves to ``path`` once the
+            file is complete.
+        """
+        image_format = self._check_format(image_format or self.image_format)
+        path = path or self.path_for(image, image_format)
+        future = self._executor.submit(self._write, image, path, image_format)
+        return path, future
+
+    def _write(self, image, path, image_format):
+        try:
+            # Refresh the mtime so a re-requested file is not collected early.
+            os.utime(path)
+        except FileNotFoundError:
+            # Not written yet, or collected since: write it (again).
+            pil_format, _, options = FORMATS[image_format]
+            if pil_format == "JPEG" and image.mode != "RGB":
+                # JPEG has no alpha channel
+                image = image.convert("RGB")
+            if pil_format in ("JPEG", "WEBP"):
+                options = dict(options, quality=self.quality)
+            # Write to a temporary name first so readers never see a partial file.
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with span("save", format=image_format):
+                image.save(tmp_path, format=pil_format, **options)
+                os.replace(tmp_path, path)
+        self.maybe_collect_garbage()
+        return path
+
+    def maybe_collect_garbage(self):
+        now = time.time()
+        if now - self._last_gc < self.gc_interval_seconds or not self._gc_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_gc = now
+            self.collect_garbage(now)
+        finally:
+            self._gc_lock.release()
+
+    def collect_garbage(self, now=None):
+        """Delete expired files, then the oldest ones until under the disk budget."""
+        now = now or time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age_seconds and total <= self.max_total_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,243 @@
+"""
+Lazy, pluggable loading of the Kontext pipeline.
+
+Loading the full model takes minutes, so the pipeline is built on first use (or
+in a background warm-up thread while the UI is already serving) instead of at
+import time. Backends are registered by name, which lets a lightweight stand-in
+pipeline be swapped in with ``KONTEXT_BACKEND=stub``, or a prepared snapshot be
+memory-mapped with ``KONTEXT_BACKEND=snapshot``.
+"""
+import threading
+import time
+
+import devicetorch
+import torch
+
+import settings
+
+PROCESS_START = time.perf_counter()
+
+_BACKENDS = {}
+
+
+# none:          every component resident on the accelerator (fastest, most memory)
+# model:         whole components moved on and off the accelerator as they run
+# sequential:    individual layers streamed to the accelerator (least memory, slowest)
+# text-encoders: transformer and VAE resident, only the text encoders offloaded
+OFFLOAD_MODES = ("none", "model", "sequential", "text-encoders")
+
+TEXT_ENCODER_MODES = ("device", "cpu", "cpu-int8")
+
+
+def register_backend(name):
+    """
+    Register a pipeline factory under ``name``.
+
+    The decorated callable takes an ``offload_mode`` keyword (one of
+    ``OFFLOAD_MODES``) and returns a ready-to-use pipeline.
+    """
+    def decorator(factory):
+        _BACKENDS[name] = factory
+        return factory
+    return decorator
+
+
+def available_backends():
+    return sorted(_BACKENDS)
+
+
+def _offload_text_encoders(pipe, device):
+    from accelerate import cpu_offload_with_hook
+
+    pipe.transformer.to(device)
+    pipe.vae.to(device)
+    hook = None
+    for name in ("text_encoder", "text_encoder_2"):
+        module = getattr(pipe, name, None)
+        if isinstance(module, torch.nn.Module):
+            _, hook = cpu_offload_with_hook(module, device, prev_module_hook=hook)
+    if hook is not None:
+        # Send the last text encoder back to CPU as soon as denoising starts.
+        pipe.transformer.register_forward_pre_hook(lambda module, args: hook.offload())
+
+
+def _place_text_encoders(pipe):
+    """Keep the text encoders on CPU if ``KONTEXT_TEXT_ENCODERS`` asks for it."""
+    if settings.TEXT_ENCODERS not in TEXT_ENCODER_MODES:
+        raise ValueError(f"Unknown text encoder mode {settings.TEXT_ENCODERS!r}; choose one of {TEXT_ENCODER_MODES}")
+    if settings.TEXT_ENCODERS != "device":
+        from text_encoders import use_cpu_text_encoders
+
+        use_cpu_text_encoders(pipe, quantize=settings.TEXT_ENCODERS == "cpu-int8")
+
+
+def apply_offload(pipe, offload_mode):
+    """
+    Place the pipeline's components according to ``offload_mode``.
+
+    Without an accelerator everything already lives on CPU and every mode
+    behaves like ``none``.
+    """
+    if offload_mode not in OFFLOAD_MODES:
+        raise ValueError(f"Unknown offload mode {offload_mode!r}; choose one of {OFFLOAD_MODES}")
+    device = devicetorch.get(torch)
+    if device == "cpu":
+        if offload_mode != "none":
+            print(f"Offload mode '{offload_mode}' has no effect without an accelerator")
+        return pipe
+
+    if offload_mode == "none":
+        pipe.to(device)
+    elif offload_mode == "model":
+        pipe.enable_model_cpu_offload()
+    elif offload_mode == "sequential":
+        pipe.enable_sequential_cpu_offload()
+    else:
+        _offload_text_encoders(pipe, device)
+    return pipe
+
+
+def build_dfloat11_pipeline(sequential=False):
+    """
+    Assemble FLUX.1 Kontext [dev] with the DFloat11-compressed transformer, on CPU.
+
+    Args:
+        sequential (bool, optional): Arrange the transformer for sequential
+            offload: DFloat11 keeps its compressed blocks on CPU and streams
+            them to the accelerator itself. Defaults to False.
+    """
+    # Imported lazily: dfloat11 needs CUDA at import time.
+    from diffusers import FluxKontextPipeline
+    from dfloat11 import DFloat11Model
+
+    pipe = FluxKontextPipeline.from_pretrained(settings.MODEL_ID, torch_dtype=torch.bfloat16)
+    DFloat11Model.from_pretrained(
+        settings.DFLOAT11_MODEL_ID,
+        device=devicetorch.get(torch) if sequential else "cpu",
+        cpu_offload=sequential,
+        bfloat16_model=pipe.transformer,
+    )
+    if sequential:
+        # DFloat11 streams its compressed blocks to the device itself; accelerate's
+        # per-layer hooks would run after its decode hook and break it.
+        pipe._exclude_from_cpu_offload = ["transformer"]
+    return pipe
+
+
+@register_backend("dfloat11")
+def load_dfloat11_pipeline(offload_mode="model"):
+    """Full FLUX.1 Kontext [dev] with the DFloat11-compressed transformer."""
+    pipe = build_dfloat11_pipeline(sequential=offload_mode == "sequential")
+    _place_text_encoders(pipe)
+    return apply_offload(pipe, offload_mode)
+
+
+@register_backend("stub")
+def load_stub_pipeline(offload_mode="none"):
+    """Tiny deterministic pipeline for tests and CPU-only machines."""
+    from stub_pipeline import build_stub_pipeline
+
+    pipe = build_stub_pipeline()
+    _place_text_encoders(pipe)
+    return apply_offload(pipe, offload_mode)
+
+
+@register_backend("snapshot")
+def load_snapshot_pipeline(offload_mode="model"):
+    """A pipeline written by ``python snapshot.py prepare``, memory-mapped from ``KONTEXT_SNAPSHOT_DIR``."""
+    from snapshot import load_snapshot
+
+    device = devicetorch.get(torch)
+    stream = offload_mode == "sequential" and device != "cpu"
+    pipe = load_snapshot(settings.SNAPSHOT_DIR, stream_device=device if stream else None)
+    _place_text_encoders(pipe)
+    return apply_offload(pipe, offload_mode)
+
+
+class PipelineLoader:
+    """
+    Thread-safe, load-once holder for the inference pipeline.
+
+    Args:
+        backend (str or callable): Name of a registered backend, or a factory
+            callable returning a pipeline (useful for injecting fakes in tests).
+        offload_mode (str, optional): One of ``OFFLOAD_MODES``, passed to the factory.
+        prepare (callable, optional): Called with the loaded pipeline before it
+            is handed out, e.g. ``CompiledExecution.prepare``; returns the pipeline.
+    """
+
+    def __init__(self, backend=settings.PIPELINE_BACKEND, offload_mode=settings.OFFLOAD_MODE, prepare=None):
+        if offload_mode not in OFFLOAD_MODES:
+            raise ValueError(f"Unknown offload mode {offload_mode!r}; choose one of {OFFLOAD_MODES}")
+        self.offload_mode = offload_mode
+        self.prepare = prepare
+        if callable(backend):
+            self.backend_name = getattr(backend, "__name__", "custom")
+            self._factory = backend
+        elif backend in _BACKENDS:
+            self.backend_name = backend
+            self._factory = _BACKENDS[backend]
+        else:
+            raise ValueError(f"Unknown pipeline backend {backend!r}; choose one of {available_backends()}")
+
+        self._pipe = None
+        self._lock = threading.Lock()
+        self._warmup_thread = None
+        self.load_seconds = None
+        self.ready_since_start = None
+        self.first_request_since_start = None
+
+    @property
+    def is_loaded(self):
+        return self._pipe is not None
+
+    def get(self):
+        """Return the pipeline, loading it on the calling thread if needed."""
+        if self._pipe is not None:
+            return self._pipe
+        with self._lock:
+            if self._pipe is None:
+                self._load()
+        return self._pipe
+
+    def _load(self):
+        print(f"Loading pipeline backend '{self.backend_name}' (offload: {self.offload_mode})...")
+        start = time.perf_counter()
+        pipe = self._factory(offload_mode=self.offload_mode)
+        if self.prepare is not None:
+            pipe = self.prepare(pipe)
+        self.load_seconds = time.perf_counter() - start
+        self.ready_since_start = time.perf_counter() - PROCESS_START
+        self._pipe = pipe
+        print(f"Pipeline loaded in {self.load_seconds:.2f}s ({self.ready_since_start:.2f}s after process start)")
+
+    def warmup_async(self):
+        """Start loading the pipeline in a daemon thread and return immediately."""
+        if self._pipe is not None or self._warmup_thread is not None:
+            return self._warmup_thread
+
+        def warmup():
+            try:
+                self.get()
+            except Exception as exc:
+                print(f"Pipeline warm-up failed: {exc!r}")
+
+        self._warmup_thread = threading.Thread(target=warmup, name="pipeline-warmup", daemon=True)
+        self._warmup_thread.start()
+        return self._warmup_thread
+
+    def record_request(self):
+        """Record the time-to-first-request once, on the first completed request."""
+        if self.first_request_since_start is None:
+            self.first_request_since_start = time.perf_counter() - PROCESS_START
+            print(f"First request served {self.first_request_since_start:.2f}s after process start")
+
+    def stats(self):
+        return {
+            "backend": self.backend_name,
+            "offload_mode": self.offload_mode,
+            "loaded": self.is_loaded,
+            "load_seconds": self.load_seconds,
+            "ready_since_start": self.ready_since_start,
+            "first_request_since_start": self.first_request_since_start,
+        }
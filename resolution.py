@@ -0,0 +1,109 @@
+"""
+Resolution policy: snap inputs to a fixed set of aspect-ratio buckets.
+
+Arbitrary upload sizes (a 4000x3000 phone photo, say) would otherwise run at
+whatever size the pipeline derives from them. Snapping every request to one of
+a handful of buckets at a configurable pixel budget bounds memory and latency,
+and keeps shapes repeatable so requests can be batched together.
+"""
+import math
+import threading
+from collections import Counter
+from dataclasses import dataclass
+
+from PIL import Image
+from diffusers.pipelines.flux.pipeline_flux_kontext import PREFERRED_KONTEXT_RESOLUTIONS
+
+from metrics import span
+
+# Kontext packs 2x2 latent patches on top of the 8x VAE downsampling.
+MULTIPLE_OF = 16
+
+
+@dataclass(frozen=True)
+class Bucket:
+    width: int
+    height: int
+
+    @property
+    def aspect_ratio(self):
+        return self.width / self.height
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def __str__(self):
+        return f"{self.width}x{self.height}"
+
+
+class ResolutionPolicy:
+    """
+    Maps any requested size to the closest bucket in aspect ratio.
+
+    Buckets are Kontext's preferred training resolutions (about 1MP) scaled to
+    ``max_pixels``, so the default budget reproduces them exactly.
+
+    Args:
+        max_pixels (int, optional): Target pixel count per bucket. Defaults to 1024**2.
+        multiple_of (int, optional): Bucket sides are rounded to this. Defaults to 16.
+    """
+
+    def __init__(self, max_pixels=1024**2, multiple_of=MULTIPLE_OF):
+        self.max_pixels = max_pixels
+        self.multiple_of = multiple_of
+        scale = math.sqrt(max_pixels / 1024**2)
+        buckets = {
+            Bucket(self._round(w * scale), self._round(h * scale))
+            for w, h in PREFERRED_KONTEXT_RESOLUTIONS
+        }
+        self.buckets = sorted(buckets, key=lambda bucket: bucket.aspect_ratio)
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def _round(self, value):
+        return max(self.multiple_of, round(value / self.multiple_of) * self.multiple_of)
+
+    def choose(self, width, height):
+        """The bucket whose aspect ratio is closest (in log space) to ``width``/``height``."""
+        target = math.log(width / height)
+        return min(self.buckets, key=lambda bucket: abs(math.log(bucket.aspect_ratio) - target))
+
+    def apply(self, image):
+        """
+        Resize ``image`` to its bucket and record the choice.
+
+        Args:
+            image (PIL.Image.Image): The input image.
+
+        Returns:
+            tuple: ``(resized_image, bucket)``.
+        """
+        with span("preprocess"):
+            bucket = self.choose(*image.size)
+            self.record(bucket)
+            if image.size != bucket.size:
+                image = image.resize(bucket.size, Image.LANCZOS)
+        return image, bucket
+
+    def record(self, bucket):
+        with self._lock:
+            self.counts[str(bucket)] += 1
+
+    @staticmethod
+    def restore(image, size):
+        """Resize an output back to the original input ``size``."""
+        if image.size == tuple(size):
+            return image
+        return image.resize(tuple(size), Image.LANCZOS)
+
+    def stats(self):
+        return {
+            "max_pixels": self.max_pixels,
+            "buckets": [str(bucket) for bucket in self.buckets],
+            "requests_per_bucket": dict(self.counts),
+        }
@@ -0,0 +1,244 @@
+"""
+Persistent cache of finished results.
+
+Generation is deterministic given the input image, prompt, seed, guidance scale,
+step count and output size, so an exact repeat (an example row, a retry, a
+double-click) can be answered from disk instead of recomputed. Results are
+stored as lossless PNGs in one directory, bounded by a byte budget with
+least-recently-used eviction (file mtimes record use, so the order survives
+restarts).
+
+Identical requests that arrive while the first is still running join its
+pipeline run instead of starting another one.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+from caches import normalize_prompt
+from cancellation import CancelGroup, CancelToken
+from inference import GenerationResult
+from latents import image_hash
+
+
+class _InFlight:
+    __slots__ = ("future", "cancel_group")
+
+    def __init__(self, future, cancel_group):
+        self.future = future
+        self.cancel_group = cancel_group
+
+
+class ResultCache:
+    """
+    On-disk result cache with in-flight deduplication.
+
+    Args:
+        directory (str): Where cached results are stored.
+        max_bytes (int): Disk budget; least recently used results are deleted
+            beyond it. ``0`` disables storage (in-flight deduplication still applies).
+        model_id (str, optional): Identifies the weights, so results from a
+            different model never match. Defaults to ``""``.
+    """
+
+    def __init__(self, directory, max_bytes, model_id=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.model_id = model_id
+        self._lock = threading.Lock()
+        self._inflight = {}
+        # Stored PNGs are written off the request path.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+        self._entries = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.evictions = 0
+
+        if max_bytes > 0:
+            os.makedirs(directory, exist_ok=True)
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.name.endswith(".png"):
+                    self._entries[entry.name[:-4]] = entry.stat().st_size
+            self.current_bytes = sum(self._entries.values())
+            self._executor.submit(self._evict)
+
+    def key(self, prompt, seed, guidance_scale, steps, width, height, input_image=None, input_latent_key=None):
+        """
+        The cache key of a request.
+
+        The input is identified by ``input_latent_key`` when the pipeline will
+        start from cached latents, otherwise by the content hash of the
+        (already bucketed) ``input_image``.
+        """
+        if input_latent_key is not None:
+            source = "latents:" + input_latent_key
+        elif input_image is not None:
+            source = "image:" + image_hash(input_image)
+        else:
+            source = None
+        fields = {
+            "model": self.model_id,
+            "input": source,
+            "prompt": normalize_prompt(prompt),
+            "seed": int(seed),
+            "guidance_scale": float(guidance_scale),
+            "steps": int(steps),
+            "size": [int(width), int(height)],
+        }
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:40]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".png")
+
+    def get(self, key):
+        """The stored result for ``key`` as a ``GenerationResult``, or None."""
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            known = key in self._entries
+        if not known:
+            return None
+        path = self._path(key)
+        try:
+            with Image.open(path) as image:
+                image.load()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.current_bytes -= self._entries.pop(key, 0)
+            return None
+        return GenerationResult(image=image, latents=None, latent_key=image_hash(image))
+
+    def put(self, key, image):
+        """Store ``image`` under ``key`` in the background."""
+        if self.max_bytes > 0:
+            self._executor.submit(self._write, key, image)
+
+    def _write(self, key, image):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format="PNG", compress_level=1)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self.current_bytes += size - self._entries.get(key, 0)
+            self._entries[key] = size
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            if self.current_bytes <= self.max_bytes:
+                return
+            keys = list(self._entries)
+        by_age = []
+        for key in keys:
+            try:
+                by_age.append((os.stat(self._path(key)).st_mtime, key))
+            except FileNotFoundError:
+                by_age.append((0, key))
+        for _, key in sorted(by_age):
+            with self._lock:
+                if self.current_bytes <= self.max_bytes:
+                    return
+                self.current_bytes -= self._entries.pop(key, 0)
+                self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def submit(self, key, request, submit):
+        """
+        Resolve ``request`` from the cache, from an identical in-flight run, or
+        by calling ``submit(request)``.
+
+        ``request.cancel_token`` is replaced by a ``CancelGroup`` shared by every
+        request waiting on the same run, so the run is only cancelled once all
+        of them are.
+
+        Returns:
+            Future: Resolves to a ``GenerationResult`` (or None if cancelled).
+        """
+        return self.submit_many([key], [request], lambda requests: [submit(requests[0])])[0]
+
+    def submit_many(self, keys, requests, submit_many):
+        """
+        Like ``submit`` for several requests, where the ones that have to run
+        are passed together to ``submit_many(requests)`` (e.g. to run as one batch).
+
+        Returns:
+            list[Future]: One future per request, in order.
+        """
+        futures = [None] * len(requests)
+        for index, key in enumerate(keys):
+            cached = self.get(key)
+            if cached is not None:
+                self.hits += 1
+                futures[index] = Future()
+                futures[index].set_result(cached)
+
+        new, duplicates, entries = {}, [], []
+        with self._lock:
+            for index, (key, request) in enumerate(zip(keys, requests)):
+                if futures[index] is not None:
+                    continue
+                # A request without a token can never be cancelled, and neither can a run it shares.
+                token = request.cancel_token or CancelToken()
+                entry = self._inflight.get(key)
+                if entry is not None and not entry.cancel_group.cancelled:
+                    entry.cancel_group.add(token)
+                    request.cancel_token = entry.cancel_group
+                    self.deduplicated += 1
+                    futures[index] = entry.future
+                elif key in new:
+                    group = requests[new[key]].cancel_token
+                    group.add(token)
+                    request.cancel_token = group
+                    self.deduplicated += 1
+                    duplicates.append((index, new[key]))
+                else:
+                    self.misses += 1
+                    request.cancel_token = CancelGroup([token])
+                    new[key] = index
+            if new:
+                submitted = submit_many([requests[index] for index in new.values()])
+                for (key, index), future in zip(new.items(), submitted):
+                    entry = self._inflight[key] = _InFlight(future, requests[index].cancel_token)
+                    entries.append((key, entry))
+                    futures[index] = future
+        for index, original in duplicates:
+            futures[index] = futures[original]
+        for key, entry in entries:
+            entry.future.add_done_callback(lambda future, key=key, entry=entry: self._finished(key, entry))
+        return futures
+
+    def _finished(self, key, entry):
+        with self._lock:
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+        if entry.future.cancelled() or entry.future.exception() is not None:
+            return
+        result = entry.future.result()
+        if result is not None:
+            self.put(key, result.image)
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+            in_flight = len(self._inflight)
+        return {
+            "entries": entries,
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "evictions": self.evictions,
+            "in_flight": in_flight,
+        }
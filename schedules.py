@@ -0,0 +1,148 @@
+"""
+Step presets, cached timestep schedules and the optional few-step LoRA.
+
+FLUX shifts its sigma schedule by an amount that depends on the number of image
+tokens, so every pipeline call rebuilds it from the step count and resolution.
+``ScheduleCache`` computes each (steps, width, height) schedule once and runs
+the pipeline with a non-shifting copy of its scheduler, passing the cached
+sigmas straight through. This gives the same timesteps as the default path
+without recomputing them per call.
+
+``FastLoRA`` loads a step-distilled LoRA once and enables it only for batches
+with few steps, which is what makes 4-8 step presets usable.
+"""
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from diffusers.pipelines.flux.pipeline_flux_kontext import calculate_shift
+
+# Preset name -> denoising steps, shown in the UI and compared by `benchmark.py presets`.
+PRESETS = {
+    "Quality": 28,
+    "Balanced": 16,
+    "Fast": 8,
+    "Turbo": 4,
+}
+
+
+class ScheduleCache:
+    """Shifted sigma schedules per ``(steps, width, height)``."""
+
+    def __init__(self):
+        self._schedules = {}
+        self._passthrough = None
+        self._original = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def sigmas(self, pipe, steps, width, height):
+        """
+        The sigmas the pipeline would use for this step count and output size.
+
+        Args:
+            pipe: A Kontext pipeline.
+            steps (int): Denoising steps.
+            width (int): Output width.
+            height (int): Output height.
+
+        Returns:
+            list[float]: ``steps`` sigmas, already shifted for the resolution.
+        """
+        key = (steps, width, height)
+        with self._lock:
+            schedule = self._schedules.get(key)
+            if schedule is not None:
+                self.hits += 1
+                return schedule
+            self.misses += 1
+
+        # Always derive from the pipeline's own scheduler, even while ours is swapped in.
+        base = self._original if pipe.scheduler is self._passthrough else pipe.scheduler
+        scheduler = base.__class__.from_config(base.config)
+        multiple_of = pipe.vae_scale_factor * 2
+        image_seq_len = (height // multiple_of) * (width // multiple_of)
+        mu = calculate_shift(
+            image_seq_len,
+            scheduler.config.get("base_image_seq_len", 256),
+            scheduler.config.get("max_image_seq_len", 4096),
+            scheduler.config.get("base_shift", 0.5),
+            scheduler.config.get("max_shift", 1.15),
+        )
+        scheduler.set_timesteps(sigmas=np.linspace(1.0, 1 / steps, steps), mu=mu)
+        # The scheduler appends a terminal zero; the pipeline expects one sigma per step.
+        schedule = scheduler.sigmas[:-1].tolist()
+        with self._lock:
+            self._schedules[key] = schedule
+        return schedule
+
+    @contextmanager
+    def applied(self, pipe):
+        """Swap in a scheduler that uses given sigmas as they are, for the duration of a call."""
+        if self._passthrough is None:
+            self._passthrough = pipe.scheduler.__class__.from_config(
+                pipe.scheduler.config,
+                use_dynamic_shifting=False,
+                shift=1.0,
+                shift_terminal=None,
+            )
+        original = self._original = pipe.scheduler
+        pipe.scheduler = self._passthrough
+        try:
+            yield
+        finally:
+            pipe.scheduler = original
+
+    def stats(self):
+        return {"schedules": len(self._schedules), "hits": self.hits, "misses": self.misses}
+
+
+class FastLoRA:
+    """
+    A step-distilled LoRA used for low-step batches only.
+
+    Args:
+        source (str): Hugging Face repo id or local path of the LoRA weights.
+            Empty disables it.
+        scale (float, optional): Adapter strength. Defaults to 1.0.
+        max_steps (int, optional): Batches with at most this many steps use the
+            LoRA. Defaults to 8.
+    """
+
+    ADAPTER = "fast"
+
+    def __init__(self, source, scale=1.0, max_steps=8):
+        self.source = source
+        self.scale = scale
+        self.max_steps = max_steps
+        self._loaded = False
+        self._failed = False
+
+    def wanted(self, steps):
+        return bool(self.source) and not self._failed and steps <= self.max_steps
+
+    def _load(self, pipe):
+        print(f"Loading fast-mode LoRA from {self.source}...")
+        try:
+            pipe.load_lora_weights(self.source, adapter_name=self.ADAPTER)
+        except Exception as exc:
+            # e.g. compressed backends whose linear layers have no regular weights to adapt
+            self._failed = True
+            print(f"Fast-mode LoRA disabled: could not load it ({exc})")
+            return False
+        self._loaded = True
+        return True
+
+    @contextmanager
+    def applied(self, pipe, steps):
+        """Enable the LoRA around a pipeline call if ``steps`` is low enough."""
+        if not self.wanted(steps) or (not self._loaded and not self._load(pipe)):
+            yield
+            return
+        pipe.enable_lora()
+        pipe.set_adapters([self.ADAPTER], [self.scale])
+        try:
+            yield
+        finally:
+            pipe.disable_lora()
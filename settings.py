@@ -0,0 +1,135 @@
+"""
+Runtime settings for the Kontext app.
+
+Every value can be overridden with a ``KONTEXT_*`` environment variable so the
+same code runs on a workstation, a CPU-only CI box or a multi-GPU server
+without edits.
+"""
+import os
+import tempfile
+
+
+def _env_str(name, default):
+    return os.environ.get(name, default)
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Pipeline loading
+PIPELINE_BACKEND = _env_str("KONTEXT_BACKEND", "dfloat11")
+MODEL_ID = _env_str("KONTEXT_MODEL_ID", "fuliucansheng/FLUX.1-Kontext-dev-diffusers")
+DFLOAT11_MODEL_ID = _env_str("KONTEXT_DFLOAT11_MODEL_ID", "DFloat11/FLUX.1-Kontext-dev-DF11")
+WARMUP_ON_START = _env_bool("KONTEXT_WARMUP", True)
+# One of pipeline_loader.OFFLOAD_MODES: none, model, sequential, text-encoders
+OFFLOAD_MODE = _env_str("KONTEXT_OFFLOAD", "model")
+# Written by ``python snapshot.py prepare`` and loaded by the "snapshot" backend
+SNAPSHOT_DIR = _env_str("KONTEXT_SNAPSHOT_DIR", "snapshot")
+
+# Resolution bucketing
+MAX_PIXELS = _env_int("KONTEXT_MAX_PIXELS", 1024 * 1024)
+RESTORE_INPUT_SIZE = _env_bool("KONTEXT_RESTORE_INPUT_SIZE", False)
+
+# Caches
+PROMPT_CACHE_MB = _env_int("KONTEXT_PROMPT_CACHE_MB", 256)
+IMAGE_LATENT_CACHE_MB = _env_int("KONTEXT_IMAGE_LATENT_CACHE_MB", 256)
+
+# Text encoders: "device" (placed by the offload mode), "cpu" (kept on CPU in bf16
+# and run on a thread of their own) or "cpu-int8" (the same with int8 weights)
+TEXT_ENCODERS = _env_str("KONTEXT_TEXT_ENCODERS", "device")
+
+# Region edits: context kept around the edited area (fraction of its size) and
+# width in pixels of the blend back into the original image
+REGION_MARGIN = _env_float("KONTEXT_REGION_MARGIN", 0.25)
+REGION_FEATHER = _env_int("KONTEXT_REGION_FEATHER", 32)
+
+# Fast mode: an optional step-distilled LoRA (Hugging Face repo or local path)
+# used only for requests with at most FAST_LORA_MAX_STEPS steps
+FAST_LORA = _env_str("KONTEXT_FAST_LORA", "")
+FAST_LORA_SCALE = _env_float("KONTEXT_FAST_LORA_SCALE", 1.0)
+FAST_LORA_MAX_STEPS = _env_int("KONTEXT_FAST_LORA_MAX_STEPS", 8)
+
+# Step cache: skip the transformer on steps whose first-block residual changed
+# by less than this fraction since the last computed step (0 disables)
+STEP_CACHE_THRESHOLD = _env_float("KONTEXT_STEP_CACHE_THRESHOLD", 0.0)
+
+# Device memory for keeping decoded DFloat11 transformer blocks resident (0 disables)
+WEIGHT_RESIDENCY_MB = _env_int("KONTEXT_WEIGHT_RESIDENCY_MB", 0)
+
+# Tiled VAE: encode/decode images above this many pixels in overlapping tiles of
+# VAE_TILE_SIZE pixels, bounding peak memory (0 disables)
+VAE_TILING_PIXELS = _env_int("KONTEXT_VAE_TILING_PIXELS", 1024 * 1024)
+VAE_TILE_SIZE = _env_int("KONTEXT_VAE_TILE_SIZE", 512)
+
+# Compiled execution: torch.compile the transformer and VAE decoder, warmed up at
+# load time for these buckets ("WxH,WxH" or "all"); other sizes run eager
+COMPILE = _env_bool("KONTEXT_COMPILE", False)
+COMPILE_BUCKETS = _env_str("KONTEXT_COMPILE_BUCKETS", "1024x1024")
+COMPILE_CACHE_DIR = _env_str(
+    "KONTEXT_COMPILE_CACHE_DIR",
+    os.path.join(os.environ.get("GRADIO_TEMP_DIR", tempfile.gettempdir()), "kontext-compile-cache"),
+)
+
+# Persistent result cache (0 disables storage; identical in-flight requests are always shared)
+RESULT_CACHE_MB = _env_int("KONTEXT_RESULT_CACHE_MB", 1024)
+RESULT_CACHE_DIR = _env_str(
+    "KONTEXT_RESULT_CACHE_DIR",
+    os.path.join(os.environ.get("GRADIO_TEMP_DIR", tempfile.gettempdir()), "kontext-result-cache"),
+)
+
+# Render the bundled examples into the result cache after the warm-up load
+PRECOMPUTE_EXAMPLES = _env_bool("KONTEXT_PRECOMPUTE_EXAMPLES", True)
+
+# Request batching (a max batch size of 1 disables batching)
+BATCH_MAX_SIZE = _env_int("KONTEXT_BATCH_MAX_SIZE", 1)
+BATCH_MAX_WAIT_MS = _env_int("KONTEXT_BATCH_MAX_WAIT_MS", 50)
+
+# Worker processes, one pipeline each: "cuda:0,cuda:1", "cpu,cpu" or "auto"
+# (one per CUDA device). Empty runs the pipeline in the front-end process.
+WORKERS = _env_str("KONTEXT_WORKERS", "")
+
+# Live previews: show an approximate image every N denoising steps (0 disables)
+PREVIEW_EVERY = _env_int("KONTEXT_PREVIEW_EVERY", 4)
+
+# HTTP/JSON job API on its own port (0 disables)
+API_PORT = _env_int("KONTEXT_API_PORT", 0)
+API_MAX_QUEUE = _env_int("KONTEXT_API_MAX_QUEUE", 16)
+API_MAX_WAIT_SECONDS = _env_float("KONTEXT_API_MAX_WAIT_SECONDS", 0)
+API_MAX_JOBS = _env_int("KONTEXT_API_MAX_JOBS", 256)
+
+# Instrumentation: Prometheus /metrics on its own port (0 disables; also served
+# by the API when it is enabled) and an optional Chrome trace file of all spans
+METRICS_PORT = _env_int("KONTEXT_METRICS_PORT", 0)
+TRACE_FILE = _env_str("KONTEXT_TRACE_FILE", "")
+
+# Memory management
+MEMORY_HIGH_WATER = _env_float("KONTEXT_MEMORY_HIGH_WATER", 0.85)
+MEMORY_IDLE_SECONDS = _env_int("KONTEXT_MEMORY_IDLE_SECONDS", 60)
+
+# Result files
+OUTPUT_DIR = _env_str(
+    "KONTEXT_OUTPUT_DIR",
+    os.path.join(os.environ.get("GRADIO_TEMP_DIR", tempfile.gettempdir()), "kontext-outputs"),
+)
+OUTPUT_FORMAT = _env_str("KONTEXT_OUTPUT_FORMAT", "jpeg")
+OUTPUT_QUALITY = _env_int("KONTEXT_OUTPUT_QUALITY", 95)
+OUTPUT_MAX_AGE_HOURS = _env_int("KONTEXT_OUTPUT_MAX_AGE_HOURS", 24)
+OUTPUT_MAX_DISK_MB = _env_int("KONTEXT_OUTPUT_MAX_DISK_MB", 1024)
+
+# Server
+SERVER_NAME = _env_str("KONTEXT_SERVER_NAME", "127.0.0.1")
+SERVER_PORT = _env_int("KONTEXT_SERVER_PORT", 7860)
@@ -0,0 +1,347 @@
+"""
+Fast-restart snapshots of the assembled pipeline.
+
+    python snapshot.py prepare [--backend dfloat11] [--output snapshot/]
+
+Loading the ``dfloat11`` backend parses the diffusers checkpoint, builds the
+bf16 transformer and then has DFloat11 replace its weights with compressed
+buffers, on every start. ``prepare`` does that once and writes the result: every
+tensor of every component (including DFloat11's compressed weights) goes into a
+single safetensors file, next to a ``snapshot.json`` manifest with the
+component classes and configs and DFloat11's per-module layout, plus the
+tokenizers and scheduler.
+
+``load_snapshot`` builds the modules without allocating weights and points
+their tensors straight into a copy-on-write memory map of that file. Nothing is
+read or converted up front, so loading takes seconds, and worker processes on
+one host share the file's pages in the page cache instead of each holding a
+private copy. Writes to a tensor (fusing a LoRA, for instance) copy only the
+touched pages and never reach the file. Load time and per-process RSS/PSS are
+measured by ``python benchmark.py startup``.
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import struct
+import sys
+import time
+
+import torch
+from accelerate import init_empty_weights
+
+MANIFEST = "snapshot.json"
+TENSORS = "pipeline.safetensors"
+FORMAT_VERSION = 1
+
+_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+_DTYPES_BY_NAME = {name: dtype for dtype, name in _DTYPES.items()}
+
+
+def write_safetensors(path, tensors):
+    """
+    Write ``tensors`` to ``path`` in the safetensors format, one tensor at a time.
+
+    Tensors are laid out widest dtype first (in their original order within a
+    dtype), so every tensor starts at an offset aligned to its element size and
+    can be viewed in place from a memory map.
+    """
+    order = sorted(tensors, key=lambda name: -tensors[name].element_size())
+    header, offset = {}, 0
+    for name in order:
+        tensor = tensors[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": _DTYPES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+    raw = json.dumps(header, separators=(",", ":")).encode()
+    # Pad the header so the data starts 8-byte aligned.
+    raw += b" " * (-len(raw) % 8)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(raw)))
+        f.write(raw)
+        for name in order:
+            tensor = tensors[name].detach().cpu().contiguous()
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy())
+    return offset
+
+
+def map_safetensors(path):
+    """
+    Memory-map a safetensors file.
+
+    Returns:
+        dict[str, torch.Tensor]: CPU tensors viewing a private (copy-on-write)
+        mapping of the file; pages are read on first access and shared with
+        every other process mapping the same file.
+    """
+    with open(path, "rb") as f:
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    header.pop("__metadata__", None)
+    data = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)[8 + length:]
+    tensors = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        tensors[name] = data[start:end].view(_DTYPES_BY_NAME[info["dtype"]]).view(info["shape"])
+    return tensors
+
+
+def _class_path(obj):
+    cls = type(obj)
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _resolve(path):
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def _unique_tensors(state_dict):
+    """Split a state dict into distinct tensors and aliases of them (tied weights)."""
+    tensors, aliases, seen = {}, {}, {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        tensors[name] = tensor
+    return tensors, aliases
+
+
+def _dfloat11_layout(transformer):
+    """What DFloat11 did to ``transformer`` beyond its tensors, per compressed module."""
+    layout = {}
+    for name, module in transformer.named_modules():
+        if "encoded_exponent" not in module._buffers:
+            continue
+        entry = {
+            "shared_mem_size": int(module.shared_mem_size),
+            "split_positions": list(getattr(module, "split_positions", []) or []),
+            "weight_injection_modules": None,
+        }
+        if hasattr(module, "weight_injection_modules"):
+            names = {id(child): child_name for child_name, child in module.named_modules()}
+            entry["weight_injection_modules"] = [names[id(target)] for target in module.weight_injection_modules]
+        layout[name] = entry
+    return layout
+
+
+def _dfloat11_config():
+    """Decode kernel launch settings of the DFloat11 weights, resolved the way DFloat11 resolves its path."""
+    import settings
+
+    path = settings.DFLOAT11_MODEL_ID
+    if not os.path.exists(path):
+        path = path.replace("/", "__")
+    with open(os.path.join(path, "config.json"), encoding="utf-8") as f:
+        config = json.load(f)["dfloat11_config"]
+    return {"threads_per_block": config["threads_per_block"], "bytes_per_thread": config["bytes_per_thread"]}
+
+
+def write_snapshot(pipe, directory, source):
+    """
+    Write an assembled, unplaced (CPU) pipeline to ``directory``.
+
+    The snapshot is written next to ``directory`` and moved into place when
+    complete, so a crash never leaves a half-written snapshot behind.
+
+    Args:
+        pipe: The pipeline, as built by a backend before any offloading.
+        directory (str): Where the snapshot goes; replaced if it exists.
+        source (str): Name of the backend that built ``pipe``, for the manifest.
+
+    Returns:
+        int: Bytes of tensor data written.
+    """
+    partial = directory.rstrip("/\\") + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    manifest = {"version": FORMAT_VERSION, "source": source, "pipeline": _class_path(pipe), "components": {}}
+    tensors = {}
+    for name, component in pipe.components.items():
+        if component is None:
+            manifest["components"][name] = None
+        elif isinstance(component, torch.nn.Module):
+            if hasattr(component, "to_json_string"):
+                config = json.loads(component.to_json_string())
+            else:
+                config = component.config.to_dict()
+            unique, aliases = _unique_tensors(component.state_dict())
+            tensors.update((f"{name}.{key}", tensor) for key, tensor in unique.items())
+            manifest["components"][name] = {
+                "kind": "module", "class": _class_path(component), "config": config, "aliases": aliases,
+            }
+            layout = _dfloat11_layout(component)
+            if layout:
+                manifest["dfloat11"] = {"component": name, "config": _dfloat11_config(), "modules": layout}
+        else:
+            component.save_pretrained(os.path.join(partial, name))
+            manifest["components"][name] = {"kind": "pretrained", "class": _class_path(component), "path": name}
+    nbytes = write_safetensors(os.path.join(partial, TENSORS), tensors)
+    with open(os.path.join(partial, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(partial, directory)
+    return nbytes
+
+
+def _empty_module(entry):
+    cls = _resolve(entry["class"])
+    with init_empty_weights():
+        if hasattr(cls, "from_config"):
+            return cls.from_config(entry["config"])
+        return cls(cls.config_class.from_dict(entry["config"]))
+
+
+def _set_tensor(module, name, tensor):
+    *path, leaf = name.split(".")
+    for part in path:
+        module = getattr(module, part)
+    if leaf in module._parameters:
+        if not isinstance(tensor, torch.nn.Parameter):
+            tensor = torch.nn.Parameter(tensor, requires_grad=False)
+        module._parameters[leaf] = tensor
+    else:
+        module.register_buffer(leaf, tensor)
+    return module._parameters.get(leaf, tensor)
+
+
+def _strip_dfloat11_weights(transformer, layout):
+    """Remove the weights DFloat11 replaces, as its loader does on the bf16 model."""
+    for name, entry in layout["modules"].items():
+        module = transformer.get_submodule(name)
+        if entry["weight_injection_modules"] is None:
+            del module.weight
+        else:
+            targets = [module.get_submodule(path) for path in entry["weight_injection_modules"]]
+            for target in targets:
+                del target.weight
+            module.weight_injection_modules = targets
+
+
+def _attach_dfloat11(transformer, layout, stream_device):
+    """Give each compressed module the decode hook and attributes DFloat11's loader sets."""
+    from dfloat11.dfloat11 import get_hook, offloaded_tensor_names
+
+    config = layout["config"]
+    for name, entry in layout["modules"].items():
+        module = transformer.get_submodule(name)
+        module.shared_mem_size = entry["shared_mem_size"]
+        if entry["split_positions"]:
+            module.split_positions = entry["split_positions"]
+        if stream_device is not None:
+            # Kept on CPU (pinned) and copied to the device by the hook on every call.
+            module.offloaded_tensors = {
+                tensor_name: module._buffers.pop(tensor_name).pin_memory() for tensor_name in offloaded_tensor_names
+            }
+        module.register_forward_pre_hook(get_hook(config["threads_per_block"], config["bytes_per_thread"]))
+    if stream_device is not None:
+        transformer.to(stream_device)
+
+
+def load_snapshot(directory, stream_device=None):
+    """
+    Load a pipeline written by ``write_snapshot``, with its tensors memory-mapped.
+
+    Args:
+        directory (str): The snapshot directory.
+        stream_device (str, optional): For sequential offload: keep DFloat11's
+            compressed weights on CPU and stream them to this device per block,
+            with the rest of the transformer resident there. Defaults to None
+            (everything stays on CPU for the offload mode to place).
+
+    Returns:
+        The pipeline, on CPU unless ``stream_device`` is given.
+    """
+    manifest_path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(
+            f"No pipeline snapshot in {directory!r}; create one with `python snapshot.py prepare --output {directory}`"
+        )
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["version"] != FORMAT_VERSION:
+        raise ValueError(f"Snapshot {directory!r} has format version {manifest['version']}, expected {FORMAT_VERSION}")
+
+    start = time.perf_counter()
+    mapped = map_safetensors(os.path.join(directory, TENSORS))
+    layout = manifest.get("dfloat11")
+    components = {}
+    for name, entry in manifest["components"].items():
+        if entry is None:
+            components[name] = None
+        elif entry["kind"] == "pretrained":
+            components[name] = _resolve(entry["class"]).from_pretrained(os.path.join(directory, entry["path"]))
+        else:
+            module = _empty_module(entry)
+            if layout and layout["component"] == name:
+                _strip_dfloat11_weights(module, layout)
+            prefix = f"{name}."
+            assigned = {}
+            for key, tensor in mapped.items():
+                if key.startswith(prefix):
+                    assigned[key[len(prefix):]] = _set_tensor(module, key[len(prefix):], tensor)
+            for key, target in entry["aliases"].items():
+                _set_tensor(module, key, assigned[target])
+            missing = [key for key, tensor in (*module.named_parameters(), *module.named_buffers()) if tensor.is_meta]
+            if missing:
+                raise RuntimeError(f"Snapshot {directory!r} has no tensors for {name}: {', '.join(missing[:5])}")
+            components[name] = module.eval()
+    if layout:
+        _attach_dfloat11(components[layout["component"]], layout, stream_device)
+
+    pipe = _resolve(manifest["pipeline"])(**components)
+    if layout and stream_device is not None:
+        # As in the dfloat11 backend: DFloat11 streams the transformer itself.
+        pipe._exclude_from_cpu_offload = [layout["component"]]
+    nbytes = sum(tensor.numel() * tensor.element_size() for tensor in mapped.values())
+    print(f"Mapped pipeline snapshot ({manifest['source']}, {nbytes / 1024**3:.2f} GB) "
+          f"in {time.perf_counter() - start:.2f}s from {directory}")
+    return pipe
+
+
+def prepare_command(args):
+    from pipeline_loader import build_dfloat11_pipeline
+    from stub_pipeline import build_stub_pipeline
+
+    builders = {"dfloat11": build_dfloat11_pipeline, "stub": build_stub_pipeline}
+    print(f"Assembling the '{args.backend}' pipeline...")
+    start = time.perf_counter()
+    pipe = builders[args.backend]()
+    print(f"Assembled in {time.perf_counter() - start:.1f}s; writing snapshot to {args.output}...")
+    start = time.perf_counter()
+    nbytes = write_snapshot(pipe, args.output, args.backend)
+    print(f"Wrote {nbytes / 1024**3:.2f} GB in {time.perf_counter() - start:.1f}s. "
+          f"Start with KONTEXT_BACKEND=snapshot KONTEXT_SNAPSHOT_DIR={args.output}")
+
+
+def main(argv=None):
+    import settings
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    prepare = subparsers.add_parser("prepare", help="assemble the pipeline once and write a snapshot of it")
+    prepare.add_argument("--backend", choices=("dfloat11", "stub"), default="dfloat11", help="pipeline to snapshot")
+    prepare.add_argument("--output", default=settings.SNAPSHOT_DIR, help="snapshot directory (replaced if it exists)")
+    prepare.set_defaults(func=prepare_command)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
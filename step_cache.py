@@ -0,0 +1,121 @@
+"""
+Step-skipping cache for the FLUX transformer (first-block residual caching).
+
+Adjacent denoising steps produce very similar activations. After the first
+transformer block has run, the change in its residual (output minus input)
+since the last fully computed step predicts how much the rest of the stack
+would change. When that relative change is below a threshold, the remaining
+double and single blocks are skipped and the residual they added last time is
+reused, so the step costs one block instead of 57.
+
+The first step of every pipeline call is always computed, and the reference
+residual is only updated on computed steps, so errors cannot creep forward
+through a long run of skips.
+"""
+from contextlib import contextmanager
+from itertools import chain
+
+import torch
+
+
+class _Run:
+    """Residuals and counts of one pipeline call."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.first_residual = None
+        self.hidden_residual = None
+        self.encoder_residual = None
+        self.computed = 0
+        self.skipped = 0
+
+    def can_reuse(self, first_residual):
+        if self.first_residual is None or self.first_residual.shape != first_residual.shape:
+            return False
+        change = (first_residual - self.first_residual).abs().mean() / self.first_residual.abs().mean()
+        return change.item() < self.threshold
+
+
+class _CachedBlocks(torch.nn.Module):
+    """Stands in for the whole block stack while a ``StepCache`` is applied."""
+
+    def __init__(self, run, transformer_blocks, single_transformer_blocks):
+        super().__init__()
+        self.run = run
+        self.transformer_blocks = transformer_blocks
+        self.single_transformer_blocks = single_transformer_blocks
+
+    def forward(self, hidden_states, encoder_hidden_states, temb, image_rotary_emb, joint_attention_kwargs=None):
+        kwargs = {"temb": temb, "image_rotary_emb": image_rotary_emb, "joint_attention_kwargs": joint_attention_kwargs}
+        original = hidden_states
+        encoder_hidden_states, hidden_states = self.transformer_blocks[0](
+            hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs
+        )
+        first_residual = hidden_states - original
+        if self.run.can_reuse(first_residual):
+            self.run.skipped += 1
+            return encoder_hidden_states + self.run.encoder_residual, hidden_states + self.run.hidden_residual
+
+        self.run.computed += 1
+        head_hidden_states, head_encoder_hidden_states = hidden_states, encoder_hidden_states
+        for block in chain(self.transformer_blocks[1:], self.single_transformer_blocks):
+            encoder_hidden_states, hidden_states = block(
+                hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, **kwargs
+            )
+        self.run.first_residual = first_residual
+        self.run.hidden_residual = hidden_states - head_hidden_states
+        self.run.encoder_residual = encoder_hidden_states - head_encoder_hidden_states
+        return encoder_hidden_states, hidden_states
+
+
+class StepCache:
+    """
+    Skips most of the transformer on steps that barely change its first block.
+
+    Args:
+        threshold (float): Largest relative change of the first block's residual
+            (mean absolute difference over mean absolute value) at which the
+            cached residual is reused. ``0`` disables the cache; around 0.08
+            skips roughly every other step with little visible change, higher
+            values skip more.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.computed = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    @contextmanager
+    def applied(self, pipe):
+        """
+        Route the transformer's blocks through the cache for one pipeline call.
+
+        Yields:
+            The run's counters (``computed`` and ``skipped`` transformer passes),
+            or None when the cache is disabled.
+        """
+        if not self.enabled:
+            yield None
+            return
+        transformer = pipe.transformer
+        run = _Run(self.threshold)
+        transformer_blocks = transformer.transformer_blocks
+        single_transformer_blocks = transformer.single_transformer_blocks
+        transformer.transformer_blocks = torch.nn.ModuleList(
+            [_CachedBlocks(run, transformer_blocks, single_transformer_blocks)]
+        )
+        transformer.single_transformer_blocks = torch.nn.ModuleList()
+        try:
+            yield run
+        finally:
+            transformer.transformer_blocks = transformer_blocks
+            transformer.single_transformer_blocks = single_transformer_blocks
+            self.computed += run.computed
+            self.skipped += run.skipped
+
+    def stats(self):
+        return {"threshold": self.threshold, "computed": self.computed, "skipped": self.skipped}
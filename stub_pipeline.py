@@ -0,0 +1,113 @@
+"""
+Deterministic stand-in for the FLUX.1 Kontext pipeline.
+
+The stub is a real ``FluxKontextPipeline`` built from tiny, randomly initialised
+components (seeded, so every run produces the same pixels). It exercises the
+exact same call path as the full model -- scheduler, packing, VAE, step
+callbacks -- but loads in milliseconds and runs on CPU, which makes it useful
+for tests, UI work and CPU-only boxes.
+"""
+import hashlib
+
+import torch
+from diffusers import (
+    AutoencoderKL,
+    FlowMatchEulerDiscreteScheduler,
+    FluxKontextPipeline,
+    FluxTransformer2DModel,
+)
+
+STUB_TEXT_TOKENS = 16
+STUB_TEXT_DIM = 32
+
+
+class StubKontextPipeline(FluxKontextPipeline):
+    """
+    Kontext pipeline whose text encoders are replaced by a prompt hash.
+
+    Prompt embeddings are drawn from a generator seeded with the SHA-256 of the
+    prompt, so identical prompts always map to identical embeddings without
+    needing a tokenizer download.
+    """
+
+    def encode_prompt(
+        self,
+        prompt,
+        prompt_2=None,
+        device=None,
+        num_images_per_prompt=1,
+        prompt_embeds=None,
+        pooled_prompt_embeds=None,
+        max_sequence_length=512,
+        lora_scale=None,
+    ):
+        device = device or self._execution_device
+        dtype = self.transformer.dtype
+
+        if prompt_embeds is None:
+            prompt = [prompt] if isinstance(prompt, str) else prompt
+            embeds, pooled = [], []
+            for text in prompt:
+                digest = hashlib.sha256(text.encode("utf-8")).digest()
+                generator = torch.Generator().manual_seed(int.from_bytes(digest[:8], "little") >> 1)
+                embeds.append(torch.randn(1, STUB_TEXT_TOKENS, STUB_TEXT_DIM, generator=generator))
+                pooled.append(torch.randn(1, STUB_TEXT_DIM, generator=generator))
+            prompt_embeds = torch.cat(embeds).repeat_interleave(num_images_per_prompt, dim=0)
+            pooled_prompt_embeds = torch.cat(pooled).repeat_interleave(num_images_per_prompt, dim=0)
+
+        prompt_embeds = prompt_embeds.to(device=device, dtype=dtype)
+        pooled_prompt_embeds = pooled_prompt_embeds.to(device=device, dtype=dtype)
+        text_ids = torch.zeros(prompt_embeds.shape[1], 3, device=device, dtype=dtype)
+        return prompt_embeds, pooled_prompt_embeds, text_ids
+
+
+def build_stub_pipeline(seed=0):
+    """
+    Build a ``StubKontextPipeline`` with tiny, seeded random weights.
+
+    Args:
+        seed (int, optional): Seed for weight initialisation. Defaults to 0.
+
+    Returns:
+        StubKontextPipeline: A CPU-resident float32 pipeline.
+    """
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        transformer = FluxTransformer2DModel(
+            patch_size=1,
+            in_channels=64,
+            num_layers=1,
+            num_single_layers=1,
+            attention_head_dim=16,
+            num_attention_heads=2,
+            joint_attention_dim=STUB_TEXT_DIM,
+            pooled_projection_dim=STUB_TEXT_DIM,
+            guidance_embeds=True,
+            axes_dims_rope=(4, 6, 6),
+        )
+        vae = AutoencoderKL(
+            in_channels=3,
+            out_channels=3,
+            down_block_types=("DownEncoderBlock2D",) * 4,
+            up_block_types=("UpDecoderBlock2D",) * 4,
+            block_out_channels=(8, 8, 8, 8),
+            layers_per_block=1,
+            latent_channels=16,
+            norm_num_groups=4,
+            sample_size=32,
+            use_quant_conv=False,
+            use_post_quant_conv=False,
+            shift_factor=0.0609,
+            scaling_factor=1.5035,
+        )
+
+    pipe = StubKontextPipeline(
+        scheduler=FlowMatchEulerDiscreteScheduler(),
+        vae=vae.eval(),
+        text_encoder=None,
+        tokenizer=None,
+        text_encoder_2=None,
+        tokenizer_2=None,
+        transformer=transformer.eval(),
+    )
+    return pipe
@@ -0,0 +1,200 @@
+"""
+CPU-resident, optionally int8-quantized text encoders.
+
+Under model CPU offload the T5 encoder (about 9.5 GB in bf16) is copied to the
+accelerator and back for every prompt that misses the prompt cache, and it
+competes with the transformer for device memory in every other offload mode.
+``use_cpu_text_encoders`` moves the text encoders out of the pipeline into a
+text-only pipeline that stays on CPU, optionally with int8 weights. Prompts
+are then encoded on a thread of their own, so a batch's prompts can be encoded
+while its input images go through the VAE (see
+``PromptEmbeddingCache.prefetch``).
+
+Int8 quantization is weight-only: every linear layer keeps int8 weights with
+one scale per output channel and dequantizes them layer by layer as it runs.
+``embedding_similarity`` measures how far the quantized embeddings drift from
+the bf16 ones (``python benchmark.py text-encoders``).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+from metrics import span
+
+
+class Int8Linear(torch.nn.Module):
+    """A linear layer with int8 weights and a float32 scale per output channel."""
+
+    def __init__(self, weight, scale, bias):
+        super().__init__()
+        self.in_features = weight.shape[1]
+        self.out_features = weight.shape[0]
+        # Named ``weight`` so model code that inspects ``layer.weight.dtype`` sees int8.
+        self.register_buffer("weight", weight)
+        self.register_buffer("scale", scale)
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_linear(cls, linear):
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        quantized = (weight / scale).round().clamp(-127, 127).to(torch.int8)
+        bias = None if linear.bias is None else linear.bias.detach().float()
+        return cls(quantized, scale, bias)
+
+    def forward(self, x):
+        weight = self.weight.to(x.dtype) * self.scale.to(x.dtype)
+        return F.linear(x, weight, None if self.bias is None else self.bias.to(x.dtype))
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def module_nbytes(module):
+    return sum(t.numel() * t.element_size() for t in (*module.parameters(), *module.buffers()))
+
+
+@torch.no_grad()
+def quantize_int8(module):
+    """
+    Replace every ``nn.Linear`` in ``module`` with an ``Int8Linear``, in place.
+
+    Layers are converted one at a time so the float copy of only one weight
+    exists at once. Everything else (embeddings, norms) is cast to float32,
+    which is also what the quantized layers compute in on CPU.
+
+    Returns:
+        The quantized module, on CPU.
+    """
+    module.to("cpu")
+    before = module_nbytes(module)
+    for parent in list(module.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, torch.nn.Linear):
+                setattr(parent, name, Int8Linear.from_linear(child))
+    for tensor in (*module.parameters(), *module.buffers()):
+        if tensor.is_floating_point() and tensor.dtype != torch.float32:
+            tensor.data = tensor.data.float()
+    print(f"Quantized {type(module).__name__} to int8: "
+          f"{before / 1024**2:.0f} MB -> {module_nbytes(module) / 1024**2:.0f} MB")
+    return module
+
+
+class TextEncoderThread:
+    """
+    Encodes prompts on a dedicated thread with a CPU-resident text pipeline.
+
+    Args:
+        encode_prompt (callable): The text pipeline's ``encode_prompt``, run on CPU.
+        dtype (torch.dtype): Dtype the embeddings are handed out in (the transformer's).
+    """
+
+    def __init__(self, encode_prompt, dtype):
+        self._encode_prompt = encode_prompt
+        self.dtype = dtype
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="text-encoder")
+        self.encoded = 0
+
+    def _encode(self, prompt, max_sequence_length):
+        with torch.no_grad(), span("text_encode"):
+            prompt_embeds, pooled_prompt_embeds, _ = self._encode_prompt(
+                prompt=prompt, prompt_2=None, device="cpu", max_sequence_length=max_sequence_length,
+            )
+        self.encoded += 1
+        return prompt_embeds, pooled_prompt_embeds
+
+    def submit(self, prompt, max_sequence_length=512):
+        """Start encoding ``prompt``; the future resolves to CPU ``(prompt_embeds, pooled_prompt_embeds)``."""
+        return self._executor.submit(self._encode, prompt, max_sequence_length)
+
+    def encode_prompt(
+        self,
+        prompt,
+        prompt_2=None,
+        device=None,
+        num_images_per_prompt=1,
+        prompt_embeds=None,
+        pooled_prompt_embeds=None,
+        max_sequence_length=512,
+        lora_scale=None,
+    ):
+        """Drop-in for ``FluxKontextPipeline.encode_prompt`` that encodes on the thread."""
+        if prompt_embeds is None:
+            if not isinstance(prompt, str):
+                raise ValueError("CPU text encoders encode one prompt at a time")
+            prompt_embeds, pooled_prompt_embeds = self.submit(prompt, max_sequence_length).result()
+            prompt_embeds = prompt_embeds.repeat_interleave(num_images_per_prompt, dim=0)
+            pooled_prompt_embeds = pooled_prompt_embeds.repeat_interleave(num_images_per_prompt, dim=0)
+        prompt_embeds = prompt_embeds.to(device=device, dtype=self.dtype)
+        pooled_prompt_embeds = pooled_prompt_embeds.to(device=device, dtype=self.dtype)
+        text_ids = torch.zeros(prompt_embeds.shape[1], 3, device=device, dtype=self.dtype)
+        return prompt_embeds, pooled_prompt_embeds, text_ids
+
+
+def use_cpu_text_encoders(pipe, quantize=False):
+    """
+    Move ``pipe``'s text encoders to CPU for good and encode prompts on a thread.
+
+    Call before applying an offload mode, so offloading never sees the text
+    encoders. Afterwards ``pipe.encode_prompt`` runs on the text encoder thread
+    and ``pipe.encode_prompt_async`` starts an encode without waiting for it.
+
+    Args:
+        pipe: A Flux/Kontext pipeline.
+        quantize (bool, optional): Quantize the text encoders' linear layers to
+            int8. Defaults to False (bf16 on CPU).
+
+    Returns:
+        TextEncoderThread: The thread now serving ``pipe``'s prompts.
+    """
+    text_encoder, text_encoder_2 = pipe.text_encoder, pipe.text_encoder_2
+    if text_encoder is None and text_encoder_2 is None:
+        # Nothing to move: the stub pipeline encodes prompts without models.
+        encode_prompt = pipe.encode_prompt
+    else:
+        prepare = quantize_int8 if quantize else (lambda module: module.to("cpu"))
+        text_pipe = type(pipe)(
+            scheduler=pipe.scheduler,
+            vae=None,
+            text_encoder=prepare(text_encoder),
+            tokenizer=pipe.tokenizer,
+            text_encoder_2=prepare(text_encoder_2),
+            tokenizer_2=pipe.tokenizer_2,
+            transformer=None,
+        )
+        pipe.register_modules(text_encoder=None, text_encoder_2=None)
+        encode_prompt = text_pipe.encode_prompt
+    thread = TextEncoderThread(encode_prompt, dtype=pipe.transformer.dtype)
+    pipe.encode_prompt = thread.encode_prompt
+    pipe.encode_prompt_async = thread.submit
+    return thread
+
+
+@torch.no_grad()
+def embedding_similarity(reference, candidate, prompts, max_sequence_length=512):
+    """
+    Cosine similarity of two text encoders' embeddings of the same prompts.
+
+    Args:
+        reference (callable): ``encode_prompt`` of the reference (e.g. bf16) encoders.
+        candidate (callable): ``encode_prompt`` of the encoders under test.
+        prompts (list[str]): Prompts to compare on.
+
+    Returns:
+        dict: Minimum and mean cosine similarity over tokens of ``prompt_embeds``
+        and over prompts of ``pooled_prompt_embeds``.
+    """
+    token_scores, pooled_scores = [], []
+    for prompt in prompts:
+        expected = reference(prompt=prompt, prompt_2=None, device="cpu", max_sequence_length=max_sequence_length)
+        actual = candidate(prompt=prompt, prompt_2=None, device="cpu", max_sequence_length=max_sequence_length)
+        token_scores.append(F.cosine_similarity(expected[0].float(), actual[0].float(), dim=-1).flatten())
+        pooled_scores.append(F.cosine_similarity(expected[1].float(), actual[1].float(), dim=-1).flatten())
+    tokens, pooled = torch.cat(token_scores), torch.cat(pooled_scores)
+    return {
+        "prompt_embeds_min": tokens.min().item(),
+        "prompt_embeds_mean": tokens.mean().item(),
+        "pooled_min": pooled.min().item(),
+        "pooled_mean": pooled.mean().item(),
+    }
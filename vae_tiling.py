@@ -0,0 +1,72 @@
+"""
+Tiled VAE encode and decode for large images.
+
+The VAE's activations grow with the full image resolution, so at high
+resolutions the encode of the input and the decode of the result are what run
+out of memory first, long before the transformer does. ``VAETiling`` switches
+the pipeline's VAE to tiled mode for images above a pixel threshold: the image
+(or latent) is split into overlapping tiles that are encoded or decoded one at
+a time and blended linearly across the overlaps, so peak activation memory
+depends on the tile size instead of the image size. Smaller images keep the
+untiled path and produce exactly the same output as before.
+"""
+from contextlib import contextmanager
+
+
+class VAETiling:
+    """
+    Enables tiled VAE encode and decode above a pixel threshold.
+
+    Args:
+        min_pixels (int): Images with more pixels than this are tiled. ``0``
+            disables tiling.
+        tile_size (int, optional): Tile edge in image pixels. Defaults to 512.
+        overlap (float, optional): Fraction of each tile shared with its
+            neighbours and blended across to hide seams. Defaults to 0.25.
+    """
+
+    def __init__(self, min_pixels, tile_size=512, overlap=0.25):
+        self.min_pixels = min_pixels
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tiled = 0
+        self.untiled = 0
+
+    @property
+    def enabled(self):
+        return self.min_pixels > 0
+
+    def wanted(self, width, height):
+        return self.enabled and width * height > self.min_pixels
+
+    @contextmanager
+    def applied(self, pipe, width, height):
+        """
+        Tile the VAE for the encodes and decodes of one ``width`` x ``height`` image.
+
+        Yields:
+            bool: Whether tiling is in effect.
+        """
+        if not self.wanted(width, height):
+            self.untiled += 1
+            yield False
+            return
+        vae = pipe.vae
+        saved = (vae.use_tiling, vae.tile_sample_min_size, vae.tile_latent_min_size, vae.tile_overlap_factor)
+        vae.use_tiling = True
+        vae.tile_sample_min_size = self.tile_size
+        vae.tile_latent_min_size = self.tile_size // pipe.vae_scale_factor
+        vae.tile_overlap_factor = self.overlap
+        self.tiled += 1
+        try:
+            yield True
+        finally:
+            vae.use_tiling, vae.tile_sample_min_size, vae.tile_latent_min_size, vae.tile_overlap_factor = saved
+
+    def stats(self):
+        return {
+            "min_pixels": self.min_pixels,
+            "tile_size": self.tile_size,
+            "tiled": self.tiled,
+            "untiled": self.untiled,
+        }
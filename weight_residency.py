@@ -0,0 +1,211 @@
+"""
+Keep decompressed DFloat11 blocks resident on the device.
+
+DFloat11 stores the transformer compressed and decodes each block into one
+shared bf16 buffer right before it runs, so every step pays the decode of all
+blocks again (and, with ``sequential`` offload, the host-to-device copy of
+their compressed data as well). ``WeightResidency`` wraps each block's decode
+hook: once a block has been decoded it copies the weights into storage of its
+own and serves later calls from there, for as many blocks as fit in a byte
+budget. When the budget is full, a block displaces resident blocks only if it
+has been used more often than they have, so blocks that run more often (e.g.
+the first block, which runs on every step the step cache skips) stay resident.
+"""
+import time
+from contextlib import contextmanager
+
+import torch
+
+from metrics import observe
+
+TRANSFER_BUCKETS = tuple(2**exponent * 1024**2 for exponent in range(0, 16))  # 1MB .. 32GB
+
+
+def _is_decode_hook(hook):
+    return getattr(hook, "__qualname__", "").endswith("decode_hook")
+
+
+def _weight_targets(module):
+    """The modules whose ``weight`` the decode hook injects."""
+    return getattr(module, "weight_injection_modules", None) or [module]
+
+
+class _Block:
+    __slots__ = ("name", "module", "decode", "uses", "weights", "bytes", "transfer_bytes")
+
+    def __init__(self, name, module, decode):
+        self.name = name
+        self.module = module
+        self.decode = decode
+        self.uses = 0
+        self.weights = None
+        self.bytes = 0
+        # Compressed data copied to the device on every decode (sequential offload only).
+        self.transfer_bytes = sum(
+            tensor.numel() * tensor.element_size() for tensor in getattr(module, "offloaded_tensors", {}).values()
+        )
+
+
+class _CallStats:
+    """Decode work done during one pipeline call."""
+
+    def __init__(self, timed):
+        self.decodes = 0
+        self.resident_hits = 0
+        self.transferred_bytes = 0
+        self.decode_seconds = 0.0
+        self._timed = timed
+        self._events = []
+
+    def start(self):
+        if self._timed:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def stop(self, start):
+        if self._timed:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self._events.append((start, end))
+        else:
+            self.decode_seconds += time.perf_counter() - start
+
+    def finish(self):
+        # Device events are only read once the call is over, so timing does not stall every decode.
+        if self._events:
+            self._events[-1][1].synchronize()
+            self.decode_seconds += sum(start.elapsed_time(end) for start, end in self._events) / 1000
+            self._events = []
+
+
+class WeightResidency:
+    """
+    Serves decoded DFloat11 blocks from resident copies, within a byte budget.
+
+    Args:
+        budget_bytes (int): Device memory available for resident blocks. ``0``
+            disables residency; decode time and transfers are still counted.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.resident_bytes = 0
+        self.evictions = 0
+        self.decodes = 0
+        self.resident_hits = 0
+        self._blocks = None
+        self._call = None
+
+    def _install(self, transformer):
+        self._blocks = []
+        for name, module in transformer.named_modules():
+            for hook_id, hook in list(module._forward_pre_hooks.items()):
+                # Unwrap hooks installed by an earlier manager on the same pipeline.
+                decode = getattr(hook, "decode", hook)
+                if _is_decode_hook(decode):
+                    block = _Block(name, module, decode)
+                    module._forward_pre_hooks[hook_id] = self._hook(block)
+                    self._blocks.append(block)
+        if self._blocks:
+            print(f"Weight residency: {len(self._blocks)} DFloat11 blocks, "
+                  f"budget {self.budget_bytes / 1024**2:.0f} MB")
+
+    def _hook(self, block):
+        def hook(module, args):
+            block.uses += 1
+            call = self._call
+            if block.weights is not None:
+                for target, weight in zip(_weight_targets(module), block.weights):
+                    target.weight = weight
+                self.resident_hits += 1
+                if call is not None:
+                    call.resident_hits += 1
+                return None
+
+            if call is not None:
+                start = call.start()
+            block.decode(module, args)
+            if call is not None:
+                call.stop(start)
+                call.decodes += 1
+                call.transferred_bytes += block.transfer_bytes
+            self.decodes += 1
+            self._admit(block)
+            return None
+        hook.decode = block.decode
+        return hook
+
+    def _admit(self, block):
+        if self.budget_bytes <= 0:
+            return
+        targets = _weight_targets(block.module)
+        size = sum(target.weight.numel() * target.weight.element_size() for target in targets)
+        if self.resident_bytes + size > self.budget_bytes:
+            # Only make room by evicting blocks that are used less often than this one.
+            victims = sorted(
+                (other for other in self._blocks if other.weights is not None and other.uses < block.uses),
+                key=lambda other: other.uses,
+            )
+            freed = self.budget_bytes - self.resident_bytes
+            chosen = []
+            for victim in victims:
+                if freed >= size:
+                    break
+                chosen.append(victim)
+                freed += victim.bytes
+            if freed < size:
+                return
+            for victim in chosen:
+                self._evict(victim)
+        # The decoded weights live in DFloat11's shared buffer, which the next block overwrites.
+        block.weights = [target.weight.clone() for target in targets]
+        block.bytes = size
+        self.resident_bytes += size
+
+    def _evict(self, block):
+        for target in _weight_targets(block.module):
+            # Re-decoded (and re-injected) before the block next runs.
+            target.weight = None
+        block.weights = None
+        self.resident_bytes -= block.bytes
+        block.bytes = 0
+        self.evictions += 1
+
+    @contextmanager
+    def applied(self, pipe):
+        """
+        Count the decode work of one pipeline call, installing the hooks on first use.
+
+        Yields:
+            The call's counters (``decodes``, ``resident_hits``,
+            ``transferred_bytes`` and ``decode_seconds``), or None if the
+            transformer has no DFloat11 blocks.
+        """
+        if self._blocks is None:
+            self._install(pipe.transformer)
+        if not self._blocks:
+            yield None
+            return
+        call = self._call = _CallStats(timed=torch.cuda.is_available())
+        try:
+            yield call
+        finally:
+            self._call = None
+            call.finish()
+            observe("kontext_weight_decode_seconds", call.decode_seconds)
+            observe("kontext_weight_transfer_bytes", call.transferred_bytes, buckets=TRANSFER_BUCKETS)
+
+    def stats(self):
+        blocks = self._blocks or []
+        return {
+            "blocks": len(blocks),
+            "resident_blocks": sum(block.weights is not None for block in blocks),
+            "resident_bytes": self.resident_bytes,
+            "budget_bytes": self.budget_bytes,
+            "decodes": self.decodes,
+            "resident_hits": self.resident_hits,
+            "evictions": self.evictions,
+        }
+
@@ -0,0 +1,660 @@
+"""
+Multi-worker mode: one pipeline per device, behind a shared dispatcher.
+
+``WorkerPool`` starts one worker process per device (``python workers.py``),
+each owning its own pipeline, caches and ``BatchScheduler``. The front end
+(UI, API, example precompute) submits to the pool exactly as it would to a
+``BatchScheduler``: requests wait in one priority queue and are handed to the
+least-loaded worker that has room, over a local authenticated connection.
+Images cross the process boundary as raw RGB in shared memory; only small
+control messages (parameters, progress, previews, stats) are pickled.
+
+Accelerator workers see only their own device (``CUDA_VISIBLE_DEVICES``); CPU
+workers split the cores of the host between them.
+
+Metrics recorded inside the pipeline (stage spans, caches) stay in the worker
+processes; the front end records queue waits and per-request run times.
+"""
+import argparse
+import atexit
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+from cancellation import CancelToken
+from inference import GenerationRequest, GenerationResult
+from latents import image_hash
+from memory import process_memory
+from metrics import metrics
+from pipeline_loader import PROCESS_START
+
+AUTHKEY_ENV = "KONTEXT_WORKER_AUTHKEY"
+
+
+def parse_devices(spec, cuda_devices=0):
+    """
+    Device list of a ``KONTEXT_WORKERS`` value.
+
+    ``"cuda:0,cuda:1"`` or ``"cpu,cpu"`` list the workers explicitly; ``"auto"``
+    means one worker per visible CUDA device, or a single CPU worker without one.
+    """
+    if spec.strip() == "auto":
+        return [f"cuda:{index}" for index in range(cuda_devices)] or ["cpu"]
+    devices = [device.strip() for device in spec.split(",") if device.strip()]
+    for device in devices:
+        if device != "cpu" and not (device.startswith("cuda:") and device[5:].isdigit()):
+            raise ValueError(f"Unknown worker device {device!r}; use cuda:<index> or cpu")
+    return devices
+
+
+def _split_cpus(count):
+    """Contiguous, equally sized sets of the CPUs this process may run on."""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    size = max(1, len(cpus) // count)
+    return [cpus[index * size:(index + 1) * size] or cpus for index in range(count)]
+
+
+def _attach(name):
+    """Open an existing shared memory block without letting this process's tracker own it."""
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: attaching registers the block, which would be unlinked at exit.
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _array(shm, shape):
+    return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+
+class _Job:
+    __slots__ = ("id", "request", "priority", "on_start", "future", "enqueued", "started", "worker", "shm",
+                 "cancel_sent", "group")
+
+    def __init__(self, job_id, request, priority, on_start):
+        self.id = job_id
+        self.request = request
+        self.priority = priority
+        self.on_start = on_start
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+        self.started = None
+        self.worker = None
+        self.shm = []
+        self.cancel_sent = False
+        self.group = None
+
+    @property
+    def order(self):
+        return (-self.priority, self.enqueued)
+
+
+class _Worker:
+    def __init__(self, index, device, process):
+        self.index = index
+        self.device = device
+        self.process = process
+        self.connection = None
+        self.send_lock = threading.Lock()
+        self.alive = True
+        self.ready = False
+        self.load_seconds = None
+        self.in_flight = {}
+        self.completed = 0
+        self.failed = 0
+        self.run_seconds = 0.0
+
+    def send(self, *message):
+        with self.send_lock:
+            self.connection.send(message)
+
+
+class RemoteLoader:
+    """
+    Stands in for ``PipelineLoader`` in the front end of a ``WorkerPool``.
+
+    The pipelines live in the workers, which load them as soon as they start:
+    ``get()`` only waits until one of them is ready and returns None.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.backend_name = f"{pool.backend_name} x{len(pool.workers)} workers"
+        self.first_request_since_start = None
+
+    @property
+    def is_loaded(self):
+        return self.pool.is_loaded
+
+    def get(self):
+        self.pool.wait_ready()
+
+    def warmup_async(self):
+        return None
+
+    def record_request(self):
+        if self.first_request_since_start is None:
+            self.first_request_since_start = time.perf_counter() - PROCESS_START
+            print(f"First request served {self.first_request_since_start:.2f}s after process start")
+
+    def stats(self):
+        return {
+            "backend": self.backend_name,
+            "loaded": self.is_loaded,
+            "first_request_since_start": self.first_request_since_start,
+        }
+
+
+class WorkerPool:
+    """
+    Runs requests on a pool of worker processes; a drop-in for ``BatchScheduler``.
+
+    Args:
+        devices (list[str]): One worker per entry, ``"cuda:<index>"`` or ``"cpu"``.
+        backend (str): Pipeline backend the workers load.
+        offload_mode (str): Offload mode the workers use.
+        max_batch_size (int, optional): Batch size of each worker's scheduler;
+            each worker is given at most this many requests at a time so the
+            rest stay in the shared queue. Defaults to 1.
+        host (str, optional): Interface of the local IPC listener. Defaults to
+            ``"127.0.0.1"``.
+    """
+
+    def __init__(self, devices, backend, offload_mode, max_batch_size=1, host="127.0.0.1"):
+        self.per_worker_batch_size = max(1, max_batch_size)
+        self.max_batch_size = self.per_worker_batch_size * len(devices)
+        self.backend_name = backend
+        self._pending = []
+        self._jobs = {}
+        self._next_id = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._ready = threading.Event()
+
+        authkey = secrets.token_bytes(32)
+        self._listener = Listener((host, 0), authkey=authkey)
+        address = "%s:%d" % self._listener.address
+        cpu_sets = iter(_split_cpus(devices.count("cpu") or 1))
+        self.workers = []
+        for index, device in enumerate(devices):
+            env = dict(os.environ, **{AUTHKEY_ENV: authkey.hex()})
+            command = [
+                sys.executable, os.path.abspath(__file__), "--address", address, "--index", str(index),
+                "--backend", backend, "--offload", offload_mode, "--batch-size", str(self.per_worker_batch_size),
+            ]
+            if device == "cpu":
+                env["CUDA_VISIBLE_DEVICES"] = ""
+                command += ["--cpus", ",".join(map(str, next(cpu_sets)))]
+            else:
+                env["CUDA_VISIBLE_DEVICES"] = device.split(":")[1]
+            process = subprocess.Popen(command, env=env)
+            self.workers.append(_Worker(index, device, process))
+        print(f"Started {len(devices)} workers ({', '.join(devices)}); waiting for them to connect...")
+
+        connections = []
+
+        def accept():
+            for _ in devices:
+                connection = self._listener.accept()
+                connections.append((connection, connection.recv()))
+        accepting = threading.Thread(target=accept, name="worker-accept", daemon=True)
+        accepting.start()
+        while accepting.is_alive():
+            accepting.join(0.5)
+            if any(worker.process.poll() is not None for worker in self.workers):
+                self.shutdown()
+                raise RuntimeError("a worker process exited during start-up")
+
+        for connection, (_, index, pid) in connections:
+            worker = self.workers[index]
+            worker.connection = connection
+            threading.Thread(target=self._receive, args=(worker,), name=f"worker-{index}-receiver", daemon=True).start()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="worker-dispatcher", daemon=True)
+        self._dispatcher.start()
+        atexit.register(self.shutdown)
+
+    # --- BatchScheduler interface -------------------------------------------------
+
+    def submit(self, request, priority=0, on_start=None):
+        """
+        Queue ``request`` and return a ``Future`` resolving to its ``GenerationResult``.
+
+        Args:
+            request (GenerationRequest): The request; its callbacks run on the
+                front end as the worker reports progress.
+            priority (int, optional): Higher values are dispatched first. Defaults to 0.
+            on_start (callable, optional): Called with the seconds ``request``
+                spent queued (in the pool and on its worker) once it starts running.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WorkerPool is shut down")
+            self._next_id += 1
+            job = _Job(self._next_id, request, priority, on_start)
+            self._pending.append(job)
+            self._cond.notify()
+        return job.future
+
+    def submit_many(self, requests, priority=0, on_start=None):
+        """Queue ``requests`` to run together in one batch on one worker; returns their futures."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WorkerPool is shut down")
+            group = []
+            for request in requests:
+                self._next_id += 1
+                job = _Job(self._next_id, request, priority, on_start)
+                job.enqueued = group[0].enqueued if group else job.enqueued
+                job.group = group
+                group.append(job)
+            self._pending.extend(group)
+            self._cond.notify()
+        return [job.future for job in group]
+
+    def __call__(self, request):
+        return self.submit(request).result()
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def shutdown(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        for worker in self.workers:
+            if worker.alive and worker.connection is not None:
+                try:
+                    worker.send("shutdown")
+                except OSError:
+                    pass
+        for worker in self.workers:
+            try:
+                worker.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+        self._listener.close()
+
+    # --- Loader interface (the pipelines live in the workers) ----------------------
+
+    @property
+    def is_loaded(self):
+        return any(worker.ready for worker in self.workers)
+
+    def wait_ready(self, timeout=None):
+        """Block until at least one worker has loaded its pipeline."""
+        if not self._ready.wait(timeout):
+            raise TimeoutError("no worker finished loading its pipeline")
+
+    # --- Dispatch ----------------------------------------------------------------
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                self._forward_cancellations()
+                self._pending = [job for job in self._pending if not self._drop_if_cancelled(job)]
+                assignments = []
+                while self._pending:
+                    worker = self._least_loaded()
+                    if worker is None:
+                        break
+                    first = min(self._pending, key=lambda job: job.order)
+                    # A group goes to one worker as a whole, even if it exceeds the worker's room.
+                    jobs = [job for job in self._pending if job is first or (first.group and job.group is first.group)]
+                    for job in jobs:
+                        self._pending.remove(job)
+                    jobs = [job for job in jobs if job.future.set_running_or_notify_cancel()]
+                    for job in jobs:
+                        job.worker = worker
+                        worker.in_flight[job.id] = job
+                        self._jobs[job.id] = job
+                    if jobs:
+                        assignments.append((worker, jobs))
+                if not assignments:
+                    # Also wakes up periodically to forward cancellations of running jobs.
+                    self._cond.wait(0.1)
+            for worker, jobs in assignments:
+                self._send_jobs(worker, jobs)
+
+    def _least_loaded(self):
+        candidates = [
+            worker for worker in self.workers
+            if worker.alive and len(worker.in_flight) < self.per_worker_batch_size
+        ]
+        return min(candidates, key=lambda worker: (len(worker.in_flight), worker.index), default=None)
+
+    def _drop_if_cancelled(self, job):
+        if job.future.cancelled():
+            return True
+        if job.request.cancelled and job.future.set_running_or_notify_cancel():
+            job.future.set_result(None)
+            return True
+        return False
+
+    def _forward_cancellations(self):
+        for job in self._jobs.values():
+            if not job.cancel_sent and job.request.cancelled and job.worker.alive:
+                job.cancel_sent = True
+                try:
+                    job.worker.send("cancel", job.id, job.request.cancel_token.reason)
+                except OSError:
+                    pass
+
+    def _send_jobs(self, worker, jobs):
+        specs = []
+        for job in jobs:
+            try:
+                specs.append(self._job_spec(job))
+            except Exception as exc:
+                self._complete(job, exception=exc)
+        if not specs:
+            return
+        try:
+            worker.send("generate", specs)
+        except OSError as exc:
+            for job in jobs:
+                self._complete(job, exception=exc)
+
+    def _job_spec(self, job):
+        """Write ``job``'s input image to shared memory and describe the job for the worker."""
+        request = job.request
+        image_meta = None
+        if request.input_image is not None:
+            pixels = np.asarray(request.input_image.convert("RGB"), dtype=np.uint8)
+            shm = SharedMemory(create=True, size=pixels.nbytes)
+            job.shm.append(shm)
+            _array(shm, pixels.shape)[:] = pixels
+            image_meta = (shm.name, pixels.shape)
+        output = SharedMemory(create=True, size=request.width * request.height * 3)
+        job.shm.append(output)
+        params = {
+            "prompt": request.prompt,
+            "seed": request.seed,
+            "guidance_scale": request.guidance_scale,
+            "steps": request.steps,
+            "width": request.width,
+            "height": request.height,
+            "input_latent_key": request.input_latent_key,
+            "preview_every": request.preview_every if request.on_preview is not None else 0,
+        }
+        return job.id, params, image_meta, output.name, request.on_step is not None
+
+    # --- Worker messages ---------------------------------------------------------
+
+    def _receive(self, worker):
+        while True:
+            try:
+                message = worker.connection.recv()
+            except (EOFError, OSError):
+                break
+            kind, args = message[0], message[1:]
+            if kind == "ready":
+                worker.ready = True
+                worker.load_seconds = args[0]
+                self._ready.set()
+                print(f"Worker {worker.index} ({worker.device}) ready in {args[0]:.1f}s")
+                continue
+            job = self._jobs.get(args[0])
+            if job is None:
+                continue
+            if kind == "started":
+                job.started = time.perf_counter()
+                metrics.record_span("queue_wait", job.enqueued, job.started, worker=worker.index)
+                if job.on_start is not None:
+                    job.on_start(job.started - job.enqueued)
+            elif kind == "step":
+                job.request.on_step(args[1], args[2])
+            elif kind == "preview":
+                _, pixels, size = args
+                job.request.on_preview(Image.frombytes("RGB", size, pixels))
+            elif kind == "done":
+                image = Image.fromarray(_array(job.shm[-1], (job.request.height, job.request.width, 3)).copy())
+                stats = args[1]
+                self._complete(job, result=GenerationResult(
+                    image=image, latents=None, latent_key=image_hash(image), **stats,
+                ))
+            elif kind == "cancelled":
+                self._complete(job, result=None)
+            elif kind == "error":
+                self._complete(job, exception=RuntimeError(f"worker {worker.index}: {args[1]}"))
+
+        worker.alive = False
+        if not self._closed:
+            try:
+                code = worker.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                code = None
+            print(f"Worker {worker.index} ({worker.device}) disconnected (exit code {code})")
+        with self._cond:
+            jobs = list(worker.in_flight.values())
+        for job in jobs:
+            self._complete(job, exception=RuntimeError(f"worker {worker.index} exited"))
+
+    def _complete(self, job, result=None, exception=None):
+        worker = job.worker
+        with self._cond:
+            worker.in_flight.pop(job.id, None)
+            self._jobs.pop(job.id, None)
+            if exception is None:
+                worker.completed += 1
+                worker.run_seconds += time.perf_counter() - (job.started or job.enqueued)
+            else:
+                worker.failed += 1
+            self._cond.notify()
+        for shm in job.shm:
+            shm.close()
+            shm.unlink()
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+
+    def stats(self):
+        completed = sum(worker.completed for worker in self.workers)
+        run_seconds = sum(worker.run_seconds for worker in self.workers)
+        return {
+            "workers": [
+                {
+                    "device": worker.device,
+                    "pid": worker.process.pid,
+                    "alive": worker.alive,
+                    "ready": worker.ready,
+                    "load_seconds": worker.load_seconds,
+                    # Host memory; a memory-mapped snapshot shows up as shared, not per worker.
+                    "memory": process_memory(worker.process.pid) if worker.alive else None,
+                    "in_flight": len(worker.in_flight),
+                    "completed": worker.completed,
+                    "failed": worker.failed,
+                }
+                for worker in self.workers
+            ],
+            "queue_depth": self.queue_depth,
+            "items": completed,
+            # Requests run in parallel on the workers, so this is per request, not per batch.
+            "mean_batch_seconds": run_seconds / completed if completed else 0.0,
+            "max_batch_size": self.max_batch_size,
+        }
+
+
+def _serve(args):
+    """Worker process: load a pipeline and run the requests sent by the pool."""
+    host, port = args.address.rsplit(":", 1)
+    connection = Client((host, int(port)), authkey=bytes.fromhex(os.environ.pop(AUTHKEY_ENV)))
+    if args.cpus:
+        cpus = [int(cpu) for cpu in args.cpus.split(",")]
+        os.sched_setaffinity(0, cpus)
+
+    import torch
+
+    import settings
+    from batching import BatchScheduler
+    from caches import ImageLatentCache, PromptEmbeddingCache
+    from compile_cache import CompiledExecution, parse_buckets
+    from inference import run_batch
+    from memory import MemoryManager
+    from pipeline_loader import PipelineLoader
+    from resolution import ResolutionPolicy
+    from schedules import FastLoRA, ScheduleCache
+    from step_cache import StepCache
+    from vae_tiling import VAETiling
+    from weight_residency import WeightResidency
+
+    if args.cpus:
+        torch.set_num_threads(len(cpus))
+    send_lock = threading.Lock()
+
+    def send(*message):
+        with send_lock:
+            connection.send(message)
+
+    compiled = CompiledExecution(
+        settings.COMPILE,
+        parse_buckets(settings.COMPILE_BUCKETS, ResolutionPolicy(settings.MAX_PIXELS)),
+        cache_dir=settings.COMPILE_CACHE_DIR,
+    )
+    loader = PipelineLoader(args.backend, offload_mode=args.offload, prepare=compiled.prepare)
+    prompt_cache = PromptEmbeddingCache(settings.PROMPT_CACHE_MB * 1024**2)
+    image_cache = ImageLatentCache(settings.IMAGE_LATENT_CACHE_MB * 1024**2)
+    schedule_cache = ScheduleCache()
+    fast_lora = FastLoRA(settings.FAST_LORA, scale=settings.FAST_LORA_SCALE, max_steps=settings.FAST_LORA_MAX_STEPS)
+    step_cache = StepCache(settings.STEP_CACHE_THRESHOLD)
+    weight_residency = WeightResidency(settings.WEIGHT_RESIDENCY_MB * 1024**2)
+    vae_tiling = VAETiling(settings.VAE_TILING_PIXELS, tile_size=settings.VAE_TILE_SIZE)
+    memory_manager = MemoryManager(high_water=settings.MEMORY_HIGH_WATER, idle_seconds=settings.MEMORY_IDLE_SECONDS)
+
+    def generate_batch(requests):
+        with memory_manager.active():
+            return run_batch(
+                loader.get(), requests, prompt_cache, image_cache, schedule_cache, fast_lora, step_cache,
+                weight_residency, vae_tiling,
+            )
+
+    scheduler = BatchScheduler(
+        generate_batch,
+        key_fn=lambda request: request.batch_key,
+        max_batch_size=args.batch_size,
+        max_wait=settings.BATCH_MAX_WAIT_MS / 1000,
+    )
+    send("hello", args.index, os.getpid())
+
+    def load():
+        loader.get().set_progress_bar_config(disable=True)
+        send("ready", loader.load_seconds)
+    threading.Thread(target=load, name="pipeline-warmup", daemon=True).start()
+
+    tokens = {}
+
+    def finish(job_id, output_name, future):
+        tokens.pop(job_id, None)
+        try:
+            result = future.result()
+            if result is None:
+                send("cancelled", job_id)
+                return
+            pixels = np.asarray(result.image.convert("RGB"), dtype=np.uint8)
+            output = _attach(output_name)
+            try:
+                _array(output, pixels.shape)[:] = pixels
+            finally:
+                output.close()
+            send("done", job_id, {
+                "skipped_steps": result.skipped_steps,
+                "decode_seconds": result.decode_seconds,
+                "transferred_bytes": result.transferred_bytes,
+            })
+        except Exception as exc:
+            send("error", job_id, repr(exc))
+
+    def build(job_id, params, image_meta, output_name, wants_steps):
+        image = None
+        if image_meta is not None:
+            name, shape = image_meta
+            shm = _attach(name)
+            try:
+                image = Image.fromarray(_array(shm, shape).copy())
+            finally:
+                shm.close()
+        token = tokens[job_id] = CancelToken()
+        preview_every = params.pop("preview_every")
+        return GenerationRequest(
+            **params,
+            input_image=image,
+            on_step=(lambda done, total: send("step", job_id, done, total)) if wants_steps else None,
+            on_preview=(lambda preview: send("preview", job_id, preview.tobytes(), preview.size))
+            if preview_every else None,
+            preview_every=preview_every,
+            cancel_token=token,
+        )
+
+    def start(specs):
+        requests = []
+        for spec in specs:
+            try:
+                requests.append((spec, build(*spec)))
+            except Exception as exc:
+                send("error", spec[0], repr(exc))
+        if not requests:
+            return
+        job_ids = [spec[0] for spec, _ in requests]
+        started = threading.Event()
+
+        def on_start(wait):
+            # Called once per item; the group always starts as one batch.
+            if not started.is_set():
+                started.set()
+                for job_id in job_ids:
+                    send("started", job_id)
+
+        # Jobs sent together (e.g. variations of one request) run in one batch.
+        if len(requests) == 1:
+            futures = [scheduler.submit(requests[0][1], on_start=on_start)]
+        else:
+            futures = scheduler.submit_many([request for _, request in requests], on_start=on_start)
+        for (spec, _), future in zip(requests, futures):
+            future.add_done_callback(lambda future, job_id=spec[0], output_name=spec[3]: finish(job_id, output_name, future))
+
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            break
+        kind = message[0]
+        if kind == "generate":
+            start(message[1])
+        elif kind == "cancel":
+            token = tokens.get(message[1])
+            if token is not None:
+                token.cancel(message[2] or "cancelled")
+        elif kind == "shutdown":
+            break
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker process of a WorkerPool (started by the pool).")
+    parser.add_argument("--address", required=True, help="host:port of the pool's listener")
+    parser.add_argument("--index", type=int, required=True)
+    parser.add_argument("--backend", required=True)
+    parser.add_argument("--offload", required=True)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--cpus", help="comma-separated CPUs to pin this worker to")
+    _serve(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()